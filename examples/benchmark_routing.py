@@ -0,0 +1,57 @@
+import timeit
+
+import numpy as np
+import queueing_tool as qt
+from queueing_tool.queues.choice import _choice, _alias_choice
+
+
+# Star graphs: one arrival edge into vertex 1, which fans out to
+# ``fan_out`` checkout queues.
+def star_network(fan_out):
+    adja_list = {0: {1: {}}, 1: {k: {} for k in range(2, fan_out + 2)}}
+    edge_list = {0: {1: 1}, 1: {k: 2 for k in range(2, fan_out + 2)}}
+    g = qt.adjacency2graph(adjacency=adja_list, edge_type=edge_list)
+
+    q_classes = {1: qt.QueueServer, 2: qt.QueueServer}
+    q_args = {
+        1: {'arrival_f': lambda t: t + np.random.exponential(0.01)},
+        2: {'service_f': lambda t: t + np.random.exponential(1.0)},
+    }
+    net = qt.QueueNetwork(g=g, q_classes=q_classes, q_args=q_args, seed=13,
+                          max_agents=np.infty)
+
+    # Skewed routing probabilities, so the linear scan can't stop early.
+    probs = np.arange(1, fan_out + 1, dtype=float)
+    probs = probs / probs.sum()
+    out = sorted(net.g.out_edges(1))
+    net.set_transitions({1: {e[1]: p for e, p in zip(out, probs)}})
+    return net
+
+
+def time_routing(net, n=100000):
+    # Time only the per-agent routing decision, with the old linear
+    # scan and with the alias table.
+    probs = net._route_probs[1]
+    prob, alias = net._route_alias[1]
+    k = len(probs)
+    u = np.random.uniform(size=n).tolist()
+
+    linear = timeit.timeit(lambda: [_choice(probs, x, k) for x in u], number=3) / 3
+    walker = timeit.timeit(lambda: [_alias_choice(prob, alias, x, k) for x in u], number=3) / 3
+    return linear, walker
+
+
+def time_simulation(net, n=50000):
+    net.initialize(edge_type=1)
+    start = timeit.default_timer()
+    net.simulate(n=n)
+    return timeit.default_timer() - start
+
+
+if __name__ == '__main__':
+    print('fan-out   linear scan   alias table   simulate(n=50000)')
+    for fan_out in [2, 20, 500]:
+        net = star_network(fan_out)
+        linear, walker = time_routing(net)
+        sim = time_simulation(net)
+        print('{0:7d}   {1:10.4f}s   {2:10.4f}s   {3:14.4f}s'.format(fan_out, linear, walker, sim))
@@ -24,8 +24,8 @@ def rate(t):
     return 25 + 350 * np.sin(np.pi * t / 2)**2
 
 
-def ser_f(t):
-    return t + np.random.exponential(0.2 / 2.5)
+# Service times are exponential with mean 0.2 / 2.5
+ser_f = qt.Exponential(2.5 / 0.2)
 
 
 def identity(t):
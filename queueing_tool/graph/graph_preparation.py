@@ -46,7 +46,7 @@ def add_edge_lengths(g):
     return g
 
 
-def _prepare_graph(g, g_colors, q_cls, q_arg, adjust_graph):
+def _prepare_graph(g, g_colors, q_cls, q_arg, adjust_graph, seed_seq=None):
     """Prepares a graph for use in :class:`.QueueNetwork`.
 
     This function is called by ``__init__`` in the
@@ -75,6 +75,12 @@ def _prepare_graph(g, g_colors, q_cls, q_arg, adjust_graph):
     adjust_graph : bool
         Specifies whether the graph will be adjusted using
         :func:`.adjacency2graph`.
+    seed_seq : :class:`~numpy.random.SeedSequence` (optional)
+        If given, it is spawned into one child per edge and the queue
+        on the edge with edge index ``k`` gets a
+        :class:`~numpy.random.Generator` made from the ``k``-th child.
+        Edge types whose arguments already have a ``rng`` or ``seed``
+        keep them.
 
     Returns
     -------
@@ -129,7 +135,7 @@ def _prepare_graph(g, g_colors, q_cls, q_arg, adjust_graph):
     g.new_edge_property('edge_marker_size')
     g.new_edge_property('edge_pen_width')
 
-    queues = _set_queues(g, q_cls, q_arg, 'cap' in g.vertex_properties())
+    queues = _set_queues(g, q_cls, q_arg, 'cap' in g.vertex_properties(), seed_seq)
 
     if 'pos' not in g.vertex_properties():
         g.set_pos()
@@ -156,8 +162,12 @@ def _prepare_graph(g, g_colors, q_cls, q_arg, adjust_graph):
     return g, queues
 
 
-def _set_queues(g, q_cls, q_arg, has_cap):
+def _set_queues(g, q_cls, q_arg, has_cap, seed_seq=None):
     queues = [0 for k in range(g.number_of_edges())]
+    rngs = [None for k in range(g.number_of_edges())]
+
+    if seed_seq is not None:
+        rngs = [np.random.default_rng(s) for s in seed_seq.spawn(len(rngs))]
 
     for e in g.edges():
         eType = g.ep(e, 'edge_type')
@@ -167,6 +177,10 @@ def _set_queues(g, q_cls, q_arg, has_cap):
             cap = g.vp(e[1], 'cap') if g.vp(e[1], 'cap') is not None else 0
             q_arg[eType]['num_servers'] = max(cap, 1)
 
-        queues[qedge[2]] = q_cls[eType](edge=qedge, **q_arg[eType])
+        args = q_arg[eType]
+        if rngs[qedge[2]] is not None and 'rng' not in args and 'seed' not in args:
+            args = dict(args, rng=rngs[qedge[2]])
+
+        queues[qedge[2]] = q_cls[eType](edge=qedge, **args)
 
     return queues
@@ -10,26 +10,60 @@
     QueueNetwork.draw
     QueueNetwork.get_agent_data
     QueueNetwork.get_queue_data
+    QueueNetwork.get_quantiles
+    QueueNetwork.get_sketches
+    QueueNetwork.get_sojourns
+    QueueNetwork.get_stats
     QueueNetwork.initialize
+    QueueNetwork.iter_events
     QueueNetwork.next_event_description
+    QueueNetwork.occupancy_series
+    QueueNetwork.query_data
+    QueueNetwork.record_trace
     QueueNetwork.reset_colors
     QueueNetwork.set_transitions
     QueueNetwork.show_active
     QueueNetwork.show_type
     QueueNetwork.simulate
     QueueNetwork.start_collecting_data
+    QueueNetwork.start_collecting_sojourns
+    QueueNetwork.start_collecting_states
+    QueueNetwork.start_collecting_stats
     QueueNetwork.stop_collecting_data
+    QueueNetwork.stop_collecting_sojourns
+    QueueNetwork.stop_collecting_states
+    QueueNetwork.stop_collecting_stats
+    QueueNetwork.time_average
+    QueueNetwork.to_arrow
+    QueueNetwork.to_dataframe
     QueueNetwork.transitions
+    QueueNetwork.warm_up
+    PriorityQueue
+    CalendarQueue
+    read_trace
+    verify_trace
 """
 
-from queueing_tool.network.priority_queue import PriorityQueue
+from queueing_tool.network.priority_queue import (
+    CalendarQueue,
+    PriorityQueue,
+    Scheduler
+)
 from queueing_tool.network.queue_network import (
     QueueingToolError,
     QueueNetwork
 )
+from queueing_tool.network.trace import (
+    read_trace,
+    verify_trace
+)
 
 __all__ = [
+    'CalendarQueue',
     'PriorityQueue',
     'QueueingToolError',
-    'QueueNetwork'
+    'QueueNetwork',
+    'Scheduler',
+    'read_trace',
+    'verify_trace'
 ]
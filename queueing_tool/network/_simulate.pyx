@@ -0,0 +1,1018 @@
+"""The compiled event loop behind :meth:`.QueueNetwork.simulate`.
+
+The loop mirrors ``QueueNetwork._simulate_next_event(slow=False)`` event
+for event, but while it runs the state of every queue and agent lives
+in C arrays instead of :class:`.QueueServer` and :class:`.Agent`
+objects. It only understands the stock :class:`.QueueServer`,
+:class:`.LossQueue` and :class:`.NullQueue` classes with plain
+:class:`.Agent` instances, use :func:`is_supported` to check whether a
+network can be handed to :func:`simulate`.
+
+The per queue agent heaps use the same ordering and sift algorithms as
+:class:`.AgentHeap` and the arrival and service functions are called in the same order as
+the Python loop, so a seeded network goes through exactly the same
+events either way.
+"""
+import collections
+
+cimport cython
+from cpython cimport array
+from libc.math cimport INFINITY
+from libc.stdlib cimport calloc, free, realloc
+
+import numpy as np
+
+from queueing_tool.network.priority_queue cimport (
+    CalendarQueue,
+    PriorityQueue,
+    Scheduler
+)
+from queueing_tool.queues.agent_heap cimport AgentHeap
+from queueing_tool.queues.distributions cimport Distribution
+from queueing_tool.queues.sketch cimport QuantileSketch
+from queueing_tool.queues.agents import Agent
+from queueing_tool.queues.queue_servers import (
+    LossQueue,
+    NullQueue,
+    QueueServer
+)
+
+
+cdef double EPS = 1e-7
+
+cdef enum:
+    SERVER_QUEUE = 0
+    LOSS_QUEUE = 1
+    NULL_QUEUE = 2
+
+
+# The events of a trace, see queueing_tool.network.trace.
+cdef enum:
+    TRACE_NOTHING = 0
+    TRACE_ARRIVAL = 1
+    TRACE_DEPARTURE = 2
+    TRACE_BLOCKED = 3
+
+
+# One record of TRACE_DTYPE.
+cdef packed struct TraceRecord:
+    double time
+    int edge
+    int event
+    int target
+
+
+cdef struct Heap:
+    double *times
+    long *seqs
+    int *slots
+    Py_ssize_t size
+    Py_ssize_t capacity
+    long counter
+
+
+def is_supported(net):
+    """Returns whether ``net`` can be simulated by :func:`simulate`.
+
+    Parameters
+    ----------
+    net : :class:`.QueueNetwork`
+        An initialized network.
+
+    Returns
+    -------
+    bool
+        ``True`` if every queue is a :class:`.QueueServer`,
+        :class:`.LossQueue` or :class:`.NullQueue` (and not a subclass)
+        that does not collect data, every agent in the network is a
+        plain :class:`.Agent`, and the scheduler is a
+        :class:`.PriorityQueue` or :class:`.CalendarQueue`.
+    """
+    if type(net._fancy_heap) is not PriorityQueue and \
+            type(net._fancy_heap) is not CalendarQueue:
+        return False
+
+    for q in net.edge2queue:
+        cls = type(q)
+        if cls is not QueueServer and cls is not LossQueue and cls is not NullQueue:
+            return False
+        if q.collect_data or q.AgentFactory is not Agent:
+            return False
+        for agents in (q._arrivals, q._departures, q.queue):
+            for agent in agents:
+                if type(agent) is not Agent:
+                    return False
+    return True
+
+
+def simulate(net, n=1, t=None, until=None):
+    """Simulates ``net`` forward in compiled code.
+
+    This function behaves exactly like :meth:`.QueueNetwork.simulate`;
+    the network must be initialized and :func:`is_supported` must
+    return ``True`` for it. Each call copies the state of every queue
+    and agent into the compiled loop and back, which takes about as
+    long as simulating one event in Python per edge and agent.
+
+    Parameters
+    ----------
+    net : :class:`.QueueNetwork`
+        The network to simulate.
+    n : int (optional, default: ``1``)
+        The number of events to simulate. If ``t`` is not given
+        then this parameter is used.
+    t : float (optional)
+        The amount of simulation time to simulate forward. If
+        given, ``t`` is used instead of ``n``.
+    until : float (optional)
+        The simulation time to simulate until. If given, ``until`` is
+        used instead of ``t`` and ``n``.
+    """
+    cdef _Kernel kernel = _Kernel(net)
+    if until is None and t is not None:
+        until = net._t + t
+    try:
+        if until is None:
+            kernel.run(n, INFINITY, False)
+        else:
+            kernel.run(0, until, True)
+    finally:
+        kernel.store(net)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline bint _heap_less(Heap *h, Py_ssize_t a, Py_ssize_t b) nogil:
+    if h.times[a] < h.times[b]:
+        return True
+    return h.times[a] == h.times[b] and h.seqs[a] < h.seqs[b]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _siftdown(Heap *h, Py_ssize_t startpos, Py_ssize_t pos) nogil:
+    cdef double newtime = h.times[pos]
+    cdef long newseq = h.seqs[pos]
+    cdef int newslot = h.slots[pos]
+    cdef Py_ssize_t parentpos
+
+    while pos > startpos:
+        parentpos = (pos - 1) >> 1
+        if newtime < h.times[parentpos] or \
+                (newtime == h.times[parentpos] and newseq < h.seqs[parentpos]):
+            h.times[pos] = h.times[parentpos]
+            h.seqs[pos] = h.seqs[parentpos]
+            h.slots[pos] = h.slots[parentpos]
+            pos = parentpos
+            continue
+        break
+
+    h.times[pos] = newtime
+    h.seqs[pos] = newseq
+    h.slots[pos] = newslot
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _siftup(Heap *h, Py_ssize_t pos) nogil:
+    cdef Py_ssize_t endpos = h.size
+    cdef Py_ssize_t startpos = pos
+    cdef Py_ssize_t childpos, rightpos
+    cdef double newtime = h.times[pos]
+    cdef long newseq = h.seqs[pos]
+    cdef int newslot = h.slots[pos]
+
+    childpos = 2 * pos + 1
+    while childpos < endpos:
+        rightpos = childpos + 1
+        if rightpos < endpos and not _heap_less(h, childpos, rightpos):
+            childpos = rightpos
+
+        h.times[pos] = h.times[childpos]
+        h.seqs[pos] = h.seqs[childpos]
+        h.slots[pos] = h.slots[childpos]
+        pos = childpos
+        childpos = 2 * pos + 1
+
+    h.times[pos] = newtime
+    h.seqs[pos] = newseq
+    h.slots[pos] = newslot
+    _siftdown(h, startpos, pos)
+
+
+cdef int _heap_append(Heap *h, double t, long seq, int slot) except -1:
+    # Appends without sifting, which keeps the layout of a heap that
+    # already satisfies the heap invariant.
+    cdef Py_ssize_t capacity
+    cdef double *times
+    cdef long *seqs
+    cdef int *slots
+
+    if h.size == h.capacity:
+        capacity = 2 * h.capacity if h.capacity > 0 else 4
+        times = <double *> realloc(h.times, capacity * sizeof(double))
+        if times == NULL:
+            raise MemoryError()
+        h.times = times
+        seqs = <long *> realloc(h.seqs, capacity * sizeof(long))
+        if seqs == NULL:
+            raise MemoryError()
+        h.seqs = seqs
+        slots = <int *> realloc(h.slots, capacity * sizeof(int))
+        if slots == NULL:
+            raise MemoryError()
+        h.slots = slots
+        h.capacity = capacity
+
+    h.times[h.size] = t
+    h.seqs[h.size] = seq
+    h.slots[h.size] = slot
+    h.size += 1
+    return 0
+
+
+cdef inline int _heap_push(Heap *h, double t, int slot) except -1:
+    _heap_append(h, t, h.counter, slot)
+    h.counter += 1
+    _siftdown(h, 0, h.size - 1)
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline int _heap_pop(Heap *h, double *t) nogil:
+    cdef double last_time
+    cdef long last_seq
+    cdef int last_slot, slot
+
+    h.size -= 1
+    last_time = h.times[h.size]
+    last_seq = h.seqs[h.size]
+    last_slot = h.slots[h.size]
+    if h.size > 0:
+        t[0] = h.times[0]
+        slot = h.slots[0]
+        h.times[0] = last_time
+        h.seqs[0] = last_seq
+        h.slots[0] = last_slot
+        _siftup(h, 0)
+        return slot
+
+    t[0] = last_time
+    return last_slot
+
+
+cdef inline double _heap_top(Heap *h) nogil:
+    return h.times[0] if h.size > 0 else INFINITY
+
+
+cdef inline double _call(object f, double t) except? -1:
+    # Distributions are called without going through Python.
+    if isinstance(f, Distribution):
+        return t + (<Distribution> f)._draw()
+    return f(t)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline Py_ssize_t _alias_choice(double[::1] prob, int[::1] alias, Py_ssize_t start,
+                                     double u, Py_ssize_t n) nogil:
+    # Same arithmetic as queues.choice._alias_choice
+    cdef double x = u * n
+    cdef Py_ssize_t k = <Py_ssize_t> x
+
+    if k >= n:
+        k = n - 1
+
+    if x - k < prob[start + k]:
+        return k
+    return alias[start + k]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef class _Kernel:
+    """Holds a snapshot of a network while the compiled loop runs."""
+
+    cdef Scheduler heap
+    cdef Py_ssize_t nE
+    cdef double now, max_agents
+    cdef long num_events, total_agents
+    cdef bint blocking, stepped
+    cdef double last_time
+    cdef int last_edge
+
+    cdef Heap *arrivals
+    cdef Heap *departures
+
+    cdef int[::1] kind, target, out_ptr, out_idx, alias_idx
+    cdef int[::1] fifo_head, fifo_tail
+    cdef long[::1] fifo_len
+    cdef double[::1] alias_prob
+    cdef double[::1] num_servers, buffer, active_cap, deactive_t
+    cdef double[::1] next_ct, current_t, qtime
+    cdef int[::1] active
+    cdef long[::1] num_departures, num_system, num_total
+    cdef long[::1] num_arrivals, o_arrivals, num_blocked, num_agents
+
+    cdef list arrival_f, service_f
+    cdef Distribution uniforms
+
+    # Running statistics of the queues that collect them.
+    cdef int[::1] st_on
+    cdef double[::1] st_start, st_last, st_system, st_queued, st_busy
+    cdef long[::1] w_num, s_num
+    cdef double[::1] w_mean, w_m2, s_mean, s_m2
+    cdef int[::1] sk_on
+    cdef list w_sketch, s_sketch
+    cdef int[::1] lg_on, lg_compress
+    cdef list lg_times, lg_values
+
+    cdef bint so_on
+    cdef double so_start
+    cdef long[::1] so_num, so_hops, so_blocked
+    cdef double[::1] so_mean, so_m2
+
+    cdef object trace
+    cdef TraceRecord[::1] tr_records
+    cdef Py_ssize_t tr_pos
+
+    cdef double[::1] a_time, a_arrival, a_entered
+    cdef int[::1] a_edge, a_next
+    cdef long[::1] a_num, a_blocked, a_hops
+    cdef list objs
+    cdef Py_ssize_t num_slots
+    cdef int free_slot
+
+    def __cinit__(self, net):
+        self.arrivals = NULL
+        self.departures = NULL
+        self.nE = 0
+
+    def __init__(self, net):
+        cdef Py_ssize_t nE = len(net.edge2queue)
+        cdef Py_ssize_t e, j, k, nV
+
+        self.heap = net._fancy_heap
+        self.now = net._t
+        self.max_agents = net.max_agents
+        self.num_events = net.num_events
+        self.blocking = net._blocking
+        self.stepped = False
+
+        self.trace = net._trace
+        if self.trace is not None:
+            self.tr_records = self.trace.records
+            self.tr_pos = self.trace.pos
+
+        self.arrivals = <Heap *> calloc(nE, sizeof(Heap))
+        self.departures = <Heap *> calloc(nE, sizeof(Heap))
+        if self.arrivals == NULL or self.departures == NULL:
+            raise MemoryError()
+        self.nE = nE
+
+        self.kind = np.zeros(nE, np.intc)
+        self.target = np.zeros(nE, np.intc)
+        self.fifo_head = np.full(nE, -1, np.intc)
+        self.fifo_tail = np.full(nE, -1, np.intc)
+        self.fifo_len = np.zeros(nE, np.int_)
+        self.num_servers = np.zeros(nE)
+        self.buffer = np.zeros(nE)
+        self.active_cap = np.zeros(nE)
+        self.deactive_t = np.zeros(nE)
+        self.next_ct = np.zeros(nE)
+        self.current_t = np.zeros(nE)
+        self.qtime = np.zeros(nE)
+        self.active = np.zeros(nE, np.intc)
+        self.num_departures = np.zeros(nE, np.int_)
+        self.num_system = np.zeros(nE, np.int_)
+        self.num_total = np.zeros(nE, np.int_)
+        self.num_arrivals = np.zeros(nE, np.int_)
+        self.o_arrivals = np.zeros(nE, np.int_)
+        self.num_blocked = np.zeros(nE, np.int_)
+        self.num_agents = np.array(net._num_agents, np.int_)
+        self.total_agents = np.sum(self.num_agents)
+
+        self.arrival_f = []
+        self.service_f = []
+        self.uniforms = net._uniforms
+
+        self.st_on = np.zeros(nE, np.intc)
+        self.st_start = np.zeros(nE)
+        self.st_last = np.zeros(nE)
+        self.st_system = np.zeros(nE)
+        self.st_queued = np.zeros(nE)
+        self.st_busy = np.zeros(nE)
+        self.w_num = np.zeros(nE, np.int_)
+        self.w_mean = np.zeros(nE)
+        self.w_m2 = np.zeros(nE)
+        self.s_num = np.zeros(nE, np.int_)
+        self.s_mean = np.zeros(nE)
+        self.s_m2 = np.zeros(nE)
+        self.sk_on = np.zeros(nE, np.intc)
+        self.w_sketch = [None] * nE
+        self.s_sketch = [None] * nE
+        self.lg_on = np.zeros(nE, np.intc)
+        self.lg_compress = np.zeros(nE, np.intc)
+        self.lg_times = [None] * nE
+        self.lg_values = [None] * nE
+
+        # The network's SojournStats arrays are updated in place.
+        so = net._sojourns
+        self.so_on = net.collect_sojourns
+        self.so_start = so.t_start
+        self.so_num = so.num
+        self.so_mean = so.mean
+        self.so_m2 = so.m2
+        self.so_hops = so.hops
+        self.so_blocked = so.blocked
+
+        self.a_time = np.zeros(1024)
+        self.a_arrival = np.zeros(1024)
+        self.a_edge = np.zeros(1024, np.intc)
+        self.a_next = np.zeros(1024, np.intc)
+        self.a_num = np.zeros(1024, np.int_)
+        self.a_blocked = np.zeros(1024, np.int_)
+        self.a_entered = np.zeros(1024)
+        self.a_hops = np.zeros(1024, np.int_)
+        self.objs = []
+        self.num_slots = 0
+        self.free_slot = -1
+
+        for e, q in enumerate(net.edge2queue):
+            cls = type(q)
+            if cls is NullQueue:
+                self.kind[e] = NULL_QUEUE
+            elif cls is LossQueue:
+                self.kind[e] = LOSS_QUEUE
+            else:
+                self.kind[e] = SERVER_QUEUE
+            self.target[e] = q.edge[1]
+            self.num_servers[e] = q.num_servers
+            self.buffer[e] = q.buffer if cls is LossQueue else INFINITY
+            self.active_cap[e] = q.active_cap
+            self.deactive_t[e] = q.deactive_t
+            self.next_ct[e] = q._next_ct
+            self.current_t[e] = q._current_t
+            self.qtime[e] = q._time
+            self.active[e] = q._active
+            self.num_departures[e] = q.num_departures
+            self.num_system[e] = q.num_system
+            self.num_total[e] = q._num_total
+            self.num_arrivals[e] = q._num_arrivals
+            self.o_arrivals[e] = q._oArrivals
+            self.num_blocked[e] = getattr(q, 'num_blocked', 0)
+            self.arrival_f.append(q.arrival_f)
+            self.service_f.append(q.service_f)
+
+            if q.collect_stats:
+                st = q._stats
+                self.st_on[e] = True
+                self.st_start[e] = st.t_start
+                self.st_last[e] = st.t_last
+                self.st_system[e] = st.area_system
+                self.st_queued[e] = st.area_queued
+                self.st_busy[e] = st.area_busy
+                self.w_num[e] = st.num_waits
+                self.w_mean[e] = st.mean_wait
+                self.w_m2[e] = st.m2_wait
+                self.s_num[e] = st.num_sojourns
+                self.s_mean[e] = st.mean_sojourn
+                self.s_m2[e] = st.m2_sojourn
+                if st.wait_sketch is not None:
+                    # The sketches are updated in place.
+                    self.sk_on[e] = True
+                    self.w_sketch[e] = st.wait_sketch
+                    self.s_sketch[e] = st.sojourn_sketch
+
+            if q.collect_states:
+                # The state log is also appended to in place.
+                self.lg_on[e] = True
+                self.lg_compress[e] = q._states.compress
+                self.lg_times[e] = q._states.times
+                self.lg_values[e] = q._states.values
+
+            self._load_heap(&self.arrivals[e], q._arrivals)
+            self._load_heap(&self.departures[e], q._departures)
+
+            for agent in q.queue:
+                self._fifo_append(e, self._load_slot(agent))
+
+        nV = len(net.out_edges)
+        self.out_ptr = np.zeros(nV + 1, np.intc)
+        for k in range(nV):
+            self.out_ptr[k + 1] = self.out_ptr[k] + len(net.out_edges[k])
+
+        self.out_idx = np.zeros(max(self.out_ptr[nV], 1), np.intc)
+        self.alias_prob = np.zeros(max(self.out_ptr[nV], 1))
+        self.alias_idx = np.zeros(max(self.out_ptr[nV], 1), np.intc)
+        for k in range(nV):
+            prob, alias = net._route_alias[k]
+            for j in range(self.out_ptr[k + 1] - self.out_ptr[k]):
+                self.out_idx[self.out_ptr[k] + j] = net.out_edges[k][j]
+                self.alias_prob[self.out_ptr[k] + j] = prob[j]
+                self.alias_idx[self.out_ptr[k] + j] = alias[j]
+
+    def __dealloc__(self):
+        cdef Py_ssize_t e
+        for e in range(self.nE):
+            if self.arrivals != NULL:
+                free(self.arrivals[e].times)
+                free(self.arrivals[e].seqs)
+                free(self.arrivals[e].slots)
+            if self.departures != NULL:
+                free(self.departures[e].times)
+                free(self.departures[e].seqs)
+                free(self.departures[e].slots)
+        free(self.arrivals)
+        free(self.departures)
+
+    cdef int _load_heap(self, Heap *h, AgentHeap agents) except -1:
+        cdef Py_ssize_t k
+        for k in range(len(agents.agents)):
+            _heap_append(h, agents.times[k], agents.seqs[k], self._load_slot(agents.agents[k]))
+        h.counter = agents.counter
+        return 0
+
+    cdef AgentHeap _store_heap(self, Heap *h):
+        cdef AgentHeap agents = AgentHeap()
+        cdef Py_ssize_t k
+        for k in range(h.size):
+            agents._append(h.times[k], h.seqs[k], self._agent(h.slots[k]))
+        agents.counter = h.counter
+        return agents
+
+    cdef int _load_slot(self, object agent) except -1:
+        cdef int s = self._new_slot()
+        self.objs[s] = agent
+        self.a_time[s] = agent._time
+        self.a_arrival[s] = agent._arrival
+        self.a_blocked[s] = agent.blocked
+        self.a_entered[s] = agent._entered
+        self.a_hops[s] = agent._hops
+        self.a_edge[s] = agent.agent_id[0]
+        return s
+
+    cdef int _new_slot(self) except -1:
+        cdef int s
+        if self.free_slot >= 0:
+            s = self.free_slot
+            self.free_slot = self.a_next[s]
+            return s
+
+        if self.num_slots == self.a_time.shape[0]:
+            self._grow()
+
+        s = self.num_slots
+        self.num_slots += 1
+        self.objs.append(None)
+        return s
+
+    cdef int _grow(self) except -1:
+        cdef Py_ssize_t n = 2 * self.a_time.shape[0]
+        self.a_time = np.resize(np.asarray(self.a_time), n)
+        self.a_arrival = np.resize(np.asarray(self.a_arrival), n)
+        self.a_edge = np.resize(np.asarray(self.a_edge), n)
+        self.a_next = np.resize(np.asarray(self.a_next), n)
+        self.a_num = np.resize(np.asarray(self.a_num), n)
+        self.a_blocked = np.resize(np.asarray(self.a_blocked), n)
+        self.a_entered = np.resize(np.asarray(self.a_entered), n)
+        self.a_hops = np.resize(np.asarray(self.a_hops), n)
+        return 0
+
+    cdef int _release(self, int s) except -1:
+        # The agent left the network; objects that existed before the
+        # loop started get their final state written back.
+        cdef object agent = self.objs[s]
+        if agent is not None:
+            agent._time = self.a_time[s]
+            agent._arrival = self.a_arrival[s]
+            agent.blocked = self.a_blocked[s]
+            agent._entered = self.a_entered[s]
+            agent._hops = self.a_hops[s]
+            self.objs[s] = None
+
+        self.a_next[s] = self.free_slot
+        self.free_slot = s
+        return 0
+
+    cdef inline void _fifo_append(self, Py_ssize_t e, int s):
+        self.a_next[s] = -1
+        if self.fifo_len[e] == 0:
+            self.fifo_head[e] = s
+        else:
+            self.a_next[self.fifo_tail[e]] = s
+        self.fifo_tail[e] = s
+        self.fifo_len[e] += 1
+
+    cdef inline int _fifo_popleft(self, Py_ssize_t e):
+        cdef int s = self.fifo_head[e]
+        self.fifo_head[e] = self.a_next[s]
+        self.fifo_len[e] -= 1
+        if self.fifo_len[e] == 0:
+            self.fifo_tail[e] = -1
+        return s
+
+    cdef inline void _update_time(self, Py_ssize_t e):
+        cdef double a = _heap_top(&self.arrivals[e])
+        cdef double d = _heap_top(&self.departures[e])
+        self.qtime[e] = a if a < d else d
+
+    cdef inline void _advance(self, Py_ssize_t e, double t):
+        # QueueStats.advance
+        cdef double dt = t - self.st_last[e]
+        self.st_system[e] += self.num_system[e] * dt
+        self.st_queued[e] += self.fifo_len[e] * dt
+        self.st_busy[e] += (self.num_system[e] - self.fifo_len[e]) * dt
+        self.st_last[e] = t
+
+    cdef inline int _add_wait(self, Py_ssize_t e, double x) except -1:
+        # QueueStats.add_wait
+        cdef double delta = x - self.w_mean[e]
+        self.w_num[e] += 1
+        self.w_mean[e] += delta / self.w_num[e]
+        self.w_m2[e] += delta * (x - self.w_mean[e])
+        if self.sk_on[e]:
+            (<QuantileSketch> self.w_sketch[e])._add(x)
+        return 0
+
+    cdef inline int _add_sojourn(self, Py_ssize_t e, double x) except -1:
+        # QueueStats.add_sojourn
+        cdef double delta = x - self.s_mean[e]
+        self.s_num[e] += 1
+        self.s_mean[e] += delta / self.s_num[e]
+        self.s_m2[e] += delta * (x - self.s_mean[e])
+        if self.sk_on[e]:
+            (<QuantileSketch> self.s_sketch[e])._add(x)
+        return 0
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int _log(self, Py_ssize_t e, double t) except -1:
+        # StateLog.append
+        cdef array.array times = self.lg_times[e]
+        cdef array.array values = self.lg_values[e]
+        cdef Py_ssize_t n = len(times)
+        cdef long value = self.num_system[e]
+
+        if self.lg_compress[e]:
+            if values.data.as_longs[n - 1] == value:
+                return 0
+            elif times.data.as_doubles[n - 1] == t:
+                values.data.as_longs[n - 1] = value
+                return 0
+
+        array.resize_smart(times, n + 1)
+        array.resize_smart(values, n + 1)
+        times.data.as_doubles[n] = t
+        values.data.as_longs[n] = value
+        return 0
+
+    cdef inline void _add_network_sojourn(self, int s, double t):
+        # SojournStats.add
+        cdef Py_ssize_t e = self.a_edge[s]
+        cdef double x = t - self.a_entered[s]
+        cdef double delta = x - self.so_mean[e]
+        self.so_num[e] += 1
+        self.so_mean[e] += delta / self.so_num[e]
+        self.so_m2[e] += delta * (x - self.so_mean[e])
+        self.so_hops[e] += self.a_hops[s]
+        self.so_blocked[e] += self.a_blocked[s]
+
+    cdef inline void _set_num_agents(self, Py_ssize_t e, long value):
+        self.total_agents += value - self.num_agents[e]
+        self.num_agents[e] = value
+
+    cdef int _add_external_arrival(self, Py_ssize_t e) except -1:
+        # QueueServer._add_arrival() without an agent
+        cdef double t
+        cdef int s
+
+        if self.current_t[e] >= self.next_ct[e]:
+            t = _call(self.arrival_f[e], self.current_t[e])
+            self.next_ct[e] = t
+
+            if t >= self.deactive_t[e]:
+                self.active[e] = False
+                return 0
+
+            self.num_total[e] += 1
+            s = self._new_slot()
+            self.a_time[s] = t
+            self.a_edge[s] = e
+            self.a_num[s] = self.o_arrivals[e]
+            self.a_blocked[s] = 0
+            self.a_entered[s] = t
+            self.a_hops[s] = 0
+            _heap_push(&self.arrivals[e], t, s)
+
+            self.o_arrivals[e] += 1
+            if self.o_arrivals[e] >= self.active_cap[e]:
+                self.active[e] = False
+
+        if _heap_top(&self.arrivals[e]) < _heap_top(&self.departures[e]):
+            self.qtime[e] = _heap_top(&self.arrivals[e])
+        return 0
+
+    cdef int _receive(self, Py_ssize_t e, int s) except -1:
+        # QueueServer._receive, LossQueue._receive and NullQueue._receive
+        if self.kind[e] == NULL_QUEUE:
+            self._release(s)
+            return 0
+
+        if not self._is_full(e):
+            self.num_total[e] += 1
+        return self._arrive(e, s)
+
+    cdef inline bint _is_full(self, Py_ssize_t e):
+        return self.kind[e] == LOSS_QUEUE and \
+            not self.num_system[e] < self.num_servers[e] + self.buffer[e]
+
+    cdef int _arrive(self, Py_ssize_t e, int s) except -1:
+        # QueueServer._serve_arrival and LossQueue._block_arrival
+        cdef double t
+
+        self.current_t[e] = self.a_time[s]
+
+        if self._is_full(e):
+            self.num_blocked[e] += 1
+            self.a_blocked[s] += 1
+
+            if self.active[e]:
+                self._add_external_arrival(e)
+
+            self._update_time(e)
+            self._release(s)
+            return 0
+
+        if self.active[e]:
+            self._add_external_arrival(e)
+
+        if self.st_on[e]:
+            self._advance(e, self.a_time[s])
+
+        self.num_system[e] += 1
+        self.num_arrivals[e] += 1
+        self.a_arrival[s] = self.a_time[s]
+
+        if self.lg_on[e]:
+            self._log(e, self.a_time[s])
+
+        if self.num_system[e] <= self.num_servers[e]:
+            if self.st_on[e]:
+                self._add_wait(e, 0.0)
+            t = _call(self.service_f[e], self.a_time[s])
+            self.a_time[s] = t
+            _heap_push(&self.departures[e], t, s)
+        else:
+            self._fifo_append(e, s)
+
+        self._update_time(e)
+        return 0
+
+    cdef int _delay_service(self, Py_ssize_t e, double t, bint use_t) except -1:
+        cdef Heap *h = &self.departures[e]
+        cdef double t0
+        cdef int s
+
+        if h.size > 0:
+            s = _heap_pop(h, &t0)
+            if not use_t:
+                t = _call(self.service_f[e], t0)
+            self.a_time[s] = t
+            _heap_push(h, t, s)
+            self._update_time(e)
+        return 0
+
+    cdef int _next_event(self, Py_ssize_t e) except -2:
+        # QueueServer.next_event, LossQueue.next_event and
+        # NullQueue.next_event. Returns the slot of the departing agent
+        # or -1 if the event was not a departure.
+        cdef Heap *arr = &self.arrivals[e]
+        cdef Heap *dep = &self.departures[e]
+        cdef double t
+        cdef int s, s2
+
+        if self.kind[e] == NULL_QUEUE:
+            return -1
+
+        if _heap_top(dep) < _heap_top(arr):
+            s = _heap_pop(dep, &t)
+            self.current_t[e] = t
+
+            if self.st_on[e]:
+                self._advance(e, t)
+                if self.a_arrival[s] >= self.st_start[e]:
+                    self._add_sojourn(e, t - self.a_arrival[s])
+
+            self.num_total[e] -= 1
+            self.num_system[e] -= 1
+            self.num_departures[e] += 1
+
+            if self.lg_on[e]:
+                self._log(e, t)
+
+            if self.fifo_len[e] > 0:
+                s2 = self._fifo_popleft(e)
+                if self.st_on[e] and self.a_arrival[s2] >= self.st_start[e]:
+                    self._add_wait(e, self.current_t[e] - self.a_arrival[s2])
+                t = _call(self.service_f[e], self.current_t[e])
+                self.a_time[s2] = t
+                _heap_push(dep, t, s2)
+
+            self._update_time(e)
+            return s
+
+        elif _heap_top(arr) < INFINITY:
+            if self._is_full(e):
+                self.num_total[e] -= 1
+
+            s = _heap_pop(arr, &t)
+            self._arrive(e, s)
+
+        return -1
+
+    cdef int _route(self, Py_ssize_t e) except -1:
+        # Agent.desired_destination
+        cdef int v = self.target[e]
+        cdef int start = self.out_ptr[v]
+        cdef int n = self.out_ptr[v + 1] - start
+
+        if n <= 1:
+            if n == 0:
+                raise IndexError("list index out of range")
+            return self.out_idx[start]
+
+        return self.out_idx[start + _alias_choice(self.alias_prob, self.alias_idx,
+                                                  start, self.uniforms._draw(), n)]
+
+    cdef int _record(self, double t, int e, int event, int target) except -1:
+        # TraceRecorder.append()
+        cdef TraceRecord *rec
+        if self.tr_pos == self.tr_records.shape[0]:
+            self.trace.pos = self.tr_pos
+            self.trace.flush()
+            self.tr_pos = self.trace.pos
+
+        rec = &self.tr_records[self.tr_pos]
+        rec.time = t
+        rec.edge = e
+        rec.event = event
+        rec.target = target
+        self.tr_pos += 1
+        return 0
+
+    cdef int _step(self) except -1:
+        # QueueNetwork._simulate_next_event(slow=False); returns 0 once
+        # there are no more events.
+        cdef double q1t, q2t, t, u
+        cdef int e1, e2, s
+
+        if not self.heap._pop():
+            self.now = INFINITY
+            return 0
+
+        q1t = self.heap.next_time
+        e1 = self.heap.next_node
+
+        self.now = q1t
+        self.last_time = q1t
+        self.last_edge = e1
+        self.stepped = True
+        self.num_events += 1
+
+        if _heap_top(&self.departures[e1]) < _heap_top(&self.arrivals[e1]):
+            e2 = self._route(e1)
+            q2t = self.qtime[e2]
+
+            if self.kind[e2] == LOSS_QUEUE and e2 != e1 and \
+                    self.num_system[e2] >= self.num_servers[e2] + self.buffer[e2]:
+                if self.trace is not None:
+                    self._record(q1t, e1, TRACE_BLOCKED, e2)
+                self.num_blocked[e2] += 1
+                self.a_blocked[self.departures[e1].slots[0]] += 1
+                if self.blocking:
+                    u = self.uniforms._draw()
+                    t = _heap_top(&self.departures[e2]) + EPS * (0.33 + 0.33 * u)
+                    self._delay_service(e1, t, True)
+                else:
+                    self._delay_service(e1, 0, False)
+            else:
+                if self.trace is not None:
+                    self._record(q1t, e1, TRACE_DEPARTURE, e2)
+                s = self._next_event(e1)
+                self.a_time[s] = q1t
+                self.a_hops[s] += 1
+
+                if self.so_on and self.kind[e2] == NULL_QUEUE and \
+                        self.a_entered[s] >= self.so_start:
+                    self._add_network_sojourn(s, q1t)
+
+                if self.active[e2] and self.max_agents < INFINITY and \
+                        self.total_agents > self.max_agents - 1:
+                    self.active[e2] = False
+
+                self._receive(e2, s)
+                self._set_num_agents(e1, self.num_total[e1])
+                self._set_num_agents(e2, self.num_total[e2])
+
+            if e2 != e1 and self.qtime[e2] != q2t:
+                self.heap._update(e2, self.qtime[e2])
+
+            self.heap._update(e1, self.qtime[e1])
+
+        elif _heap_top(&self.arrivals[e1]) < INFINITY:
+            if self.trace is not None:
+                self._record(q1t, e1, TRACE_ARRIVAL, -1)
+            if self.active[e1] and self.max_agents < INFINITY and \
+                    self.total_agents > self.max_agents - 1:
+                self.active[e1] = False
+
+            self._next_event(e1)
+            self._set_num_agents(e1, self.num_total[e1])
+
+            self.heap._update(e1, self.qtime[e1])
+
+        elif self.trace is not None:
+            self._record(q1t, e1, TRACE_NOTHING, -1)
+
+        return 1
+
+    cdef int run(self, long n, double until, bint use_time) except -1:
+        cdef long k
+        if use_time:
+            while self.now < until:
+                if not self._step():
+                    break
+        else:
+            for k in range(n):
+                if not self._step():
+                    break
+        return 0
+
+    cdef object _agent(self, int s):
+        cdef object agent = self.objs[s]
+        if agent is None:
+            agent = Agent((self.a_edge[s], self.a_num[s]))
+            self.objs[s] = agent
+
+        agent._time = self.a_time[s]
+        agent._arrival = self.a_arrival[s]
+        agent.blocked = self.a_blocked[s]
+        agent._entered = self.a_entered[s]
+        agent._hops = self.a_hops[s]
+        return agent
+
+    cdef int store(self, net) except -1:
+        # Writes the state of the loop back onto the network.
+        cdef Py_ssize_t e, k
+        cdef int s
+
+        for e, q in enumerate(net.edge2queue):
+            q._arrivals = self._store_heap(&self.arrivals[e])
+            q._departures = self._store_heap(&self.departures[e])
+
+            queue = collections.deque()
+            s = self.fifo_head[e]
+            for k in range(self.fifo_len[e]):
+                queue.append(self._agent(s))
+                s = self.a_next[s]
+            q.queue = queue
+
+            q._active = bool(self.active[e])
+            q._current_t = self.current_t[e]
+            q._time = self.qtime[e]
+            q._next_ct = self.next_ct[e]
+            q.num_departures = self.num_departures[e]
+            q.num_system = self.num_system[e]
+            q._num_total = self.num_total[e]
+            q._num_arrivals = self.num_arrivals[e]
+            q._oArrivals = self.o_arrivals[e]
+            if self.kind[e] == LOSS_QUEUE:
+                q.num_blocked = self.num_blocked[e]
+
+            if self.st_on[e]:
+                st = q._stats
+                st.t_last = self.st_last[e]
+                st.area_system = self.st_system[e]
+                st.area_queued = self.st_queued[e]
+                st.area_busy = self.st_busy[e]
+                st.num_waits = self.w_num[e]
+                st.mean_wait = self.w_mean[e]
+                st.m2_wait = self.w_m2[e]
+                st.num_sojourns = self.s_num[e]
+                st.mean_sojourn = self.s_mean[e]
+                st.m2_sojourn = self.s_m2[e]
+
+        if self.trace is not None:
+            self.trace.pos = self.tr_pos
+
+        net._num_agents = np.asarray(self.num_agents).tolist()
+        net._reset_counts()
+        net.num_events = self.num_events
+        net._t = self.now
+        if self.stepped:
+            net._qkey = (self.last_time, self.last_edge)
+        return 0
+
@@ -0,0 +1,48 @@
+from cpython cimport array
+
+
+cdef class Scheduler:
+
+    cdef int actual_size
+    cdef public int size, next_node
+    cdef public double next_time
+    cdef public long num_inserts, num_updates, num_removals
+
+    cdef bint _pop(self) except -1
+    cdef bint _peek(self) except -1
+    cdef int _update(self, int k, double t) except -1
+    cdef int _remove(self, int k) except -1
+
+
+cdef class PriorityQueue(Scheduler):
+
+    cdef public array.array array_times, array_edges
+    cdef array.array array_pos, array_q_times
+    cdef double [::1] sorted_times
+    cdef double [::1] q_times
+    cdef int [::1] sorted_edges
+    cdef int [::1] pos
+
+    cdef void _delete(self, int i) nogil
+    cdef void _grow(self, int n)
+
+
+cdef class CalendarQueue(Scheduler):
+
+    cdef array.array array_q_times, array_next, array_prev, array_bucket
+    cdef array.array array_heads
+    cdef double [::1] q_times
+    cdef int [::1] next_edge
+    cdef int [::1] prev_edge
+    cdef int [::1] bucket
+    cdef int [::1] heads
+    cdef public int nbuckets
+    cdef public double width
+    cdef int current
+    cdef double current_day
+
+    cdef int _find(self) except -2
+    cdef void _insert(self, int k, double t) nogil
+    cdef void _unlink(self, int k) nogil
+    cdef int _resize(self, int nbuckets) except -1
+    cdef void _grow(self, int n)
@@ -1,18 +1,120 @@
 cimport cython
 from cpython cimport array
 import array
+import heapq
 
+from libc.math cimport INFINITY, floor, fmod
 
-cdef class PriorityQueue:
-    """A specialized version of a priority queue for a QueueNetwork"""
 
-    cdef public array.array array_times, array_edges
-    cdef double [::1] sorted_times
-    cdef double [::1] q_times
-    cdef int [::1] sorted_edges
-    cdef int actual_size
-    cdef public int size, next_node
-    cdef public double next_time
+cdef class Scheduler:
+    """Base class for the event schedulers used by a QueueNetwork.
+
+    A scheduler holds at most one ``(time, edge_index)`` key per edge
+    and returns them in order of time, with ties broken by edge index.
+    Subclasses implement the ``cdef`` methods ``_pop``, ``_peek``,
+    ``_update`` and ``_remove``; the methods below wrap them.
+    """
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, int k):
+        raise NotImplementedError
+
+    @property
+    def stats(self):
+        """Returns a dict with counts of the operations done on the
+        queue.
+
+        ``'stale_avoided'`` is the number of in place updates and
+        removals, each of which would have left a stale entry in a
+        heap that uses lazy deletion.
+        """
+        return {
+            'size': self.size,
+            'capacity': self.actual_size,
+            'inserts': self.num_inserts,
+            'updates': self.num_updates,
+            'removals': self.num_removals,
+            'stale_avoided': self.num_updates + self.num_removals,
+        }
+
+    def keys(self):
+        """Returns a list of every ``(time, edge_index)`` key in the
+        scheduler, in no particular order.
+        """
+        raise NotImplementedError
+
+    def pop(self):
+        """Removes and returns the next ``(time, edge_index)`` key, or
+        ``None`` if the scheduler is empty.
+        """
+        if self._pop():
+            return self.next_time, self.next_node
+        return None
+
+    def peek(self):
+        """Returns the next ``(time, edge_index)`` key without removing
+        it, or ``None`` if the scheduler is empty.
+        """
+        if self._peek():
+            return self.next_time, self.next_node
+        return None
+
+    def peek_k(self, int k):
+        """Returns a sorted list of the next ``k`` keys without
+        removing them.
+
+        Subclasses override this with a method that only looks at the
+        front of the queue; this one sorts every key.
+        """
+        return heapq.nsmallest(k, self.keys())
+
+    def push(self, double t, int k):
+        """Same as :meth:`.update`, kept for the ``(time, edge)``
+        argument order used by keys.
+        """
+        self._update(k, t)
+
+    def update(self, int k, double t):
+        """Sets the time of edge ``k`` to ``t``, inserting the edge if
+        it is not in the queue and removing it if ``t`` is infinite.
+        """
+        self._update(k, t)
+
+    def remove(self, int k):
+        """Removes edge ``k`` from the queue if it is there."""
+        self._remove(k)
+
+    cdef bint _pop(self) except -1:
+        raise NotImplementedError
+
+    cdef bint _peek(self) except -1:
+        raise NotImplementedError
+
+    cdef int _update(self, int k, double t) except -1:
+        raise NotImplementedError
+
+    cdef int _remove(self, int k) except -1:
+        raise NotImplementedError
+
+
+cdef class PriorityQueue(Scheduler):
+    """A specialized version of a priority queue for a QueueNetwork.
+
+    The queue is a binary heap that keeps track of where each edge
+    sits in it. This lets the time of an edge be changed or removed in
+    place, so the heap never holds stale entries and its size is
+    bounded by the number of edges.
+
+    Parameters
+    ----------
+    keys : list (optional)
+        A list of ``(time, edge_index)`` pairs.
+    n : int (optional, default: ``0``)
+        The number of edges. The queue grows automatically if an edge
+        index larger than this is pushed.
+    """
 
     def __cinit__(self, object keys=None, int n=0):
         pass
@@ -23,21 +125,29 @@ cdef class PriorityQueue:
         if keys is None:
             keys = []
 
-        self.array_times = array.array('d', [key[0] for key in keys])
-        self.array_edges = array.array('i', [key[1] for key in keys])
+        n = max([n, 1] + [key[1] + 1 for key in keys])
+
+        self.array_times = array.array('d', [INFINITY for k in range(n)])
+        self.array_edges = array.array('i', [-1 for k in range(n)])
+        self.array_pos = array.array('i', [-1 for k in range(n)])
+        self.array_q_times = array.array('d', [INFINITY for k in range(n)])
 
         self.sorted_times = self.array_times
         self.sorted_edges = self.array_edges
+        self.pos = self.array_pos
+        self.q_times = self.array_q_times
 
-        self.size = len(keys)
-        self.actual_size = self.size
+        self.size = 0
+        self.actual_size = n
 
-        heapify(self.sorted_times, self.sorted_edges, self.size)
+        for key in keys:
+            self._update(key[1], key[0])
 
-        self.q_times = array.array('d', [float('inf') for k in range(n)])
+    def __contains__(self, int k):
+        return 0 <= k < self.actual_size and self.pos[k] >= 0
 
-        for key in keys:
-            self.q_times[key[1]] = key[0]
+    def keys(self):
+        return list(zip(self.times, self.edges))
 
     @property
     def times(self):
@@ -50,6 +160,30 @@ cdef class PriorityQueue:
     def q_map(self):
         return array.array('d', self.q_times)
 
+    def peek_k(self, int k):
+        """Returns a sorted list of the next ``k`` keys without
+        removing them.
+
+        The heap is walked from the root, keeping the children of the
+        keys taken so far in a small heap of candidates, so this takes
+        ``O(k log k)`` time.
+        """
+        cdef list keys = []
+        cdef list candidates
+        cdef double t
+        cdef int e, i, c
+
+        if k <= 0 or self.size == 0:
+            return keys
+
+        candidates = [(self.sorted_times[0], self.sorted_edges[0], 0)]
+        while candidates and len(keys) < k:
+            t, e, i = heapq.heappop(candidates)
+            keys.append((t, e))
+            for c in range(2 * i + 1, min(2 * i + 3, self.size)):
+                heapq.heappush(candidates, (self.sorted_times[c], self.sorted_edges[c], c))
+        return keys
+
     @property
     def arraysize(self):
         return self.actual_size
@@ -57,136 +191,517 @@ cdef class PriorityQueue:
     @cython.boundscheck(False)
     @cython.wraparound(False)
     @cython.nonecheck(False)
-    def pop(self):
-        cdef double t
-        cdef int k
+    cdef bint _pop(self) except -1:
+        if self.size == 0:
+            return False
 
-        self.heappop()
-        with nogil:
-            while self.next_time != self.q_times[self.next_node]:
-                if self.size == 0:
-                    self.size -= 1
-                    break
-                self.heappop()
+        self.next_time = self.sorted_times[0]
+        self.next_node = self.sorted_edges[0]
+        self._delete(0)
+        return True
 
-        if self.size < 0:
-            self.size += 1
-            return None
-        return self.next_time, self.next_node
+    cdef bint _peek(self) except -1:
+        if self.size == 0:
+            return False
+
+        self.next_time = self.sorted_times[0]
+        self.next_node = self.sorted_edges[0]
+        return True
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
     @cython.nonecheck(False)
-    def push(self, double t, int k):
+    cdef int _update(self, int k, double t) except -1:
+        cdef double old_time
+        cdef int i
+
+        if t == INFINITY:
+            return self._remove(k)
+
+        if k >= self.actual_size:
+            self._grow(k + 1)
 
+        i = self.pos[k]
         self.q_times[k] = t
-        if self.size < self.actual_size:
-            self.sorted_times[self.size] = t
-            self.sorted_edges[self.size] = k
 
+        if i < 0:
+            i = self.size
+            self.sorted_times[i] = t
+            self.sorted_edges[i] = k
+            self.pos[k] = i
+            self.size += 1
+            self.num_inserts += 1
+            _siftdown(self.sorted_times, self.sorted_edges, self.pos, 0, i)
+            return 0
+
+        old_time = self.sorted_times[i]
+        if old_time == t:
+            return 0
+
+        self.sorted_times[i] = t
+        self.num_updates += 1
+        if t < old_time:
+            _siftdown(self.sorted_times, self.sorted_edges, self.pos, 0, i)
         else:
-            array.resize_smart(self.array_times, 2 * self.size)
-            array.resize_smart(self.array_edges, 2 * self.size)
-
-            self.actual_size *= 2
-            self.sorted_times = self.array_times
-            self.sorted_edges = self.array_edges
+            _siftup(self.sorted_times, self.sorted_edges, self.pos, i, self.size)
+        return 0
 
-            self.sorted_times[self.size] = t
-            self.sorted_edges[self.size] = k
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.nonecheck(False)
+    cdef int _remove(self, int k) except -1:
+        if k < 0 or k >= self.actual_size or self.pos[k] < 0:
+            return 0
 
-        self.size += 1
-        _siftdown(self.sorted_times, self.sorted_edges, 0, self.size-1)
+        self.num_removals += 1
+        self._delete(self.pos[k])
+        return 0
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
     @cython.nonecheck(False)
-    cdef void heappop(self) nogil:
-        cdef double last_time, return_time
-        cdef int last_node, return_node
+    cdef void _delete(self, int i) nogil:
+        cdef int k = self.sorted_edges[i]
 
         self.size -= 1
-        last_time = self.sorted_times[self.size]
-        last_node = self.sorted_edges[self.size]
+        self.pos[k] = -1
+        self.q_times[k] = INFINITY
+
+        if i == self.size:
+            return
+
+        self.sorted_times[i] = self.sorted_times[self.size]
+        self.sorted_edges[i] = self.sorted_edges[self.size]
+        self.pos[self.sorted_edges[i]] = i
+
+        if i > 0 and _less(self.sorted_times, self.sorted_edges, i, (i - 1) >> 1):
+            _siftdown(self.sorted_times, self.sorted_edges, self.pos, 0, i)
+        else:
+            _siftup(self.sorted_times, self.sorted_edges, self.pos, i, self.size)
+
+    cdef void _grow(self, int n):
+        cdef int k, old_size = self.actual_size
+
+        n = max(n, 2 * old_size)
+        array.resize_smart(self.array_times, n)
+        array.resize_smart(self.array_edges, n)
+        array.resize_smart(self.array_pos, n)
+        array.resize_smart(self.array_q_times, n)
+
+        self.sorted_times = self.array_times
+        self.sorted_edges = self.array_edges
+        self.pos = self.array_pos
+        self.q_times = self.array_q_times
+
+        for k in range(old_size, n):
+            self.sorted_times[k] = INFINITY
+            self.sorted_edges[k] = -1
+            self.pos[k] = -1
+            self.q_times[k] = INFINITY
+
+        self.actual_size = n
+
+
+cdef class CalendarQueue(Scheduler):
+    """A calendar queue for a QueueNetwork.
+
+    Keys are hashed by time into ``nbuckets`` buckets that each cover
+    ``width`` units of time, and each bucket is a sorted linked list
+    of edges. The queue is resized, and ``width`` re-estimated from
+    the spacing of the next few keys, whenever the number of keys
+    gets far from the number of buckets. This makes pushes and pops
+    take amortized constant time when event times are dense, which
+    suits networks with many active edges.
+
+    Parameters
+    ----------
+    keys : list (optional)
+        A list of ``(time, edge_index)`` pairs.
+    n : int (optional, default: ``0``)
+        The number of edges. The queue grows automatically if an edge
+        index larger than this is pushed.
+
+    Notes
+    -----
+    See R. Brown, *Calendar queues: a fast O(1) priority queue
+    implementation for the simulation event set problem*,
+    Communications of the ACM 31(10), 1988.
+    """
+
+    def __cinit__(self, object keys=None, int n=0):
+        pass
+
+    def __init__(self, object keys=None, int n=0):
+        cdef tuple key
+
+        if keys is None:
+            keys = []
+
+        n = max([n, 1] + [key[1] + 1 for key in keys])
+
+        self.array_q_times = array.array('d', [INFINITY for k in range(n)])
+        self.array_next = array.array('i', [-1 for k in range(n)])
+        self.array_prev = array.array('i', [-1 for k in range(n)])
+        self.array_bucket = array.array('i', [-1 for k in range(n)])
+        self.array_heads = array.array('i', [-1, -1])
+
+        self.q_times = self.array_q_times
+        self.next_edge = self.array_next
+        self.prev_edge = self.array_prev
+        self.bucket = self.array_bucket
+        self.heads = self.array_heads
+
+        self.size = 0
+        self.actual_size = n
+        self.nbuckets = 2
+        self.width = 1.0
+
+        for key in keys:
+            self._update(key[1], key[0])
+
+    def __contains__(self, int k):
+        return 0 <= k < self.actual_size and self.bucket[k] >= 0
+
+    def keys(self):
+        return [(self.q_times[k], k) for k in range(self.actual_size) if self.bucket[k] >= 0]
+
+    @cython.cdivision(True)
+    def peek_k(self, int k):
+        """Returns a sorted list of the next ``k`` keys without
+        removing them.
+
+        The buckets are scanned day by day from the current one, the
+        same way :meth:`.pop` finds the next key, so this takes time
+        proportional to ``k`` when the keys are dense.
+        """
+        cdef list keys = []
+        cdef dict cursor = {}
+        cdef double day, first
+        cdef int i, j, b, empty = 0
+
+        if k <= 0 or self.size == 0:
+            return keys
+
+        k = min(k, self.size)
+        i = self.current
+        day = self.current_day
+
+        # Each bucket holds its keys sorted, so ``cursor`` remembers
+        # where the keys that haven't been taken yet start in it.
+        while len(keys) < k:
+            j = cursor.get(i, self.heads[i])
+            if j >= 0 and floor(self.q_times[j] / self.width) <= day:
+                empty = 0
+                while j >= 0 and len(keys) < k and floor(self.q_times[j] / self.width) <= day:
+                    keys.append((self.q_times[j], j))
+                    j = self.next_edge[j]
+                cursor[i] = j
+            else:
+                empty += 1
+
+            if empty < self.nbuckets:
+                i += 1
+                day += 1
+                if i == self.nbuckets:
+                    i = 0
+                continue
+
+            # Nothing in the last year, so jump to the earliest day
+            # that still has a key.
+            first = INFINITY
+            for b in range(self.nbuckets):
+                j = cursor.get(b, self.heads[b])
+                if j >= 0 and floor(self.q_times[j] / self.width) < first:
+                    first = floor(self.q_times[j] / self.width)
+                    i = b
+            day = first
+            empty = 0
+
+        return keys
+
+    cdef bint _pop(self) except -1:
+        cdef int k = self._find()
+        if k < 0:
+            return False
+
+        self.next_time = self.q_times[k]
+        self.next_node = k
+        self._unlink(k)
+
+        if self.nbuckets > 2 and self.size < self.nbuckets // 2:
+            self._resize(self.nbuckets // 2)
+        return True
+
+    cdef bint _peek(self) except -1:
+        cdef int k = self._find()
+        if k < 0:
+            return False
+
+        self.next_time = self.q_times[k]
+        self.next_node = k
+        return True
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.nonecheck(False)
+    cdef int _update(self, int k, double t) except -1:
+        if t == INFINITY:
+            return self._remove(k)
+
+        if k >= self.actual_size:
+            self._grow(k + 1)
+
+        if self.bucket[k] >= 0:
+            if self.q_times[k] == t:
+                return 0
+            self._unlink(k)
+            self._insert(k, t)
+            self.num_updates += 1
+            return 0
+
+        self._insert(k, t)
+        self.num_inserts += 1
+
+        if self.size > 2 * self.nbuckets:
+            self._resize(2 * self.nbuckets)
+        return 0
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.nonecheck(False)
+    cdef int _remove(self, int k) except -1:
+        if k < 0 or k >= self.actual_size or self.bucket[k] < 0:
+            return 0
+
+        self._unlink(k)
+        self.num_removals += 1
+
+        if self.nbuckets > 2 and self.size < self.nbuckets // 2:
+            self._resize(self.nbuckets // 2)
+        return 0
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.nonecheck(False)
+    @cython.cdivision(True)
+    cdef int _find(self) except -2:
+        # Returns the edge with the smallest key, or -1 if the queue is
+        # empty. Every key is at or after ``current_day``, so the first
+        # bucket (starting at ``current``) whose head falls on the day
+        # being scanned holds the smallest key.
+        cdef double day
+        cdef int i, j, n, best
+
+        if self.size == 0:
+            return -1
+
+        i = self.current
+        day = self.current_day
+        for n in range(self.nbuckets):
+            j = self.heads[i]
+            if j >= 0 and floor(self.q_times[j] / self.width) <= day:
+                self.current = i
+                self.current_day = day
+                return j
+
+            i += 1
+            day += 1
+            if i == self.nbuckets:
+                i = 0
+
+        # Nothing in the next year, so look at the head of every bucket.
+        best = -1
+        for i in range(self.nbuckets):
+            j = self.heads[i]
+            if j >= 0 and (best < 0 or self.q_times[j] < self.q_times[best] or
+                           (self.q_times[j] == self.q_times[best] and j < best)):
+                best = j
+
+        self.current = self.bucket[best]
+        self.current_day = floor(self.q_times[best] / self.width)
+        return best
 
-        if self.size > 0:
-            return_time = self.sorted_times[0]
-            return_node = self.sorted_edges[0]
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.nonecheck(False)
+    @cython.cdivision(True)
+    cdef void _insert(self, int k, double t) nogil:
+        cdef double day = floor(t / self.width)
+        cdef double b = fmod(day, self.nbuckets)
+        cdef int i, j, p = -1
 
-            self.sorted_times[0] = last_time
-            self.sorted_edges[0] = last_node
+        if b < 0:
+            b += self.nbuckets
 
-            _siftup(self.sorted_times, self.sorted_edges, 0, self.size)
+        i = <int> b
+        j = self.heads[i]
+        while j >= 0 and (self.q_times[j] < t or (self.q_times[j] == t and j < k)):
+            p = j
+            j = self.next_edge[j]
 
-            self.next_time = return_time
-            self.next_node = return_node
+        self.q_times[k] = t
+        self.bucket[k] = i
+        self.prev_edge[k] = p
+        self.next_edge[k] = j
+
+        if p < 0:
+            self.heads[i] = k
         else:
-            self.next_time = last_time
-            self.next_node = last_node
+            self.next_edge[p] = k
+        if j >= 0:
+            self.prev_edge[j] = k
+
+        if self.size == 0 or day < self.current_day:
+            self.current = i
+            self.current_day = day
+        self.size += 1
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.nonecheck(False)
+    cdef void _unlink(self, int k) nogil:
+        cdef int p = self.prev_edge[k]
+        cdef int j = self.next_edge[k]
+
+        if p < 0:
+            self.heads[self.bucket[k]] = j
+        else:
+            self.next_edge[p] = j
+        if j >= 0:
+            self.prev_edge[j] = p
+
+        self.bucket[k] = -1
+        self.q_times[k] = INFINITY
+        self.size -= 1
+
+    cdef int _resize(self, int nbuckets) except -1:
+        # Brown's heuristic: the new width is three times the average
+        # gap between the next 25 keys, ignoring unusually large gaps.
+        cdef list sample = []
+        cdef list keys = []
+        cdef list gaps
+        cdef double avg, width
+        cdef int i, j, k
+
+        for i in range(min(25, self.size)):
+            k = self._find()
+            sample.append((self.q_times[k], k))
+            self._unlink(k)
+
+        for i in range(self.nbuckets):
+            j = self.heads[i]
+            while j >= 0:
+                keys.append((self.q_times[j], j))
+                j = self.next_edge[j]
+
+        if len(sample) > 1:
+            gaps = [sample[i + 1][0] - sample[i][0] for i in range(len(sample) - 1)]
+            avg = sum(gaps) / len(gaps)
+            gaps = [g for g in gaps if g <= 2 * avg]
+            width = 3 * sum(gaps) / len(gaps)
+            if 0 < width < INFINITY:
+                self.width = width
+
+        self.array_heads = array.array('i', [-1 for i in range(nbuckets)])
+        self.heads = self.array_heads
+        self.nbuckets = nbuckets
+        self.size = 0
+
+        for key in sample + keys:
+            self._insert(key[1], key[0])
+        return 0
+
+    cdef void _grow(self, int n):
+        cdef int k, old_size = self.actual_size
+
+        n = max(n, 2 * old_size)
+        array.resize_smart(self.array_q_times, n)
+        array.resize_smart(self.array_next, n)
+        array.resize_smart(self.array_prev, n)
+        array.resize_smart(self.array_bucket, n)
+
+        self.q_times = self.array_q_times
+        self.next_edge = self.array_next
+        self.prev_edge = self.array_prev
+        self.bucket = self.array_bucket
+
+        for k in range(old_size, n):
+            self.q_times[k] = INFINITY
+            self.next_edge[k] = -1
+            self.prev_edge[k] = -1
+            self.bucket[k] = -1
+
+        self.actual_size = n
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.nonecheck(False)
-cdef inline void _siftdown(double[:] heap, int[:] hmap, int startpos, int pos) nogil:
+cdef inline bint _less(double[::1] heap, int[::1] hmap, int a, int b) nogil:
+    if heap[a] < heap[b]:
+        return True
+    return heap[a] == heap[b] and hmap[a] < hmap[b]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+cdef inline void _siftdown(double[::1] heap, int[::1] hmap, int[::1] pos,
+                           int startpos, int i) nogil:
     cdef double newitem, parent
     cdef int parentpos, mapitem, father
 
-    newitem = heap[pos]
-    mapitem = hmap[pos]
-    while pos > startpos:
-        parentpos = (pos - 1) >> 1
+    newitem = heap[i]
+    mapitem = hmap[i]
+    while i > startpos:
+        parentpos = (i - 1) >> 1
         parent = heap[parentpos]
         father = hmap[parentpos]
 
-        if newitem < parent:
-            heap[pos] = parent
-            hmap[pos] = father
-            pos = parentpos
+        if newitem < parent or (newitem == parent and mapitem < father):
+            heap[i] = parent
+            hmap[i] = father
+            pos[father] = i
+            i = parentpos
             continue
         break
 
-    heap[pos] = newitem
-    hmap[pos] = mapitem
+    heap[i] = newitem
+    hmap[i] = mapitem
+    pos[mapitem] = i
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.nonecheck(False)
-cdef inline void _siftup(double[:] heap, int[:] hmap, int pos, int endpos) nogil:
+cdef inline void _siftup(double[::1] heap, int[::1] hmap, int[::1] pos,
+                         int i, int endpos) nogil:
     cdef double newitem
     cdef int childpos, rightpos, mapitem
-    cdef int startpos = pos
+    cdef int startpos = i
 
-    newitem = heap[pos]
-    mapitem = hmap[pos]
+    newitem = heap[i]
+    mapitem = hmap[i]
     # Bubble up the smaller child until hitting a leaf.
-    childpos = 2*pos + 1    # leftmost child position
+    childpos = 2*i + 1    # leftmost child position
 
     while childpos < endpos:
         # Set childpos to index of smaller child.
         rightpos = childpos + 1
 
-        if rightpos < endpos and not heap[childpos] < heap[rightpos]:
+        if rightpos < endpos and not _less(heap, hmap, childpos, rightpos):
             childpos = rightpos
 
         # Move the smaller child up.
-        heap[pos] = heap[childpos]
-        hmap[pos] = hmap[childpos]
-        pos = childpos
-        childpos = 2*pos + 1
+        heap[i] = heap[childpos]
+        hmap[i] = hmap[childpos]
+        pos[hmap[i]] = i
+        i = childpos
+        childpos = 2*i + 1
 
-    # The leaf at pos is empty now.  Put newitem there, and bubble it up
+    # The leaf at i is empty now.  Put newitem there, and bubble it up
     # to its final resting place (by sifting its parents down).
-    heap[pos] = newitem
-    hmap[pos] = mapitem
-    _siftdown(heap, hmap, startpos, pos)
-
-
-@cython.boundscheck(False)
-@cython.wraparound(False)
-@cython.nonecheck(False)
-cdef inline void heapify(double[:] heap, int[:] hmap, int n) nogil:
-    cdef int i
-    for i in reversed(range(n//2)):
-        _siftup(heap, hmap, i, n)
+    heap[i] = newitem
+    hmap[i] = mapitem
+    pos[mapitem] = i
+    _siftdown(heap, hmap, pos, startpos, i)
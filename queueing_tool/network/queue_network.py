@@ -1,10 +1,13 @@
 import collections
+import multiprocessing
 import numbers
 import copy
 import array
+import os
+import pickle
+import time
 
 import numpy as np
-from numpy.random import uniform
 
 try:
     import matplotlib.pyplot as plt
@@ -17,13 +20,57 @@ try:
 except ImportError:
     HAS_MATPLOTLIB = False
 
+try:
+    import pandas as pd
+    HAS_PANDAS = True
+
+except ImportError:
+    HAS_PANDAS = False
+
+try:
+    import pyarrow as pa
+    HAS_PYARROW = True
+
+except ImportError:
+    HAS_PYARROW = False
+
 from queueing_tool.graph import _prepare_graph
 from queueing_tool.queues import (
+    DataCollector,
     NullQueue,
     QueueServer,
-    LossQueue
+    LossQueue,
+    QuantileSketch,
+    Uniform
 )
-from queueing_tool.network.priority_queue import PriorityQueue
+from queueing_tool.network.priority_queue import (
+    CalendarQueue,
+    PriorityQueue,
+    Scheduler
+)
+from queueing_tool.network import _simulate
+from queueing_tool.network.trace import (
+    ARRIVAL,
+    BLOCKED,
+    DEPARTURE,
+    NOTHING,
+    TraceRecorder
+)
+from queueing_tool.queues.collector import (
+    RingCollector,
+    SQLiteDataStore,
+    _group_by_agent,
+    _in_window,
+    _sampled
+)
+from queueing_tool.queues.stats import (
+    BatchMeans,
+    QueueStats,
+    SojournStats,
+    StateLog,
+    mser_truncation
+)
+from queueing_tool.queues.choice import _alias_table
 
 
 class QueueingToolError(Exception):
@@ -33,6 +80,36 @@ class QueueingToolError(Exception):
 
 EPS = np.float64(1e-7)
 
+# Copying the network's state into the compiled event loop and back
+# takes about as long as simulating one event in Python for each edge
+# and agent, so shorter runs than that (or than this) stay in Python.
+COMPILED_MIN_EVENTS = 256
+
+# The metrics simulate(until_precision=...) and warm_up can follow.
+RUN_METRICS = ('wait', 'sojourn', 'num_system', 'num_queued')
+
+# The columns of to_dataframe and to_arrow, in order.
+EXPORT_DTYPE = np.dtype([
+    ('arrival', np.float64),
+    ('service', np.float64),
+    ('departure', np.float64),
+    ('num_queued', np.int32),
+    ('num_total', np.int32),
+    ('edge', np.int32),
+    ('edge_type', np.int32),
+    ('agent_edge', np.int32),
+    ('agent_num', np.int64)
+])
+
+# Queues whose _receive method hands a routed agent straight to the
+# queue, instead of pushing it on the arrivals heap and popping it off.
+HANDOFF_QUEUES = (QueueServer, LossQueue, NullQueue)
+
+SCHEDULERS = {
+    'heap': PriorityQueue,
+    'calendar': CalendarQueue
+}
+
 v_pens = [
     [0.5, 0.5, 0.5, 0.5],
     [0, 0.5, 1, 1],
@@ -70,9 +147,15 @@ class QueueNetwork(object):
         and the values are dictionarys holding the arguments that are
         passed when instantiating each :class:`.QueueServer` created
         with that edge type.
-    seed : int (optional)
-        An integer used to initialize numpy's psuedo-random number
-        generator.
+    seed : int or :class:`~numpy.random.SeedSequence` (optional)
+        Seeds the network's random number generators. The seed is
+        turned into a :class:`~numpy.random.SeedSequence` and spawned
+        into independent streams: one :class:`~numpy.random.Generator`
+        for routing and one for each queue, by edge index. A queue's
+        stream only depends on the seed and its edge index, so
+        changing one queue does not change the random numbers used by
+        the others. If neither ``seed`` nor ``rng`` is given then
+        numpy's global random state is used.
     colors : dict (optional)
         A dictionary of RGBA colors used to color the graph. The keys
         are specified in the Notes section. If this parameter is
@@ -102,9 +185,33 @@ class QueueNetwork(object):
         Specifies whether the graph will be adjusted to make sure
         terminal nodes do not cause any issues when simulating. For
         most cases, this should be set to ``True``.
+    scheduler : ``{'heap', 'calendar'}`` or class (optional, default: ``'heap'``)
+        The data structure that orders the queues by the time of their
+        next event.
+
+        ``'heap'``
+            A :class:`.PriorityQueue`, an indexed binary heap.
+        ``'calendar'``
+            A :class:`.CalendarQueue`, which takes amortized constant
+            time per event. This can be faster for networks with many
+            active edges whose event times fall close together.
+
+        A subclass of :class:`.PriorityQueue` or :class:`.CalendarQueue`
+        may also be given.
+    rng : :class:`~numpy.random.Generator` (optional)
+        If given, the seed for the network's streams is drawn from
+        ``rng`` and ``seed`` is ignored.
 
     Attributes
     ----------
+    agents_by_type : dict
+        The number of agents in the network on each edge type; the keys
+        are edge types and the values are sums of :attr:`.num_agents`
+        over the edges of that type. This attribute is read-only.
+    agents_by_vertex : :class:`~numpy.ndarray`
+        A one-dimensional array where the ``v``\ th entry is the number
+        of agents waiting or in service at the queues on the in-edges
+        of vertex ``v``. This attribute is read-only.
     blocking : str
         Specifies whether the system's blocking behavior is either
         Blocking After Service (BAS) or Repetitive Service Blocking (RS).
@@ -137,7 +244,7 @@ class QueueNetwork(object):
         the total number of agents in the :class:`.QueueServer` with
         edge index ``k``. This number includes agents that are
         scheduled to arrive at the queue at some future time but
-        haven't yet.
+        haven't yet. A new array is made each time it is read.
     num_edges : int
         The number of edges in the graph.
     num_events : int
@@ -154,8 +261,15 @@ class QueueNetwork(object):
         vertex. Specifically, ``out_edges[v]`` returns a list
         containing the edge index for all edges with the tail of the
         edge at ``v``, where ``v`` is the vertex's index number.
+    rng : :class:`~numpy.random.Generator` or ``None``
+        The generator used for routing, blocking delays and picking the
+        queues to activate in :meth:`.initialize`, or ``None`` if the
+        network uses numpy's global random state.
     time : float
         The time of the next event.
+    total_agents : int
+        The total number of agents in the network, which is the sum of
+        :attr:`.num_agents`. This attribute is read-only.
 
 
     Raises
@@ -164,6 +278,9 @@ class QueueNetwork(object):
         Raised when the parameter ``g`` is not of a type that can be
         made into a :any:`networkx.DiGraph`, or when ``g`` is not
         ``None``.
+    ValueError
+        Raised when ``scheduler`` is not one of the names or classes
+        listed above.
 
     Notes
     -----
@@ -305,18 +422,28 @@ class QueueNetwork(object):
     }
 
     def __init__(self, g, q_classes=None, q_args=None, seed=None, colors=None,
-                 max_agents=1000, blocking='BAS', adjust_graph=True):
+                 max_agents=1000, blocking='BAS', adjust_graph=True,
+                 scheduler='heap', rng=None):
 
         if not isinstance(blocking, str):
             raise TypeError("blocking must be a string")
 
+        if isinstance(scheduler, str):
+            if scheduler.lower() not in SCHEDULERS:
+                msg = "scheduler must be one of {0}".format(sorted(SCHEDULERS))
+                raise ValueError(msg)
+            scheduler = SCHEDULERS[scheduler.lower()]
+        elif not (isinstance(scheduler, type) and issubclass(scheduler, Scheduler)):
+            raise ValueError("scheduler must be a string or a Scheduler subclass")
+
         self._t = 0
         self.num_events = 0
         self.max_agents = max_agents
 
         self._initialized = False
         self._prev_edge = None
-        self._fancy_heap = PriorityQueue()
+        self._scheduler = scheduler
+        self._fancy_heap = scheduler()
         self._blocking = True if blocking.lower() != 'rs' else False
 
         if colors is None:
@@ -344,20 +471,48 @@ class QueueNetwork(object):
             if 'colors' not in args:
                 args['colors'] = self.default_q_colors.get(key, self.default_q_colors[1])
 
-        if isinstance(seed, numbers.Integral):
-            np.random.seed(seed)
+        if rng is not None:
+            seed = np.random.SeedSequence(rng.integers(0, 2**63, size=4))
+        elif seed is not None and not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+
+        self._seed_seq = seed
+        if seed is not None:
+            route_seq, queue_seq = seed.spawn(2)
+            self.rng = np.random.default_rng(route_seq)
+        else:
+            queue_seq = None
+            self.rng = None
+
+        # Buffered uniform random numbers for routing and blocking.
+        self._uniforms = Uniform(rng=self.rng)
+
+        # Every queue writes the data it collects to the same columns.
+        self._data = DataCollector()
+        self._store = None
+        self.collect_sojourns = False
+        self._sojourns = SojournStats(0)
+        self._trace = None
 
         if g is not None:
-            g, qs = _prepare_graph(g, self.colors, q_classes, q_args, adjust_graph)
+            g, qs = _prepare_graph(g, self.colors, q_classes, q_args,
+                                   adjust_graph, queue_seq)
 
             self.nV = g.number_of_nodes()
             self.nE = g.number_of_edges()
 
             self.edge2queue = qs
-            self.num_agents = np.zeros(g.number_of_edges(), int)
+            for q in qs:
+                if not isinstance(q._data, RingCollector):
+                    q._data = self._data
+
+            self._sojourns = SojournStats(self.nE)
+
+            self._num_agents = [0 for e in range(self.nE)]
             self.out_edges = [0 for v in range(self.nV)]
             self.in_edges = [0 for v in range(self.nV)]
             self._route_probs = [0 for v in range(self.nV)]
+            self._route_alias = [0 for v in range(self.nV)]
 
             for v in g.nodes():
                 vod = g.out_degree(v)
@@ -365,13 +520,46 @@ class QueueNetwork(object):
                 self.out_edges[v] = [g.edge_index[e] for e in sorted(g.out_edges(v))]
                 self.in_edges[v] = [g.edge_index[e] for e in sorted(g.in_edges(v))]
                 self._route_probs[v] = probs
+                self._route_alias[v] = _alias_table(probs)
 
             g.freeze()
             self.g = g
+            self._reset_counts()
 
     def __repr__(self):
         the_string = 'QueueNetwork. # nodes: {0}, edges: {1}, agents: {2}'
-        return the_string.format(self.nV, self.nE, np.sum(self.num_agents))
+        return the_string.format(self.nV, self.nE, self._total_agents)
+
+    def __getstate__(self):
+        # The scheduler can't be pickled, it is rebuilt from the queues
+        # in __setstate__.
+        state = self.__dict__.copy()
+        del state['_fancy_heap']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._initialized:
+            keys = [q._key() for q in self.edge2queue if q._time < np.infty]
+            self._fancy_heap = self._scheduler(keys, self.nE)
+        else:
+            self._fancy_heap = self._scheduler()
+
+    @property
+    def agents_by_type(self):
+        return dict(self._type_agents)
+
+    @property
+    def agents_by_vertex(self):
+        return np.array(self._vertex_agents, int)
+
+    @property
+    def num_agents(self):
+        return np.array(self._num_agents, int)
+
+    @num_agents.setter
+    def num_agents(self, value):
+        self._num_agents = [int(n) for n in value]
 
     @property
     def blocking(self):
@@ -399,14 +587,14 @@ class QueueNetwork(object):
     def current_time(self):
         return self._t
 
+    @property
+    def total_agents(self):
+        return self._total_agents
+
     @property
     def time(self):
-        if self._fancy_heap.size > 0:
-            e = self._fancy_heap.array_edges[0]
-            t = self.edge2queue[e]._time
-        else:
-            t = np.infty
-        return t
+        key = self._fancy_heap.peek()
+        return key[0] if key is not None else np.infty
 
     def animate(self, out=None, t=None, line_kwargs=None,
                 scatter_kwargs=None, **kwargs):
@@ -592,7 +780,11 @@ class QueueNetwork(object):
         The attributes ``t``, ``num_events``, ``num_agents`` are set to
         zero, :meth:`.reset_colors` is called, and the
         :meth:`.QueueServer.clear` method is called for each queue in
-        the network.
+        the network. Buffered random numbers are thrown away, so seeding
+        numpy after clearing reproduces a simulation. Any ``sink`` or
+        ``store`` given to :meth:`.start_collecting_data` is detached,
+        though data already written to a :class:`.DiskDataStore` stays
+        on disk.
 
         Notes
         -----
@@ -601,13 +793,19 @@ class QueueNetwork(object):
         """
         self._t = 0
         self.num_events = 0
-        self.num_agents = np.zeros(self.nE, int)
-        self._fancy_heap = PriorityQueue()
+        self._num_agents = [0 for e in range(self.nE)]
+        self._fancy_heap = self._scheduler()
         self._prev_edge = None
         self._initialized = False
         self.reset_colors()
+        self._uniforms.reset()
+        self._data.clear()
+        self._data.sink = None
+        self._store = None
+        self._sojourns.start(0)
         for q in self.edge2queue:
             q.clear()
+        self._reset_counts()
 
     def clear_data(self, queues=None, edge=None, edge_type=None):
         """Clears data from all queues.
@@ -633,20 +831,37 @@ class QueueNetwork(object):
         edge_type : int or an iterable of int (optional)
             A integer, or a collection of integers identifying which
             edge types will have their data cleared.
+
+        Notes
+        -----
+        Data already written to a :class:`.DiskDataStore` is not
+        removed.
         """
         queues = _get_queues(self.g, queues, edge, edge_type)
-
+        for collector, edges in self._collectors(queues):
+            collector.clear(edges)
+
+    def _collectors(self, queues):
+        # Pairs the network's collector, and the ring buffer of each
+        # queue that keeps its own, with the edges in queues that
+        # write to it.
+        shared, rings = [], []
         for k in queues:
-            self.edge2queue[k].data = {}
+            collector = self.edge2queue[k]._data
+            if collector is self._data:
+                shared.append(k)
+            else:
+                rings.append((collector, [k]))
+        return [(self._data, shared)] + rings
 
     def copy(self):
         """Returns a deep copy of itself."""
-        net = QueueNetwork(None)
+        net = QueueNetwork(None, scheduler=self._scheduler)
         net.g = self.g.copy()
         net.max_agents = copy.deepcopy(self.max_agents)
         net.nV = copy.deepcopy(self.nV)
         net.nE = copy.deepcopy(self.nE)
-        net.num_agents = copy.deepcopy(self.num_agents)
+        net._num_agents = list(self._num_agents)
         net.num_events = copy.deepcopy(self.num_events)
         net._t = copy.deepcopy(self._t)
         net._initialized = copy.deepcopy(self._initialized)
@@ -655,12 +870,19 @@ class QueueNetwork(object):
         net.colors = copy.deepcopy(self.colors)
         net.out_edges = copy.deepcopy(self.out_edges)
         net.in_edges = copy.deepcopy(self.in_edges)
-        net.edge2queue = copy.deepcopy(self.edge2queue)
+        net._data, net.edge2queue = copy.deepcopy((self._data, self.edge2queue))
+        net._store = self._store
+        net.collect_sojourns = self.collect_sojourns
+        net._sojourns = copy.deepcopy(self._sojourns)
         net._route_probs = copy.deepcopy(self._route_probs)
+        net._route_alias = copy.deepcopy(self._route_alias)
+        net.rng, net._uniforms = copy.deepcopy((self.rng, self._uniforms))
+        net._seed_seq = copy.deepcopy(self._seed_seq)
+        net._reset_counts()
 
         if net._initialized:
             keys = [q._key() for q in net.edge2queue if q._time < np.infty]
-            net._fancy_heap = PriorityQueue(keys, net.nE)
+            net._fancy_heap = net._scheduler(keys, net.nE)
 
         return net
 
@@ -740,7 +962,9 @@ class QueueNetwork(object):
         self.g.draw_graph(line_kwargs=line_kwargs,
                           scatter_kwargs=scatter_kwargs, **kwargs)
 
-    def get_agent_data(self, queues=None, edge=None, edge_type=None, return_header=False):
+    def get_agent_data(self, queues=None, edge=None, edge_type=None,
+                       return_header=False, as_dict=True, window=None,
+                       return_weights=False):
         """Gets data from queues and organizes it by agent.
 
         If none of the parameters are given then data from every
@@ -766,6 +990,15 @@ class QueueNetwork(object):
             edge types to retrieve agent data from.
         return_header : bool (optonal, default: False)
             Determines whether the column headers are returned.
+        as_dict : bool (optional, default: ``True``)
+            Whether to return a ``dict`` or the arrays it is built
+            from. See :meth:`.DataCollector.by_agent` for the arrays.
+        window : 2-tuple of float (optional)
+            If given, only visits with an arrival time ``t`` where
+            ``window[0] <= t < window[1]`` are returned.
+        return_weights : bool (optional, default: ``False``)
+            Determines whether the sampling weights of the agents are
+            returned, see :meth:`.start_collecting_data`.
 
         Returns
         -------
@@ -773,8 +1006,9 @@ class QueueNetwork(object):
             Returns a ``dict`` where the keys are the
             :class:`Agent's<.Agent>` ``agent_id`` and the values are
             :class:`ndarrays<~numpy.ndarray>` for that
-            :class:`Agent's<.Agent>` data. The columns of this array
-            are as follows:
+            :class:`Agent's<.Agent>` data, sorted by arrival time.
+            The values are views of one array. The columns of this
+            array are as follows:
 
             * First: The arrival time of an agent.
             * Second: The service start time of an agent.
@@ -785,42 +1019,55 @@ class QueueNetwork(object):
             * Sixth: the :class:`QueueServer's<.QueueServer>` id
               (its edge index).
 
+        weights : dict or :class:`~numpy.ndarray` (optional)
+            The inverse of the probability that data was collected on
+            each agent, given by the sampling settings of the queue
+            the agent entered the network at. A ``dict`` keyed by
+            ``agent_id``, or an array in the order of the agent ids if
+            ``as_dict`` is ``False``.
         headers : str (optional)
             A comma seperated string of the column headers. Returns
             ``'arrival,service,departure,num_queued,num_total,q_id'``
         """
         queues = _get_queues(self.g, queues, edge, edge_type)
+        dat, ids = [], []
+        for collector, edges in self._collectors(queues):
+            rows = collector.rows(edges)
+            dat.append(collector._gather(rows))
+            ids.append(collector._agent_ids(rows))
+        dat, ids = np.vstack(dat), np.vstack(ids)
+
+        keep = _in_window(dat[:, 0], window)
+        dat, ids = dat[keep], ids[keep]
+
+        if self._store is not None:
+            disk, disk_ids = self._store.read(queues, window, agent_ids=True)
+            dat = np.vstack((disk, dat))
+            ids = np.vstack((disk_ids, ids))
+
+        agent_ids, offsets, dat = _group_by_agent(dat, ids)
+
+        if as_dict:
+            bounds = zip(offsets[:-1].tolist(), offsets[1:].tolist())
+            data = {tuple(a): dat[s:e] for a, (s, e) in zip(agent_ids.tolist(), bounds)}
+        else:
+            data = agent_ids, offsets, dat
 
-        data = {}
-        for qid in queues:
-            for agent_id, dat in self.edge2queue[qid].data.items():
-                datum = np.zeros((len(dat), 6))
-                datum[:, :5] = np.array(dat)
-                datum[:, 5] = qid
-                if agent_id in data:
-                    data[agent_id] = np.vstack((data[agent_id], datum))
-                else:
-                    data[agent_id] = datum
-
-        dType = [
-            ('a', float),
-            ('s', float),
-            ('d', float),
-            ('q', float),
-            ('n', float),
-            ('id', float)
-        ]
-        for agent_id, dat in data.items():
-            datum = np.array([tuple(d) for d in dat.tolist()], dtype=dType)
-            datum = np.sort(datum, order='a')
-            data[agent_id] = np.array([tuple(d) for d in datum])
+        out = (data,)
+        if return_weights:
+            weight = np.array([q._sample_every / q._sample_rate for q in self.edge2queue])
+            weights = weight[agent_ids[:, 0].astype(int)]
+            if as_dict:
+                weights = dict(zip(data.keys(), weights.tolist()))
+            out += (weights,)
 
         if return_header:
-            return data, 'arrival,service,departure,num_queued,num_total,q_id'
+            out += ('arrival,service,departure,num_queued,num_total,q_id',)
 
-        return data
+        return out if len(out) > 1 else data
 
-    def get_queue_data(self, queues=None, edge=None, edge_type=None, return_header=False):
+    def get_queue_data(self, queues=None, edge=None, edge_type=None,
+                       return_header=False, window=None):
         """Gets data from all the queues.
 
         If none of the parameters are given then data from every
@@ -846,6 +1093,9 @@ class QueueNetwork(object):
             edge types to retrieve data from.
         return_header : bool (optonal, default: False)
             Determines whether the column headers are returned.
+        window : 2-tuple of float (optional)
+            If given, only visits with an arrival time ``t`` where
+            ``window[0] <= t < window[1]`` are returned.
 
         Returns
         -------
@@ -889,20 +1139,293 @@ class QueueNetwork(object):
 
         >>> data = net.get_queue_data(queues=(20, 14, 0, 4))
         """
-        queues = _get_queues(self.g, queues, edge, edge_type)
+        queues = np.asarray(list(_get_queues(self.g, queues, edge, edge_type)), int)
+        queues = queues[np.sort(np.unique(queues, return_index=True)[1])]
+        data = np.vstack([c.fetch(e) for c, e in self._collectors(queues)])
+        data = data[_in_window(data[:, 0], window)]
 
-        data = np.zeros((0, 6))
-        for q in queues:
-            dat = self.edge2queue[q].fetch_data()
+        if self._store is not None:
+            data = np.vstack((self._store.read(queues, window), data))
+            data = data[np.lexsort(data[:, ::-1].T)]
 
-            if len(dat) > 0:
-                data = np.vstack((data, dat))
+        # Group the rows by queue, in the order the queues were given.
+        rank = np.zeros(self.nE, int)
+        rank[queues] = np.arange(len(queues))
+        data = data[np.argsort(rank[data[:, 5].astype(int)], kind='stable')]
 
         if return_header:
             return data, 'arrival,service,departure,num_queued,num_total,q_id'
 
         return data
 
+    def get_quantiles(self, q=(0.5, 0.95, 0.99), queues=None, edge=None,
+                      edge_type=None, merge=False):
+        """Returns estimates of quantiles of the waiting and sojourn
+        times at the queues that keep quantile sketches.
+
+        See :meth:`.start_collecting_stats` and :meth:`.get_sketches`.
+        If none of ``queues``, ``edge`` or ``edge_type`` are given then
+        every queue is used.
+
+        Parameters
+        ----------
+        q : float or *array_like* (optional, default: ``(0.5, 0.95, 0.99)``)
+            The quantiles, each between 0 and 1.
+        queues : int or an *array_like* of int, (optional)
+            The edge index (or an iterable of edge indices) identifying
+            the :class:`QueueServer(s)<.QueueServer>` whose quantiles
+            are returned.
+        edge : 2-tuple of int or *array_like* (optional)
+            Explicitly specify which queues you want quantiles for.
+            Must be either:
+
+            * A 2-tuple of the edge's source and target vertex
+              indices, or
+            * An iterable of 2-tuples of the edge's source and
+              target vertex indices.
+
+        edge_type : int or an iterable of int (optional)
+            A integer, or a collection of integers identifying which
+            edge types to use.
+        merge : bool (optional, default: ``False``)
+            If ``True`` then the sketches of the selected queues are
+            merged, and the quantiles are over all of their waiting
+            and sojourn times.
+
+        Returns
+        -------
+        dict
+            A dict with keys ``'wait'`` and ``'sojourn'``. If
+            ``merge`` is ``False`` each value is an
+            :class:`~numpy.ndarray` with shape ``(num_edges, len(q))``,
+            indexed by edge index, where rows of queues that were not
+            selected or keep no sketches are ``nan``. Otherwise each
+            value has the shape of ``q``.
+
+        Examples
+        --------
+        >>> import queueing_tool as qt
+        >>> g = qt.generate_pagerank_graph(100, seed=13)
+        >>> net = qt.QueueNetwork(g, seed=13)
+        >>> net.initialize(10)
+        >>> net.start_collecting_stats(quantiles=True)
+        >>> net.simulate(n=20000)
+        >>> p = net.get_quantiles([0.5, 0.95, 0.99], edge_type=1, merge=True)
+        >>> bool(p['sojourn'][0] <= p['sojourn'][1] <= p['sojourn'][2])
+        True
+        """
+        if merge:
+            return {key: np.asarray(sketch.quantile(q))
+                    for key, sketch in self.get_sketches(queues, edge, edge_type).items()}
+
+        shape = (self.nE,) + np.shape(q)
+        out = {'wait': np.full(shape, np.nan), 'sojourn': np.full(shape, np.nan)}
+        for k in _get_queues(self.g, queues, edge, edge_type):
+            for key, value in self.edge2queue[k]._stats.quantiles(q).items():
+                out[key][k] = value
+        return out
+
+    def get_sketches(self, queues=None, edge=None, edge_type=None):
+        """Returns the quantile sketches of the waiting and sojourn
+        times of the selected queues, merged together.
+
+        The sketches are copies, so they can be kept after the network
+        changes, pickled, or merged with the sketches of other
+        replications using :meth:`.QuantileSketch.merge`. If none of
+        the parameters are given then every queue is used.
+
+        Parameters
+        ----------
+        queues : int or an *array_like* of int, (optional)
+            The edge index (or an iterable of edge indices) identifying
+            the :class:`QueueServer(s)<.QueueServer>` to use.
+        edge : 2-tuple of int or *array_like* (optional)
+            Explicitly specify which queues to use. Must be either:
+
+            * A 2-tuple of the edge's source and target vertex
+              indices, or
+            * An iterable of 2-tuples of the edge's source and
+              target vertex indices.
+
+        edge_type : int or an iterable of int (optional)
+            A integer, or a collection of integers identifying which
+            edge types to use.
+
+        Returns
+        -------
+        dict
+            A dict with keys ``'wait'`` and ``'sojourn'`` whose values
+            are :class:`.QuantileSketch` instances. Queues that keep no
+            sketches are skipped.
+
+        Raises
+        ------
+        ValueError
+            If the sketches of the queues have different accuracies.
+
+        Examples
+        --------
+        Pooling the sketches of several replications:
+
+        >>> import queueing_tool as qt
+        >>> g = qt.generate_pagerank_graph(50, seed=3)
+        >>> net = qt.QueueNetwork(g, seed=3)
+        >>> net.initialize(10)
+        >>> net.start_collecting_stats(quantiles=True)
+        >>> runs = net.replicate(4, n_events=5000, processes=1,
+        ...                      collect=lambda n: n.get_sketches())
+        >>> wait = qt.QuantileSketch()
+        >>> for run in runs:
+        ...     wait.merge(run['wait'])
+        >>> len(wait) == sum(len(run['wait']) for run in runs)
+        True
+        """
+        out = {}
+        for k in _get_queues(self.g, queues, edge, edge_type):
+            stats = self.edge2queue[k]._stats
+            for key, sketch in [('wait', stats.wait_sketch), ('sojourn', stats.sojourn_sketch)]:
+                if sketch is None:
+                    continue
+                if key in out:
+                    out[key].merge(sketch)
+                else:
+                    out[key] = sketch.copy()
+
+        for key in ['wait', 'sojourn']:
+            if key not in out:
+                out[key] = QuantileSketch()
+        return out
+
+    def get_sojourns(self, by_entry=True):
+        """Returns statistics of the time agents spent in the network,
+        from arriving from outside it until leaving it.
+
+        Agents leave the network when they are routed onto an edge
+        with a :class:`.NullQueue`. Only agents that entered the
+        network after :meth:`.start_collecting_sojourns` was called
+        are counted.
+
+        Parameters
+        ----------
+        by_entry : bool (optional, default: ``True``)
+            Whether the statistics are kept apart for each edge agents
+            entered the network through.
+
+        Returns
+        -------
+        dict
+            A dict with the following keys:
+
+            * ``num_sojourns``: The number of agents that left.
+            * ``mean_sojourn``, ``var_sojourn``: The mean and variance
+              of the time from entering to leaving the network.
+            * ``mean_hops``: The mean number of queues that agents
+              were served at.
+            * ``mean_blocked``: The mean number of times agents were
+              blocked.
+
+            If ``by_entry`` is ``True`` each value is an
+            :class:`~numpy.ndarray` with one entry per edge, indexed by
+            the edge index of the queue the agents entered at.
+            Otherwise each value is a number. Means and variances
+            without any samples are ``nan``.
+
+        Examples
+        --------
+        >>> import queueing_tool as qt
+        >>> g = qt.generate_random_graph(100, seed=13)
+        >>> net = qt.QueueNetwork(g, seed=13)
+        >>> net.initialize(edge_type=1)
+        >>> net.start_collecting_sojourns()
+        >>> net.simulate(n=20000)
+        >>> res = net.get_sojourns(by_entry=False)
+        >>> res['num_sojourns'] > 0 and res['mean_hops'] >= 1
+        True
+        """
+        return self._sojourns.summary(by_entry)
+
+    def get_stats(self):
+        """Returns the statistics kept by the queues that collect
+        them.
+
+        See :meth:`.start_collecting_stats` and
+        :meth:`.QueueServer.get_stats`.
+
+        Returns
+        -------
+        dict
+            A dict with the same keys as :meth:`.QueueServer.get_stats`.
+            Each value is an :class:`~numpy.ndarray` with one entry
+            per edge, indexed by edge index. Queues that have never
+            collected statistics have ``nan`` entries.
+
+        Examples
+        --------
+        >>> import queueing_tool as qt
+        >>> g = qt.generate_pagerank_graph(100, seed=13)
+        >>> net = qt.QueueNetwork(g, seed=13)
+        >>> net.initialize(10)
+        >>> net.start_collecting_stats()
+        >>> net.simulate(n=20000)
+        >>> stats = net.get_stats()
+        >>> stats['mean_sojourn'].shape == (net.num_edges,)
+        True
+        """
+        stats = {key: np.full(self.nE, np.nan) for key in QueueStats.keys}
+        for k, q in enumerate(self.edge2queue):
+            if not q.collect_stats and q._stats.t_last == q._stats.t_start:
+                continue
+            t = self._t if q.collect_stats else None
+            for key, value in q._stats.summary(q, t).items():
+                stats[key][k] = value
+        return stats
+
+    def occupancy_series(self, edge, grid, metric='num_system'):
+        """Returns the exact time averages of the state of one queue
+        over consecutive intervals.
+
+        The queue must be logging its state, see
+        :meth:`.start_collecting_states`.
+
+        Parameters
+        ----------
+        edge : int or 2-tuple of int
+            The edge index of the queue, or the indices of the source
+            and target vertices of its edge.
+        grid : *array_like*
+            Increasing times. The averages are over the intervals
+            between consecutive times.
+        metric : str (optional, default: ``'num_system'``)
+            One of ``'num_system'``, ``'num_queued'`` (the number of
+            agents waiting for service), ``'num_busy'`` (the number of
+            agents in service), or ``'utilization'`` (``num_busy``
+            divided by ``num_servers``).
+
+        Returns
+        -------
+        :class:`~numpy.ndarray`
+            An array with one fewer entry than ``grid``. Parts of an
+            interval outside of the log are ignored, and intervals
+            that do not overlap the log are ``nan``.
+
+        Examples
+        --------
+        >>> import queueing_tool as qt
+        >>> g = qt.generate_pagerank_graph(100, seed=13)
+        >>> net = qt.QueueNetwork(g, seed=13)
+        >>> net.initialize(10)
+        >>> net.start_collecting_states()
+        >>> net.simulate(t=20)
+        >>> series = net.occupancy_series(0, [0, 5, 10, 15, 20])
+        >>> series.shape
+        (4,)
+        """
+        if isinstance(edge, tuple):
+            edge = self.g.edge_index[edge]
+
+        q = self.edge2queue[edge]
+        return q._states.series(grid, metric, q.num_servers, self._t)
+
     def initialize(self, nActive=1, queues=None, edges=None, edge_type=None):
         """Prepares the ``QueueNetwork`` for simulation.
 
@@ -957,7 +1480,8 @@ class QueueNetwork(object):
             if nActive >= 1 and isinstance(nActive, numbers.Integral):
                 qs = [q.edge[2] for q in self.edge2queue if q.edge[3] != 0]
                 n = min(nActive, len(qs))
-                queues = np.random.choice(qs, size=n, replace=False)
+                rng = np.random if self.rng is None else self.rng
+                queues = rng.choice(qs, size=n, replace=False)
             elif not isinstance(nActive, numbers.Integral):
                 msg = "If queues is None, then nActive must be an integer."
                 raise TypeError(msg)
@@ -978,10 +1502,10 @@ class QueueNetwork(object):
 
         for ei in queues:
             self.edge2queue[ei].set_active()
-            self.num_agents[ei] = self.edge2queue[ei]._num_total
+            self._update_counts(self.edge2queue[ei])
 
         keys = [q._key() for q in self.edge2queue if q._time < np.infty]
-        self._fancy_heap = PriorityQueue(keys, self.nE)
+        self._fancy_heap = self._scheduler(keys, self.nE)
         self._initialized = True
 
     def next_event_description(self):
@@ -998,19 +1522,238 @@ class QueueNetwork(object):
             The edge index of the edge that this event will occur at.
             If there are no events then ``None`` is returned.
         """
-        if self._fancy_heap.size == 0:
+        key = self._fancy_heap.peek()
+        if key is None:
             event_type = 'Nothing'
             edge_index = None
         else:
-            s = [q._key() for q in self.edge2queue]
-            s.sort()
-            e = s[0][1]
-            q = self.edge2queue[e]
+            q = self.edge2queue[key[1]]
 
             event_type = 'Arrival' if q.next_event_description() == 1 else 'Departure'
             edge_index = q.edge[2]
         return event_type, edge_index
 
+    def iter_events(self, n=None, t=None, batch=4096):
+        """Simulates the network forward and yields the visits that
+        have been completed, a batch at a time.
+
+        A visit is complete once the agent has left the queue. Visits
+        are removed from the network's data once they are yielded, so
+        the memory used does not grow with the length of the run.
+
+        If no queue is collecting data then every queue collects data
+        while the generator runs. Once it is exhausted or closed the
+        queues stop collecting data again, and the visits that were
+        still in progress are thrown away.
+
+        Parameters
+        ----------
+        n : int (optional)
+            The number of events to simulate.
+        t : float (optional)
+            The amount of simulation time to simulate forward. If
+            given, ``t`` is used instead of ``n``. If neither is given
+            the simulation runs until the generator is closed or there
+            are no more events.
+        batch : int (optional, default: ``4096``)
+            The number of visits in each batch. The last batch may be
+            smaller.
+
+        Yields
+        ------
+        :class:`~numpy.ndarray`
+            A record array with dtype :attr:`.DataCollector.dtype`. Its
+            fields are ``arrival``, ``service``, ``departure``,
+            ``num_queued``, ``num_total``, ``edge``, ``agent_edge`` and
+            ``agent_num``; see :meth:`.QueueServer.fetch_data`.
+
+        Raises
+        ------
+        QueueingToolError
+            Will raise a :exc:`.QueueingToolError` if the
+            ``QueueNetwork`` has not been initialized.
+        ValueError
+            If a ``sink`` was given to :meth:`.start_collecting_data`,
+            since it would be passed the visits before they could be
+            yielded.
+
+        Examples
+        --------
+        >>> import queueing_tool as qt
+        >>> g = qt.generate_pagerank_graph(100, seed=13)
+        >>> net = qt.QueueNetwork(g, seed=13)
+        >>> net.initialize(10)
+        >>> sizes = [len(v) for v in net.iter_events(n=20000, batch=1000)]
+        >>> max(sizes)
+        1000
+        >>> visits = next(net.iter_events(n=5000, batch=10))
+        >>> visits.dtype.names   # doctest: +NORMALIZE_WHITESPACE
+        ('arrival', 'service', 'departure', 'num_queued', 'num_total',
+         'edge', 'agent_edge', 'agent_num')
+        >>> bool((visits['departure'] >= visits['arrival']).all())
+        True
+
+        The queues only collected data while the generators ran:
+
+        >>> any(q.collect_data for q in net.edge2queue)
+        False
+        >>> len(net.get_queue_data())
+        0
+        """
+        if not self._initialized:
+            msg = ("Network has not been initialized. "
+                   "Call '.initialize()' first.")
+            raise QueueingToolError(msg)
+
+        if self._data.sink is not None:
+            msg = ("iter_events can not be used while the network's data "
+                   "is passed to a sink. Call '.stop_collecting_data()' first.")
+            raise ValueError(msg)
+
+        started = not any(q.collect_data for q in self.edge2queue)
+        if started:
+            self.start_collecting_data()
+
+        stop = np.infty if t is None else self._t + t
+        if n is None or t is not None:
+            n = np.infty
+
+        try:
+            count = 0
+            while count < n and self._t < stop:
+                self._simulate_next_event(slow=False)
+                count += 1
+                if self._data.num_done >= batch:
+                    yield self._data.drain(batch)
+
+            while self._data.num_done > 0:
+                yield self._data.drain(batch)
+        finally:
+            if started:
+                self.stop_collecting_data()
+                self._data.clear()
+
+    def query_data(self, sql, params=()):
+        """Runs an SQL query on the visits in the network's
+        :class:`.SQLiteDataStore`.
+
+        Completed visits that are still in memory are written to the
+        store first. Visits in progress, and visits kept in ring
+        buffers, are not in the store.
+
+        Parameters
+        ----------
+        sql : str
+            The SQL statement. The visits are in the table ``visits``,
+            see :class:`.SQLiteDataStore`.
+        params : sequence or dict (optional)
+            The values of the statement's placeholders.
+
+        Returns
+        -------
+        list
+            The rows selected, as tuples.
+
+        Raises
+        ------
+        QueueingToolError
+            If the network's data is not kept in a
+            :class:`.SQLiteDataStore`.
+
+        Examples
+        --------
+        Mean sojourn time at each queue, and the number of visits of
+        each agent:
+
+        >>> import os, tempfile
+        >>> import queueing_tool as qt
+        >>> g = qt.generate_pagerank_graph(100, seed=13)
+        >>> net = qt.QueueNetwork(g, seed=13)
+        >>> net.initialize(10)
+        >>> path = os.path.join(tempfile.mkdtemp(), 'visits.db')
+        >>> net.start_collecting_data(store=qt.SQLiteDataStore(path))
+        >>> net.simulate(n=20000)
+        >>> rows = net.query_data(
+        ...     'SELECT edge, AVG(departure - arrival) FROM visits '
+        ...     'WHERE departure > 0 GROUP BY edge')
+        >>> rows = net.query_data(
+        ...     'SELECT agent_edge, agent_num, COUNT(*) FROM visits '
+        ...     'GROUP BY agent_edge, agent_num')
+        """
+        if not isinstance(self._store, SQLiteDataStore):
+            msg = ("The network's data is not kept in a SQLiteDataStore. "
+                   "Pass one to '.start_collecting_data()' first.")
+            raise QueueingToolError(msg)
+
+        if self._data.num_done > 0:
+            self._store(self._data.drain())
+
+        return self._store.query(sql, params)
+
+    def record_trace(self, path, n=1, t=None, compiled=None, buffer_size=65536):
+        """Simulates the network forward and writes a record of each
+        event to the file ``path``.
+
+        Each record is 20 bytes, with the fields of
+        :data:`~queueing_tool.network.trace.TRACE_DTYPE`: the time of
+        the event, the edge index of the queue it happened at, the type
+        of event, and the edge index a departing agent was routed to.
+        Records are written ``buffer_size`` at a time. Use
+        :func:`.read_trace` to read a trace and :func:`.verify_trace`
+        to check that another run goes through the same events.
+
+        Parameters
+        ----------
+        path : str
+            The file the trace is written to. It is overwritten if it
+            exists.
+        n : int (optional, default: ``1``)
+            The number of events to simulate. If ``t`` is not given
+            then this parameter is used.
+        t : float (optional)
+            The amount of simulation time to simulate forward. If
+            given, ``t`` is used instead of ``n``.
+        compiled : bool (optional)
+            Whether to use the compiled event loop. If it is ``None``
+            then the same choice as :meth:`.simulate` is made.
+        buffer_size : int (optional, default: ``65536``)
+            The number of records written at once.
+
+        Raises
+        ------
+        QueueingToolError
+            Will raise a :exc:`.QueueingToolError` if the
+            ``QueueNetwork`` has not been initialized, or if
+            ``compiled`` is ``True`` and the compiled event loop can't
+            simulate the network.
+
+        Examples
+        --------
+        >>> import os, tempfile
+        >>> import queueing_tool as qt
+        >>> g = qt.generate_pagerank_graph(100, seed=13)
+        >>> net = qt.QueueNetwork(g, seed=13)
+        >>> net.initialize(10)
+        >>> path = os.path.join(tempfile.mkdtemp(), 'trace.bin')
+        >>> net.record_trace(path, n=5000)
+        >>> trace = qt.read_trace(path)
+        >>> len(trace)
+        5000
+        >>> bool((trace['time'][-1] == net.current_time))
+        True
+        """
+        if not self._initialized:
+            msg = ("Network has not been initialized. "
+                   "Call '.initialize()' first.")
+            raise QueueingToolError(msg)
+
+        self._trace = TraceRecorder(path, buffer_size)
+        try:
+            self._run(n, t, compiled)
+        finally:
+            self._trace.close()
+            self._trace = None
+
     def reset_colors(self):
         """Resets all edge and vertex colors to their default values."""
         for k, e in enumerate(self.g.edges()):
@@ -1044,6 +1787,13 @@ class QueueNetwork(object):
             A :exc:`.TypeError` is raised if mat is not a dict or
             :class:`~numpy.ndarray`.
 
+        Notes
+        -----
+        Each vertex keeps a Walker alias table of its routing
+        probabilities, which is rebuilt here. Routing an agent then
+        takes one uniform random number and constant time, however
+        many out edges the vertex has.
+
         Examples
         --------
         The default transition matrix is every out edge being equally
@@ -1117,6 +1867,8 @@ class QueueNetwork(object):
                 for k, e in enumerate(sorted(self.g.out_edges(key))):
                     self._route_probs[key][k] = value.get(e[1], 0)
 
+                self._route_alias[key] = _alias_table(self._route_probs[key])
+
         elif isinstance(mat, np.ndarray):
             non_terminal = np.array([self.g.out_degree(v) > 0 for v in self.g.nodes()])
             if mat.shape != (self.nV, self.nV):
@@ -1132,6 +1884,8 @@ class QueueNetwork(object):
             for k in range(self.nV):
                 for j, e in enumerate(sorted(self.g.out_edges(k))):
                     self._route_probs[k][j] = mat[k, e[1]]
+
+                self._route_alias[k] = _alias_table(self._route_probs[k])
         else:
             raise TypeError("mat must be a numpy array or a dict.")
 
@@ -1236,32 +1990,223 @@ class QueueNetwork(object):
         self.draw(update_colors=False, **kwargs)
         self._update_all_colors()
 
-    def simulate(self, n=1, t=None):
-        """Simulates the network forward.
+    def replicate(self, n_reps, n_events=None, t=None, processes=None,
+                  collect='summary', seed=None):
+        """Runs independent replications of the network in parallel.
 
-        Simulates either a specific number of events or for a specified
-        amount of simulation time.
+        Every replication starts from a copy of the network in its
+        current state, gets its own random streams, and is simulated
+        forward ``n_events`` events or ``t`` units of simulation time.
+        The network itself is left untouched.
 
         Parameters
         ----------
-        n : int (optional, default: 1)
-            The number of events to simulate. If ``t`` is not given
-            then this parameter is used.
+        n_reps : int
+            The number of replications.
+        n_events : int (optional)
+            The number of events to simulate in each replication. If
+            ``t`` is not given then this parameter is used.
         t : float (optional)
-            The amount of simulation time to simulate forward. If
-            given, ``t`` is used instead of ``n``.
+            The amount of simulation time to simulate each replication
+            forward. If given, ``t`` is used instead of ``n_events``.
+        processes : int (optional)
+            The number of worker processes. Defaults to the number of
+            CPUs. If it is ``1`` the replications run in this process.
+        collect : ``{'summary', 'queue_data'}`` or function (optional, default: ``'summary'``)
+            What is returned from each replication.
+
+            ``'summary'``
+                Counts for every queue at the end of each replication;
+                see the Returns section.
+            ``'queue_data'``
+                The array returned by :meth:`.get_queue_data`. Queues
+                start collecting data at the beginning of each
+                replication if none of them are collecting already.
+
+            A function is called with each simulated network and its
+            return values are collected in a list.
+        seed : int or :class:`~numpy.random.SeedSequence` (optional)
+            Seeds the replications. Replication ``k`` uses the ``k``-th
+            child of ``seed``, spawned with
+            :meth:`~numpy.random.SeedSequence.spawn`, for its streams.
+            By default the children are spawned from the network's own
+            seed, if it has one, so each call gets new streams.
+
+        Returns
+        -------
+        out : dict or list
+            For ``'summary'``, a dict of arrays whose first axis is the
+            replication: ``current_time`` and ``num_events`` have shape
+            ``(n_reps,)``, and ``num_arrivals``, ``num_departures``,
+            ``num_system`` and ``num_blocked`` have shape
+            ``(n_reps, num_edges)``. Otherwise a list with one entry per
+            replication.
 
         Raises
         ------
         QueueingToolError
             Will raise a :exc:`.QueueingToolError` if the
-            ``QueueNetwork`` has not been initialized. Call
-            :meth:`.initialize` before calling this method.
+            ``QueueNetwork`` has not been initialized.
+        ValueError
+            If neither ``n_events`` nor ``t`` is given, or ``collect``
+            is not recognized.
+
+        Notes
+        -----
+        On platforms that can fork, the workers inherit the network.
+        Elsewhere it is pickled, so the functions in ``q_args`` must be
+        picklable; a :class:`.Distribution` or a
+        :func:`functools.partial` of a module level function is, a
+        lambda is not.
+
+        The replications do not pass their data to the ``sink`` or
+        ``store`` given to :meth:`.start_collecting_data`; they keep
+        it in memory instead.
 
         Examples
         --------
-        Let ``net`` denote your instance of a ``QueueNetwork``. Before
-        you simulate, you need to initialize the network, which allows
+        >>> import queueing_tool as qt
+        >>> g = qt.generate_pagerank_graph(100, seed=13)
+        >>> net = qt.QueueNetwork(g, seed=13)
+        >>> net.initialize(10)
+        >>> res = net.replicate(8, n_events=2000, processes=2, seed=5)
+        >>> res['num_departures'].shape == (8, net.num_edges)
+        True
+        """
+        if not self._initialized:
+            msg = ("Network has not been initialized. "
+                   "Call '.initialize()' first.")
+            raise QueueingToolError(msg)
+        elif n_events is None and t is None:
+            raise ValueError("Either n_events or t must be given.")
+        elif collect not in ('summary', 'queue_data') and not callable(collect):
+            raise ValueError("collect must be 'summary', 'queue_data' or a function.")
+
+        if seed is None:
+            if self._seed_seq is not None:
+                seed = self._seed_seq.spawn(1)[0]
+            else:
+                seed = np.random.SeedSequence()
+        elif not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+
+        seeds = seed.spawn(n_reps)
+
+        if processes is None:
+            processes = os.cpu_count() or 1
+        processes = max(1, min(processes, n_reps))
+
+        # The sink and store are detached while the replications are
+        # made, so that they aren't copied, pickled or inherited and
+        # written to by every replication.
+        store, sink = self._store, self._data.sink
+        self._store = self._data.sink = None
+        try:
+            # Unpickling is about twice as fast as copy(), so the
+            # network is pickled once up front when it can be.
+            try:
+                blob = pickle.dumps(self, pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, AttributeError, TypeError):
+                blob = None
+
+            job = (self, blob, n_events, t, collect)
+
+            if processes == 1:
+                results = [_run_replication(job, s) for s in seeds]
+            else:
+                if 'fork' in multiprocessing.get_all_start_methods():
+                    ctx = multiprocessing.get_context('fork')
+                else:
+                    ctx = multiprocessing.get_context()
+
+                chunksize = max(1, n_reps // (4 * processes))
+                pool = ctx.Pool(processes, initializer=_init_replicate, initargs=(job,))
+                try:
+                    results = pool.map(_replicate_worker, seeds, chunksize)
+                finally:
+                    pool.close()
+                    pool.join()
+        finally:
+            self._store, self._data.sink = store, sink
+
+        if collect != 'summary':
+            return results
+
+        return {key: np.array([r[key] for r in results]) for key in results[0]}
+
+    def _reseed(self, seed):
+        # Gives the network new random streams made from seed, a
+        # SeedSequence, the same way __init__ does.
+        route_seq, queue_seq = seed.spawn(2)
+        self._seed_seq = seed
+        self.rng = np.random.default_rng(route_seq)
+        self._uniforms = Uniform(rng=self.rng)
+
+        for q, s in zip(self.edge2queue, queue_seq.spawn(self.nE)):
+            q._set_rng(np.random.default_rng(s))
+
+    def simulate(self, n=1, t=None, until_precision=None):
+        """Simulates the network forward.
+
+        Simulates either a specific number of events, for a specified
+        amount of simulation time, or until an estimate is precise
+        enough.
+
+        Parameters
+        ----------
+        n : int (optional, default: 1)
+            The number of events to simulate. If ``t`` is not given
+            then this parameter is used.
+        t : float (optional)
+            The amount of simulation time to simulate forward. If
+            given, ``t`` is used instead of ``n``.
+        until_precision : dict (optional)
+            If given, ``n`` and ``t`` are ignored and the network is
+            simulated until the confidence interval of an estimate is
+            narrow enough, or a budget runs out. The keys are:
+
+            * ``metric``: The quantity estimated. Either ``'wait'`` or
+              ``'sojourn'``, the mean waiting or sojourn time of the
+              visits to the selected queues, or ``'num_system'`` or
+              ``'num_queued'``, the time average of the total number
+              of agents at, or waiting at, the selected queues.
+            * ``queues``, ``edge`` and ``edge_type``: The queues used,
+              as in :meth:`.start_collecting_stats`. By default every
+              queue is used.
+            * ``rel_half_width`` and ``half_width``: The largest half
+              width of the interval, relative to the estimate or
+              absolute. At least one must be given, and the run stops
+              once either is reached.
+            * ``confidence`` (default ``0.95``): The confidence level
+              of the interval.
+            * ``batch_events`` (default ``1000``): The number of
+              events simulated between checks.
+            * ``num_batches`` (default ``20``): The fewest batches the
+              interval is computed from, see :class:`.BatchMeans`.
+            * ``max_events`` and ``max_time``: The most events to
+              simulate, and the most wall clock seconds to spend. There
+              is no limit by default.
+
+        Returns
+        -------
+        dict
+            Only returned when ``until_precision`` is given, with the
+            keys ``'estimate'``, ``'half_width'``, ``'lower'`` and
+            ``'upper'``; ``'converged'``, which is ``False`` if a
+            budget ran out first; ``'num_events'``, the number of
+            events simulated; and ``'num_batches'``.
+
+        Raises
+        ------
+        QueueingToolError
+            Will raise a :exc:`.QueueingToolError` if the
+            ``QueueNetwork`` has not been initialized. Call
+            :meth:`.initialize` before calling this method.
+
+        Examples
+        --------
+        Let ``net`` denote your instance of a ``QueueNetwork``. Before
+        you simulate, you need to initialize the network, which allows
         arrivals from outside the network. To initialize with 2 (random
         chosen) edges accepting arrivals run:
 
@@ -1286,17 +2231,164 @@ class QueueNetwork(object):
         >>> t1 = net.current_time
         >>> t1 - t0 # doctest: +ELLIPSIS
         75...
+
+        To simulate until the mean waiting time at the queues with
+        edge type 2 is known to within 5%, with 95% confidence, run:
+
+        >>> spec = {'metric': 'wait', 'edge_type': 2,
+        ...         'rel_half_width': 0.05, 'max_events': 10**6}
+        >>> ans = net.simulate(until_precision=spec)
+        >>> ans['converged']
+        True
+        >>> bool(ans['half_width'] <= 0.05 * ans['estimate'])
+        True
+
+        Notes
+        -----
+        If every queue is a :class:`.QueueServer`, :class:`.LossQueue`
+        or :class:`.NullQueue` that isn't collecting data, and every
+        agent is an :class:`.Agent`, then long runs are handed to a
+        compiled event loop. It produces exactly the same sequence of
+        events as the Python implementation, just faster. Handing a run
+        over costs about as much as simulating one event in Python for
+        each edge and agent, so runs with fewer events than that are
+        simulated in Python.
         """
         if not self._initialized:
             msg = ("Network has not been initialized. "
                    "Call '.initialize()' first.")
             raise QueueingToolError(msg)
-        if t is None:
+
+        if until_precision is not None:
+            return self._simulate_until_precision(**until_precision)
+
+        self._run(n, t)
+
+    def _simulate_until_precision(self, metric, queues=None, edge=None,
+                                  edge_type=None, rel_half_width=None,
+                                  half_width=None, confidence=0.95,
+                                  batch_events=1000, num_batches=20,
+                                  max_events=None, max_time=None):
+        # Simulates in runs of batch_events events, adding the totals
+        # of each run to a BatchMeans, until its interval is narrow
+        # enough. The totals are read off the queues' QueueStats, which
+        # the compiled event loop keeps too. Handing the loop a run has
+        # a cost that grows with the network, so once the batches get
+        # longer each call fills the rest of a batch.
+        _check_metric(metric)
+        if rel_half_width is None and half_width is None:
+            raise ValueError("One of rel_half_width and half_width must be given.")
+        if not 0 < confidence < 1:
+            raise ValueError("confidence must be in (0, 1).")
+
+        queues = list(_get_queues(self.g, queues, edge, edge_type))
+        started = [k for k in queues if not self.edge2queue[k].collect_stats]
+        self.start_collecting_stats(queues=started)
+
+        batches = BatchMeans(num_batches)
+        start, num_events = time.time(), 0
+        total0, weight0 = self._precision_totals(queues, metric)
+        converged = False
+
+        try:
+            while True:
+                parts = batches.remaining
+                n = batch_events * parts
+                if max_events is not None:
+                    n = min(n, max_events - num_events)
+                if n <= 0 or (max_time is not None and time.time() - start >= max_time):
+                    break
+
+                self._run(n, None)
+                num_events += n
+                total, weight = self._precision_totals(queues, metric)
+                batches.add(total - total0, weight - weight0, parts)
+                total0, weight0 = total, weight
+
+                estimate = batches.estimate()
+                hw = batches.half_width(confidence)
+                if (rel_half_width is not None and hw <= rel_half_width * abs(estimate)) or \
+                        (half_width is not None and hw <= half_width):
+                    converged = True
+                    break
+        finally:
+            self._stop_monitoring(started)
+
+        estimate = batches.estimate()
+        hw = batches.half_width(confidence)
+        return {
+            'estimate': estimate,
+            'half_width': hw,
+            'lower': estimate - hw,
+            'upper': estimate + hw,
+            'converged': converged,
+            'num_events': num_events,
+            'num_batches': len(batches)
+        }
+
+    def _precision_totals(self, queues, metric):
+        # The running total and weight of metric over queues: the sum
+        # and number of the waiting or sojourn times, or the integral
+        # of the number of agents and the time.
+        total, weight = 0.0, 0.0
+        for k in queues:
+            q = self.edge2queue[k]
+            st = q._stats
+            if metric == 'wait':
+                total += st.num_waits * st.mean_wait
+                weight += st.num_waits
+            elif metric == 'sojourn':
+                total += st.num_sojourns * st.mean_sojourn
+                weight += st.num_sojourns
+            else:
+                dt = self._t - st.t_last
+                if metric == 'num_system':
+                    total += st.area_system + q.num_system * dt
+                else:
+                    total += st.area_queued + len(q.queue) * dt
+
+        if metric in ('num_system', 'num_queued'):
+            weight = self._t
+        return total, weight
+
+    def _stop_monitoring(self, queues):
+        # Stops the statistics that were only kept to follow a run, and
+        # resets them so get_stats doesn't report them.
+        for k in queues:
+            q = self.edge2queue[k]
+            q.collect_stats = False
+            q._stats.start(self._t, q)
+
+    def _run(self, n, t, compiled=None):
+        # Runs simulate with the compiled event loop if compiled is
+        # True, the Python one if it is False, and whichever is faster
+        # if it is None. The number of events in a run of length t
+        # isn't known, so the first events are simulated in Python and
+        # the run is only handed to the compiled loop if it is long.
+        stop = None if t is None else self._t + t
+
+        if compiled is None:
+            work = max(COMPILED_MIN_EVENTS, self.nE + self._total_agents)
+            if stop is not None:
+                count = 0
+                while self._t < stop and count < work:
+                    self._simulate_next_event(slow=False)
+                    count += 1
+                if self._t >= stop:
+                    return
+                n = work
+            compiled = n >= work and _simulate.is_supported(self)
+        elif compiled and not _simulate.is_supported(self):
+            msg = "The network can't be simulated by the compiled event loop."
+            raise QueueingToolError(msg)
+
+        if compiled:
+            _simulate.simulate(self, n=n, until=stop)
+        elif stop is None:
             for dummy in range(n):
                 self._simulate_next_event(slow=False)
         else:
-            now = self._t
-            while self._t < now + t:
+            while self._t < stop:
                 self._simulate_next_event(slow=False)
 
     def _simulate_next_event(self, slow=True):
@@ -1317,68 +2409,79 @@ class QueueNetwork(object):
         if event == 2:  # This is a departure
             e2 = q1._departures[0].desired_destination(self, q1.edge)
             q2 = self.edge2queue[e2]
-            q2k = q2._key()
+            q2t = q2._time
 
             if q2.at_capacity() and e2 != e1:
+                if self._trace is not None:
+                    self._trace.append(q1t, e1, BLOCKED, e2)
                 q2.num_blocked += 1
                 q1._departures[0].blocked += 1
                 if self._blocking:
-                    t = q2._departures[0]._time + EPS * uniform(0.33, 0.66)
+                    u = self._uniforms.sample()
+                    t = q2._departures.next_time + EPS * (0.33 + 0.33 * u)
                     q1.delay_service(t)
                 else:
                     q1.delay_service()
             else:
+                if self._trace is not None:
+                    self._trace.append(q1t, e1, DEPARTURE, e2)
                 agent = q1.next_event()
                 agent._time = q1t
+                agent._hops += 1
 
-                q2._add_arrival(agent)
-                self.num_agents[e1] = q1._num_total
-                self.num_agents[e2] = q2._num_total
-
-                if slow:
-                    self._update_graph_colors(qedge=q1.edge)
-                    self._prev_edge = q1.edge
+                if self.collect_sojourns and isinstance(q2, NullQueue) and \
+                        agent._entered >= self._sojourns.t_start:
+                    self._sojourns.add(agent.agent_id[0], q1t - agent._entered,
+                                       agent._hops, agent.blocked)
 
+                # The agent is still counted at q1, so the total is the
+                # same as after the move.
                 if q2._active and self.max_agents < np.infty and \
-                        np.sum(self.num_agents) > self.max_agents - 1:
+                        self._total_agents > self.max_agents - 1:
                     q2._active = False
 
-                q2.next_event()
-                self.num_agents[e2] = q2._num_total
+                if type(q2) in HANDOFF_QUEUES:
+                    q2._receive(agent)
+                else:
+                    q2._add_arrival(agent)
+                    q2.next_event()
+
+                self._update_counts(q1)
+                self._update_counts(q2)
 
                 if slow:
+                    self._update_graph_colors(qedge=q1.edge)
+                    self._prev_edge = q1.edge
                     self._update_graph_colors(qedge=q2.edge)
                     self._prev_edge = q2.edge
 
-            new_q1k = q1._key()
-            new_q2k = q2._key()
+            if e2 != e1 and q2._time != q2t:
+                self._fancy_heap.update(e2, q2._time)
 
-            if new_q2k[0] != q2k[0]:
-                self._fancy_heap.push(*new_q2k)
-
-                if new_q1k[0] < np.infty and new_q1k != new_q2k:
-                    self._fancy_heap.push(*new_q1k)
-            else:
-                if new_q1k[0] < np.infty:
-                    self._fancy_heap.push(*new_q1k)
+            self._fancy_heap.update(e1, q1._time)
 
         elif event == 1:  # This is an arrival
+            if self._trace is not None:
+                self._trace.append(q1t, e1, ARRIVAL)
             if q1._active and self.max_agents < np.infty and \
-                    np.sum(self.num_agents) > self.max_agents - 1:
+                    self._total_agents > self.max_agents - 1:
                 q1._active = False
 
             q1.next_event()
-            self.num_agents[e1] = q1._num_total
+            self._update_counts(q1)
 
             if slow:
                 self._update_graph_colors(qedge=q1.edge)
                 self._prev_edge = q1.edge
 
-            new_q1k = q1._key()
-            if new_q1k[0] < np.infty:
-                self._fancy_heap.push(*new_q1k)
+            self._fancy_heap.update(e1, q1._time)
+
+        elif self._trace is not None:
+            self._trace.append(q1t, e1, NOTHING)
 
-    def start_collecting_data(self, queues=None, edge=None, edge_type=None):
+    def start_collecting_data(self, queues=None, edge=None, edge_type=None,
+                              sink=None, batch=4096, store=None,
+                              sample_rate=None, every=None, ring_size=None):
         """Tells the queues to collect data on agents' arrival, service
         start, and departure times.
 
@@ -1403,11 +2506,195 @@ class QueueNetwork(object):
         edge_type : int or an iterable of int (optional)
             A integer, or a collection of integers identifying which
             edge types will be set active.
+        sink : function (optional)
+            If given, completed visits are removed from the network's
+            data and passed to ``sink`` as record arrays of ``batch``
+            visits, see :meth:`.iter_events`. The last visits are
+            passed on when :meth:`.stop_collecting_data` is called.
+        batch : int (optional, default: ``4096``)
+            The number of visits passed to ``sink`` at once.
+        store : :class:`.DiskDataStore` or :class:`.SQLiteDataStore` (optional)
+            If given, completed visits are written to ``store`` in
+            chunks of ``store.chunk_size`` visits, and
+            :meth:`.get_queue_data` and :meth:`.get_agent_data` read
+            them back from it. Takes the place of ``sink``. A
+            :class:`.SQLiteDataStore` can also be queried with
+            :meth:`.query_data`.
+        sample_rate : float (optional)
+            If given, data is only collected on about this fraction of
+            the agents that enter the network at the selected queues.
+        every : int (optional)
+            If given, data is only collected on one in every ``every``
+            agents that enter the network at the selected queues.
+        ring_size : int (optional)
+            If given, each selected queue keeps only its latest
+            ``ring_size`` visits, in a :class:`.RingCollector` of its
+            own, and any data it had is dropped. Queues keep their ring
+            buffers when they stop and start collecting data again.
+            Ring buffers are not passed to ``sink`` or ``store``.
+
+        Raises
+        ------
+        ValueError
+            If both ``sample_rate`` and ``every`` are given, or either
+            is out of range.
+
+        Notes
+        -----
+        Whether data is collected on an agent is decided when it
+        enters the network, so either every visit of an agent is
+        recorded or none are. Agents already in the network are
+        decided when this method is called. The decision is a hash of
+        the agent's ``agent_id``, so sampling uses no random numbers
+        and doesn't change the simulation. The sampling settings stay
+        with the queues until they are changed; pass ``sample_rate=1``
+        to collect data on every agent again. See
+        :meth:`.get_agent_data` for the sampling weights.
+
+        Examples
+        --------
+        >>> import queueing_tool as qt
+        >>> g = qt.generate_pagerank_graph(100, seed=13)
+        >>> net = qt.QueueNetwork(g, seed=13)
+        >>> net.initialize(10)
+        >>> net.start_collecting_data(every=10)
+        >>> net.simulate(n=20000)
+        >>> data, weights = net.get_agent_data(return_weights=True)
+        >>> all(agent_id[1] % 10 == 0 for agent_id in data)
+        True
+        >>> set(weights.values())
+        {10.0}
         """
+        if sample_rate is not None and every is not None:
+            raise ValueError("Only one of sample_rate and every can be given.")
+        elif sample_rate is not None and not 0 < sample_rate <= 1:
+            raise ValueError("sample_rate must be in (0, 1].")
+        elif every is not None and not every >= 1:
+            raise ValueError("every must be a positive integer.")
+
         queues = _get_queues(self.g, queues, edge, edge_type)
 
         for k in queues:
-            self.edge2queue[k].collect_data = True
+            q = self.edge2queue[k]
+            if ring_size is not None:
+                self._data.clear([k])
+                q._data = RingCollector(ring_size)
+            q.collect_data = True
+
+        if sample_rate is not None or every is not None:
+            for k in queues:
+                q = self.edge2queue[k]
+                q._sample_rate = 1.0 if sample_rate is None else float(sample_rate)
+                q._sample_every = 1 if every is None else int(every)
+
+            for q in self.edge2queue:
+                for agents in (q._arrivals, q._departures, q.queue):
+                    for agent in agents:
+                        entry = self.edge2queue[agent.agent_id[0]]
+                        agent._sampled = _sampled(agent.agent_id, entry._sample_rate,
+                                                  entry._sample_every)
+
+        if store is not None:
+            self._store = store
+            sink, batch = store, store.chunk_size
+
+        if sink is not None:
+            self._data.sink = sink
+            self._data.batch = batch
+
+    def start_collecting_sojourns(self):
+        """Tells the network to keep statistics of the time agents
+        spend in it, starting now; see :meth:`.get_sojourns`.
+
+        The statistics are kept in constant memory. Any statistics the
+        network already had are reset.
+        """
+        self._sojourns.start(self._t)
+        self.collect_sojourns = True
+
+    def start_collecting_stats(self, queues=None, edge=None, edge_type=None,
+                               quantiles=None, rel_error=None):
+        """Tells the queues to keep running statistics, starting now.
+
+        Statistics are kept in constant memory, nothing is stored per
+        agent; see :meth:`.get_stats` and :meth:`.get_quantiles`. If
+        none of the parameters are given then every
+        :class:`.QueueServer` will start collecting statistics. Any
+        statistics the queues already had are reset.
+
+        Parameters
+        ----------
+        queues : :any:`int`, *array_like* (optional)
+            The edge index (or an iterable of edge indices) identifying
+            the :class:`QueueServer(s)<.QueueServer>` that will start
+            collecting statistics.
+        edge : 2-tuple of int or *array_like* (optional)
+            Explicitly specify which queues will collect statistics.
+            Must be either:
+
+            * A 2-tuple of the edge's source and target vertex
+              indices, or
+            * An iterable of 2-tuples of the edge's source and
+              target vertex indices.
+
+        edge_type : int or an iterable of int (optional)
+            A integer, or a collection of integers identifying which
+            edge types will collect statistics.
+        quantiles : bool (optional)
+            Whether the queues also keep sketches of the waiting and
+            sojourn times, see :meth:`.get_quantiles`. By default each
+            queue keeps its ``collect_quantiles`` setting.
+        rel_error : float (optional, default: ``0.01``)
+            The relative accuracy of the quantile sketches.
+        """
+        queues = _get_queues(self.g, queues, edge, edge_type)
+
+        for k in queues:
+            q = self.edge2queue[k]
+            q._stats.start(self._t, q, quantiles, rel_error)
+            q.collect_stats = True
+
+    def start_collecting_states(self, queues=None, edge=None, edge_type=None,
+                                compress=True):
+        """Tells the queues to log every change to ``num_system``,
+        starting now.
+
+        The logs hold one time and one integer per change, so time
+        averages over any window can be computed exactly without
+        storing data on agents; see :meth:`.time_average` and
+        :meth:`.occupancy_series`. If none of the parameters are given
+        then every :class:`.QueueServer` will start logging. Any log
+        the queues already had is thrown away.
+
+        Parameters
+        ----------
+        queues : :any:`int`, *array_like* (optional)
+            The edge index (or an iterable of edge indices) identifying
+            the :class:`QueueServer(s)<.QueueServer>` that will start
+            logging.
+        edge : 2-tuple of int or *array_like* (optional)
+            Explicitly specify which queues will start logging. Must be
+            either:
+
+            * A 2-tuple of the edge's source and target vertex
+              indices, or
+            * An iterable of 2-tuples of the edge's source and
+              target vertex indices.
+
+        edge_type : int or an iterable of int (optional)
+            A integer, or a collection of integers identifying which
+            edge types will start logging.
+        compress : bool (optional, default: ``True``)
+            Whether changes that happen at the same time are collapsed
+            into one record. It does not change any time average.
+        """
+        queues = _get_queues(self.g, queues, edge, edge_type)
+
+        for k in queues:
+            q = self.edge2queue[k]
+            q._states = StateLog(compress)
+            q._states.start(self._t, q.num_system)
+            q.collect_states = True
 
     def stop_collecting_data(self, queues=None, edge=None, edge_type=None):
         """Tells the queues to stop collecting data on agents.
@@ -1433,12 +2720,329 @@ class QueueNetwork(object):
         edge_type : int or an iterable of int (optional)
             A integer, or a collection of integers identifying which
             edge types will stop collecting data.
+
+        Notes
+        -----
+        Visits that are still in progress at these queues are marked
+        complete. If a ``sink`` was given to
+        :meth:`.start_collecting_data` then every completed visit is
+        passed to it, and once no queue is collecting data the
+        ``sink`` is removed.
         """
         queues = _get_queues(self.g, queues, edge, edge_type)
 
         for k in queues:
             self.edge2queue[k].collect_data = False
 
+        for collector, edges in self._collectors(queues):
+            collector.close(edges)
+        sink = self._data.sink
+        if sink is not None:
+            if self._data.num_done > 0:
+                sink(self._data.drain())
+            if not any(q.collect_data for q in self.edge2queue):
+                self._data.sink = None
+
+    def stop_collecting_sojourns(self):
+        """Tells the network to stop updating the statistics returned
+        by :meth:`.get_sojourns`.
+        """
+        self.collect_sojourns = False
+
+    def stop_collecting_stats(self, queues=None, edge=None, edge_type=None):
+        """Tells the queues to stop updating their statistics.
+
+        The statistics are kept up to the current time and are still
+        returned by :meth:`.get_stats`. If none of the parameters are
+        given then every :class:`.QueueServer` will stop collecting
+        statistics.
+
+        Parameters
+        ----------
+        queues : int, *array_like* (optional)
+            The edge index (or an iterable of edge indices) identifying
+            the :class:`QueueServer(s)<.QueueServer>` that will stop
+            collecting statistics.
+        edge : 2-tuple of int or *array_like* (optional)
+            Explicitly specify which queues will stop collecting
+            statistics. Must be either:
+
+            * A 2-tuple of the edge's source and target vertex
+              indices, or
+            * An iterable of 2-tuples of the edge's source and
+              target vertex indices.
+
+        edge_type : int or an iterable of int (optional)
+            A integer, or a collection of integers identifying which
+            edge types will stop collecting statistics.
+        """
+        queues = _get_queues(self.g, queues, edge, edge_type)
+
+        for k in queues:
+            q = self.edge2queue[k]
+            if q.collect_stats:
+                q._stats.stop(self._t, q)
+                q.collect_stats = False
+
+    def stop_collecting_states(self, queues=None, edge=None, edge_type=None):
+        """Tells the queues to stop logging changes to ``num_system``.
+
+        The logs end at the current time and are still used by
+        :meth:`.time_average` and :meth:`.occupancy_series`. If none of
+        the parameters are given then every :class:`.QueueServer` will
+        stop logging.
+
+        Parameters
+        ----------
+        queues : int, *array_like* (optional)
+            The edge index (or an iterable of edge indices) identifying
+            the :class:`QueueServer(s)<.QueueServer>` that will stop
+            logging.
+        edge : 2-tuple of int or *array_like* (optional)
+            Explicitly specify which queues will stop logging. Must be
+            either:
+
+            * A 2-tuple of the edge's source and target vertex
+              indices, or
+            * An iterable of 2-tuples of the edge's source and
+              target vertex indices.
+
+        edge_type : int or an iterable of int (optional)
+            A integer, or a collection of integers identifying which
+            edge types will stop logging.
+        """
+        queues = _get_queues(self.g, queues, edge, edge_type)
+
+        for k in queues:
+            q = self.edge2queue[k]
+            if q.collect_states:
+                q._states.stop(self._t)
+                q.collect_states = False
+
+    def time_average(self, metric='num_system', t0=None, t1=None,
+                     queues=None, edge=None, edge_type=None):
+        """Returns the exact time average of the state of each queue
+        over a window of time.
+
+        The averages are computed from the logs kept by the queues,
+        see :meth:`.start_collecting_states`. If none of ``queues``,
+        ``edge`` or ``edge_type`` are given then every queue is used.
+
+        Parameters
+        ----------
+        metric : str (optional, default: ``'num_system'``)
+            One of ``'num_system'``, ``'num_queued'`` (the number of
+            agents waiting for service), ``'num_busy'`` (the number of
+            agents in service), or ``'utilization'`` (``num_busy``
+            divided by ``num_servers``).
+        t0 : float (optional)
+            The start of the window. Defaults to the start of each
+            queue's log.
+        t1 : float (optional)
+            The end of the window. Defaults to the current time, or
+            the time a queue stopped logging.
+        queues : int or an *array_like* of int, (optional)
+            The edge index (or an iterable of edge indices) identifying
+            the :class:`QueueServer(s)<.QueueServer>` to use.
+        edge : 2-tuple of int or *array_like* (optional)
+            Explicitly specify which queues to use. Must be either:
+
+            * A 2-tuple of the edge's source and target vertex
+              indices, or
+            * An iterable of 2-tuples of the edge's source and
+              target vertex indices.
+
+        edge_type : int or an iterable of int (optional)
+            A integer, or a collection of integers identifying which
+            edge types to use.
+
+        Returns
+        -------
+        :class:`~numpy.ndarray`
+            An array with one entry per edge, indexed by edge index.
+            Queues that were not selected or have never logged their
+            state, and windows that do not overlap a log, are ``nan``.
+
+        Examples
+        --------
+        >>> import queueing_tool as qt
+        >>> g = qt.generate_pagerank_graph(100, seed=13)
+        >>> net = qt.QueueNetwork(g, seed=13)
+        >>> net.initialize(10)
+        >>> net.start_collecting_states()
+        >>> net.simulate(t=50)
+        >>> L = net.time_average('num_system', t0=10, t1=50)
+        >>> rho = net.time_average('utilization', t0=10, t1=50)
+        >>> bool((rho <= 1).all())
+        True
+        """
+        out = np.full(self.nE, np.nan)
+        for k in _get_queues(self.g, queues, edge, edge_type):
+            q = self.edge2queue[k]
+            if not q.collect_states and q._states.t_end == np.inf:
+                continue
+            out[k] = q._states.average(t0, t1, metric, q.num_servers, self._t)
+        return out
+
+    def _export(self, queues, edge, edge_type, window, batch_size):
+        # Yields the collected data as dicts of typed columns, reading
+        # the disk store first and then each collector in memory.
+        if batch_size is not None and batch_size < 1:
+            raise ValueError("batch_size must be a positive integer.")
+
+        queues = np.unique(list(_get_queues(self.g, queues, edge, edge_type))).astype(int)
+        edge_types = np.array([q.edge[3] for q in self.edge2queue], np.int32)
+        sources = self._collectors(queues)
+        if self._store is not None:
+            sources.insert(0, (self._store, queues))
+
+        for source, edges in sources:
+            if len(edges) == 0:
+                continue
+            for batch in source.batches(edges, window, batch_size):
+                batch['edge_type'] = edge_types[batch['edge']]
+                yield batch
+
+    def _export_all(self, *args):
+        # Joins the batches of _export into one, without copying when
+        # there is only one.
+        batches = list(self._export(*args + (None,)))
+        out = {}
+        for name in EXPORT_DTYPE.names:
+            cols = [b[name] for b in batches]
+            if len(cols) == 1:
+                out[name] = cols[0]
+            else:
+                out[name] = np.concatenate(cols + [np.zeros(0, EXPORT_DTYPE[name])])
+        return out
+
+    def to_arrow(self, queues=None, edge=None, edge_type=None, window=None,
+                 batch_size=None):
+        """Exports the collected data as a :class:`pyarrow.Table`.
+
+        The columns are the same as :meth:`.to_dataframe`. The arrow
+        arrays are built on the numpy columns without copying them.
+        Requires ``pyarrow``.
+
+        Parameters
+        ----------
+        queues : int or an *array_like* of int, (optional)
+            The edge index (or an iterable of edge indices) identifying
+            the :class:`QueueServer(s)<.QueueServer>` whose data will
+            be exported.
+        edge : 2-tuple of int or *array_like* (optional)
+            Explicitly specify which queues to export data from.
+        edge_type : int or an iterable of int (optional)
+            A integer, or a collection of integers identifying which
+            edge types to export data from.
+        window : 2-tuple of float (optional)
+            If given, only visits with an arrival time ``t`` where
+            ``window[0] <= t < window[1]`` are exported.
+        batch_size : int (optional)
+            If given, a :class:`pyarrow.RecordBatchReader` is returned
+            instead, which reads the data ``batch_size`` rows at a
+            time.
+
+        Returns
+        -------
+        :class:`pyarrow.Table` or :class:`pyarrow.RecordBatchReader`
+
+        Raises
+        ------
+        ImportError
+            If ``pyarrow`` is not installed.
+        """
+        if not HAS_PYARROW:
+            raise ImportError("pyarrow is necessary to export data to arrow.")
+
+        schema = pa.schema([(name, pa.from_numpy_dtype(EXPORT_DTYPE[name]))
+                            for name in EXPORT_DTYPE.names])
+
+        def record_batch(batch):
+            arrays = [pa.array(batch[name]) for name in EXPORT_DTYPE.names]
+            return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+        args = (queues, edge, edge_type, window)
+        if batch_size is not None:
+            batches = self._export(*args + (batch_size,))
+            return pa.RecordBatchReader.from_batches(schema, (record_batch(b) for b in batches))
+
+        return pa.Table.from_batches([record_batch(self._export_all(*args))], schema=schema)
+
+    def to_dataframe(self, queues=None, edge=None, edge_type=None, window=None,
+                     batch_size=None):
+        """Exports the collected data as a :class:`pandas.DataFrame`.
+
+        Unlike :meth:`.get_queue_data`, every column keeps its own
+        type and each visit's ``agent_id`` is included. The columns are
+        built straight from the collector's columns, so only the
+        selected rows are copied. Requires ``pandas``.
+
+        Parameters
+        ----------
+        queues : int or an *array_like* of int, (optional)
+            The edge index (or an iterable of edge indices) identifying
+            the :class:`QueueServer(s)<.QueueServer>` whose data will
+            be exported.
+        edge : 2-tuple of int or *array_like* (optional)
+            Explicitly specify which queues to export data from.
+        edge_type : int or an iterable of int (optional)
+            A integer, or a collection of integers identifying which
+            edge types to export data from.
+        window : 2-tuple of float (optional)
+            If given, only visits with an arrival time ``t`` where
+            ``window[0] <= t < window[1]`` are exported.
+        batch_size : int (optional)
+            If given, a generator is returned instead, which yields the
+            data as data frames of at most ``batch_size`` rows. Only
+            one batch is in memory at a time.
+
+        Returns
+        -------
+        :class:`pandas.DataFrame` or generator
+            The columns are:
+
+            * ``arrival``, ``service`` and ``departure``: The arrival,
+              service start and departure times, as ``float64``.
+            * ``num_queued`` and ``num_total``: The length of the
+              queue and the number of agents at the queue when the
+              agent arrived, as ``int32``.
+            * ``edge`` and ``edge_type``: The edge index and edge type
+              of the queue, as ``int32``.
+            * ``agent_edge`` and ``agent_num``: The two entries of the
+              agent's ``agent_id``, as ``int32`` and ``int64``.
+
+            Rows are in the order they were recorded, with the rows
+            in a :class:`.DiskDataStore` first.
+
+        Raises
+        ------
+        ImportError
+            If ``pandas`` is not installed.
+
+        Examples
+        --------
+        >>> import queueing_tool as qt
+        >>> g = qt.generate_pagerank_graph(100, seed=13)
+        >>> net = qt.QueueNetwork(g, seed=13)
+        >>> net.start_collecting_data()
+        >>> net.initialize(10)
+        >>> net.simulate(2000)
+        >>> df = net.to_dataframe(edge_type=(1, 3)) # doctest: +SKIP
+        >>> for df in net.to_dataframe(batch_size=500): # doctest: +SKIP
+        ...     pass
+        """
+        if not HAS_PANDAS:
+            raise ImportError("pandas is necessary to export data to a DataFrame.")
+
+        columns = list(EXPORT_DTYPE.names)
+        args = (queues, edge, edge_type, window)
+        if batch_size is not None:
+            batches = self._export(*args + (batch_size,))
+            return (pd.DataFrame(b, columns=columns, copy=False) for b in batches)
+
+        return pd.DataFrame(self._export_all(*args), columns=columns, copy=False)
+
     def transitions(self, return_matrix=True):
         """Returns the routing probabilities for each vertex in the
         graph.
@@ -1531,6 +3135,156 @@ class QueueNetwork(object):
 
         return mat
 
+    def warm_up(self, metric='num_system', queues=None, edge=None, edge_type=None,
+                batch_events=1000, min_batches=10, max_events=None, max_time=None):
+        """Simulates the network until its initial transient has
+        passed, then resets the statistics and data it has collected.
+
+        The network is simulated in batches of ``5 * batch_events``
+        events, and the mean of ``metric`` over each batch is found.
+        After each batch the MSER-5 rule, see
+        :func:`~queueing_tool.queues.stats.mser_truncation`, is applied
+        to the batch means. Once it places the end of the transient in
+        the first half of the run, the warm-up is over. The statistics
+        of the queues collecting statistics, the state logs, the
+        sojourn statistics and the collected data, as in
+        :meth:`.clear_data`, are then reset so they start from the
+        current time.
+
+        At most 200 batch means are kept; when there are more the
+        batches are merged in pairs and made twice as long.
+
+        Parameters
+        ----------
+        metric : str (optional, default: ``'num_system'``)
+            The quantity followed, one of ``'wait'``, ``'sojourn'``,
+            ``'num_system'`` or ``'num_queued'``; see the
+            ``until_precision`` argument of :meth:`.simulate`.
+        queues : int or an *array_like* of int, (optional)
+            The edge index (or an iterable of edge indices) identifying
+            the :class:`QueueServer(s)<.QueueServer>` followed.
+        edge : 2-tuple of int or *array_like* (optional)
+            Explicitly specify which queues are followed.
+        edge_type : int or an iterable of int (optional)
+            A integer, or a collection of integers identifying which
+            edge types are followed. By default every queue is.
+        batch_events : int (optional, default: ``1000``)
+            A fifth of the number of events in the first batches.
+        min_batches : int (optional, default: ``10``)
+            The fewest batches the MSER-5 rule is applied to.
+        max_events : int (optional)
+            The most events to simulate.
+        max_time : float (optional)
+            The most wall clock seconds to spend.
+
+        Returns
+        -------
+        dict
+            With the keys ``'detected'``, which is ``False`` if a
+            budget ran out first, in which case nothing is reset;
+            ``'truncation_time'`` and ``'truncation_events'``, the
+            simulation time and the number of events, since the call,
+            at which the transient was found to end; ``'num_events'``,
+            the number of events simulated; and ``'num_batches'``.
+
+        Raises
+        ------
+        QueueingToolError
+            Will raise a :exc:`.QueueingToolError` if the
+            ``QueueNetwork`` has not been initialized.
+
+        Notes
+        -----
+        Data already written to a ``sink`` or a store is not removed.
+
+        Examples
+        --------
+        >>> import queueing_tool as qt
+        >>> g = qt.generate_pagerank_graph(100, seed=13)
+        >>> net = qt.QueueNetwork(g, seed=13)
+        >>> net.initialize(10)
+        >>> net.start_collecting_stats()
+        >>> ans = net.warm_up(max_events=10**6)
+        >>> ans['detected']
+        True
+        >>> net.get_stats()['mean_num_system'].shape == (net.num_edges,)
+        True
+        """
+        if not self._initialized:
+            msg = ("Network has not been initialized. "
+                   "Call '.initialize()' first.")
+            raise QueueingToolError(msg)
+
+        _check_metric(metric)
+        queues = list(_get_queues(self.g, queues, edge, edge_type))
+        started = [k for k in queues if not self.edge2queue[k].collect_stats]
+        self.start_collecting_stats(queues=started)
+
+        totals, weights, times, events = [], [], [], []
+        scale, num_events, t0 = 1, 0, self._t
+        start = time.time()
+        total0, weight0 = self._precision_totals(queues, metric)
+        detected = False
+
+        try:
+            while True:
+                n = 5 * batch_events * scale
+                if max_events is not None:
+                    n = min(n, max_events - num_events)
+                if n <= 0 or (max_time is not None and time.time() - start >= max_time):
+                    break
+
+                self._run(n, None)
+                num_events += n
+                total, weight = self._precision_totals(queues, metric)
+                totals.append(total - total0)
+                weights.append(weight - weight0)
+                times.append(self._t)
+                events.append(num_events)
+                total0, weight0 = total, weight
+
+                if len(totals) == 200:
+                    totals = [a + b for a, b in zip(totals[::2], totals[1::2])]
+                    weights = [a + b for a, b in zip(weights[::2], weights[1::2])]
+                    times, events = times[1::2], events[1::2]
+                    scale *= 2
+
+                w = np.asarray(weights, float)
+                if len(w) >= min_batches and (w > 0).all():
+                    d = mser_truncation(np.asarray(totals) / w, batch=1)
+                    if d is not None:
+                        detected = True
+                        break
+        finally:
+            self._stop_monitoring(started)
+
+        out = {
+            'detected': detected,
+            'truncation_time': None,
+            'truncation_events': None,
+            'num_events': num_events,
+            'num_batches': len(totals)
+        }
+        if detected:
+            out['truncation_time'] = times[d - 1] if d > 0 else t0
+            out['truncation_events'] = events[d - 1] if d > 0 else 0
+            self._restart_collection()
+        return out
+
+    def _restart_collection(self):
+        # Starts everything the network is collecting over again, at
+        # the current time.
+        for k, q in enumerate(self.edge2queue):
+            if q.collect_stats:
+                q._stats.start(self._t, q)
+            if q.collect_states:
+                q._states = StateLog(q._states.compress)
+                q._states.start(self._t, q.num_system)
+
+        if self.collect_sojourns:
+            self._sojourns.start(self._t)
+        self.clear_data()
+
     def _update_all_colors(self):
         do = [True for v in range(self.nV)]
         for q in self.edge2queue:
@@ -1551,16 +3305,44 @@ class QueueNetwork(object):
                     self._update_vertex_color(q.edge[0])
                     do[q.edge[0]] = False
 
+    def _reset_counts(self):
+        # Recomputes the running totals kept by _update_counts.
+        self._total_agents = sum(self._num_agents)
+        self._type_agents = {}
+        self._vertex_agents = [0 for v in range(self.nV)]
+        self._queue_system = [q.num_system for q in self.edge2queue]
+
+        for q in self.edge2queue:
+            n = self._num_agents[q.edge[2]]
+            self._type_agents[q.edge[3]] = self._type_agents.get(q.edge[3], 0) + n
+            self._vertex_agents[q.edge[1]] += q.num_system
+
+    def _update_counts(self, q):
+        # Brings num_agents and the running totals up to date after an
+        # event at queue q, in constant time. The counts are kept in
+        # lists of ints, and num_agents is only made into an array when
+        # it is read.
+        e = q.edge[2]
+        d = q._num_total - self._num_agents[e]
+        if d:
+            self._num_agents[e] = q._num_total
+            self._total_agents += d
+            self._type_agents[q.edge[3]] += d
+
+        d = q.num_system - self._queue_system[e]
+        if d:
+            self._queue_system[e] = q.num_system
+            self._vertex_agents[q.edge[1]] += d
+
     def _update_vertex_color(self, v):
         ee = (v, v)
         ee_is_edge = self.g.is_edge(ee)
         eei = self.g.edge_index[ee] if ee_is_edge else 0
 
         if not ee_is_edge or (ee_is_edge and self.edge2queue[eei].edge[3] == 0):
-            nSy = 0
+            nSy = self._vertex_agents[v]
             cap = 0
             for ei in self.in_edges[v]:
-                nSy += self.edge2queue[ei].num_system
                 cap += self.edge2queue[ei].num_servers
 
             div = (2 * cap) + 2.
@@ -1602,6 +3384,54 @@ class QueueNetwork(object):
             self._update_vertex_color(v)
 
 
+_REPLICATE_JOB = None
+
+
+def _init_replicate(job):
+    global _REPLICATE_JOB
+    _REPLICATE_JOB = job
+
+
+def _replicate_worker(seed):
+    return _run_replication(_REPLICATE_JOB, seed)
+
+
+def _run_replication(job, seed):
+    """Runs one replication for :meth:`.QueueNetwork.replicate`."""
+    base, blob, n_events, t, collect = job
+    net = pickle.loads(blob) if blob is not None else base.copy()
+    net._reseed(seed)
+
+    if collect == 'queue_data' and not any(q.collect_data for q in net.edge2queue):
+        net.start_collecting_data()
+
+    if t is None:
+        net.simulate(n=n_events)
+    else:
+        net.simulate(t=t)
+
+    if collect == 'queue_data':
+        return net.get_queue_data()
+    elif collect != 'summary':
+        return collect(net)
+
+    qs = net.edge2queue
+    return {
+        'current_time': net.current_time,
+        'num_events': net.num_events,
+        'num_arrivals': [q.num_arrivals[0] for q in qs],
+        'num_departures': [q.num_departures for q in qs],
+        'num_system': [q.num_system for q in qs],
+        'num_blocked': [getattr(q, 'num_blocked', 0) for q in qs]
+    }
+
+
+def _check_metric(metric):
+    if metric not in RUN_METRICS:
+        msg = "metric must be one of {0}.".format(', '.join(repr(m) for m in RUN_METRICS))
+        raise ValueError(msg)
+
+
 def _get_queues(g, queues, edge, edge_type):
     """Used to specify edge indices from different types of arguments."""
     INT = numbers.Integral
@@ -0,0 +1,204 @@
+"""Binary traces of the events a :class:`.QueueNetwork` processes.
+
+A trace is a file of fixed width records, one for each event, with
+dtype :data:`TRACE_DTYPE`. They are written by
+:meth:`.QueueNetwork.record_trace` and checked against another run by
+:func:`verify_trace`.
+"""
+import os
+
+import numpy as np
+
+
+TRACE_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('edge', '<i4'),
+    ('event', '<i4'),
+    ('target', '<i4')
+])
+
+# The event column. An event is NOTHING when the queue that was
+# popped off the scheduler had nothing scheduled.
+NOTHING = 0
+ARRIVAL = 1
+DEPARTURE = 2
+BLOCKED = 3
+
+
+class _Diverged(Exception):
+    pass
+
+
+class TraceRecorder(object):
+    """Writes trace records to a file, ``buffer_size`` at a time.
+
+    Records are put in :attr:`records`, either by :meth:`append` or
+    directly by the compiled event loop, and :meth:`flush` writes the
+    first :attr:`pos` of them to the file.
+    """
+
+    def __init__(self, path, buffer_size=65536):
+        if buffer_size < 1:
+            raise ValueError("buffer_size must be a positive integer.")
+
+        self.records = np.zeros(buffer_size, TRACE_DTYPE)
+        self.pos = 0
+        self.num_records = 0
+        self._file = self._open(path)
+
+    def _open(self, path):
+        return open(path, 'wb')
+
+    def append(self, t, edge, event, target=-1):
+        if self.pos == len(self.records):
+            self.flush()
+        self.records[self.pos] = (t, edge, event, target)
+        self.pos += 1
+
+    def flush(self):
+        self._file.write(self.records[:self.pos].tobytes())
+        self.num_records += self.pos
+        self.pos = 0
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._file.close()
+
+
+class _TraceChecker(TraceRecorder):
+    # A recorder that compares its records with those in a trace file
+    # instead of writing them, and stops the simulation at the first
+    # record that differs.
+
+    def __init__(self, path, buffer_size=65536):
+        super(_TraceChecker, self).__init__(path, buffer_size)
+        if os.path.getsize(path) > 0:
+            self.expected = np.memmap(path, TRACE_DTYPE, mode='r')
+        else:
+            self.expected = np.zeros(0, TRACE_DTYPE)
+        self.divergence = None
+
+    def _open(self, path):
+        return None
+
+    def flush(self):
+        start = self.num_records
+        actual = self.records[:self.pos]
+        expected = self.expected[start:start + self.pos]
+
+        same = np.ones(self.pos, bool)
+        for name in TRACE_DTYPE.names:
+            same &= actual[name] == expected[name]
+
+        self.num_records += self.pos
+        self.pos = 0
+        if not same.all():
+            k = int(np.argmin(same))
+            self._diverge(start + k, actual[k])
+
+    def close(self):
+        # After a divergence the simulation was stopped part way
+        # through a buffer, so it isn't compared again.
+        try:
+            if self.divergence is None:
+                self.flush()
+                if self.num_records < len(self.expected):
+                    self._diverge(self.num_records, None)
+        except _Diverged:
+            pass
+
+    def _diverge(self, index, actual):
+        expected = self.expected[index] if index < len(self.expected) else None
+        self.divergence = {
+            'index': index,
+            'expected': None if expected is None else expected.item(),
+            'actual': None if actual is None else actual.item()
+        }
+        raise _Diverged()
+
+
+def read_trace(path):
+    """Reads a trace written by :meth:`.QueueNetwork.record_trace`.
+
+    Parameters
+    ----------
+    path : str
+        The trace file.
+
+    Returns
+    -------
+    :class:`~numpy.ndarray`
+        A record array with one entry per event and the fields:
+
+        * ``time``: The time of the event.
+        * ``edge``: The edge index of the queue the event happened at.
+        * ``event``: ``1`` for an arrival from outside the network,
+          ``2`` for a departure, ``3`` for a departure that was
+          blocked and ``0`` if the queue had nothing scheduled.
+        * ``target``: The edge index the departing agent was routed
+          to, or ``-1``.
+    """
+    return np.fromfile(path, TRACE_DTYPE)
+
+
+def verify_trace(net, path, compiled=None, buffer_size=65536):
+    """Simulates ``net`` and checks that it goes through the events in
+    a trace, one by one.
+
+    ``net`` must be in the state the traced network was in when
+    :meth:`.QueueNetwork.record_trace` was called; for example built
+    and initialized the same way, after seeding numpy with the same
+    seed. It is simulated forward, in place, for as many events as are
+    in the trace. Events are compared ``buffer_size`` at a time, and
+    the simulation stops once a batch of events differs from the
+    trace.
+
+    Parameters
+    ----------
+    net : :class:`.QueueNetwork`
+        An initialized network.
+    path : str
+        The trace file.
+    compiled : bool (optional)
+        Whether to use the compiled event loop. If it is ``None`` then
+        the same choice as :meth:`.QueueNetwork.simulate` is made.
+    buffer_size : int (optional, default: ``65536``)
+        The number of events compared at once.
+
+    Returns
+    -------
+    dict or ``None``
+        ``None`` if ``net`` went through the same events as the trace.
+        Otherwise a dict with the ``index`` of the first event that
+        differs and the ``expected`` and ``actual`` records, as tuples;
+        ``actual`` is ``None`` if ``net`` ran out of events.
+
+    Examples
+    --------
+    Check that the compiled event loop goes through the same events as
+    the Python one:
+
+    >>> import os, tempfile
+    >>> import queueing_tool as qt
+    >>> g = qt.generate_pagerank_graph(100, seed=13)
+    >>> path = os.path.join(tempfile.mkdtemp(), 'trace.bin')
+    >>> net = qt.QueueNetwork(g, seed=13)
+    >>> net.initialize(10)
+    >>> net.record_trace(path, n=20000, compiled=False)
+    >>> net = qt.QueueNetwork(g, seed=13)
+    >>> net.initialize(10)
+    >>> qt.verify_trace(net, path, compiled=True) is None
+    True
+    """
+    checker = _TraceChecker(path, buffer_size)
+    net._trace = checker
+    try:
+        net._run(len(checker.expected), None, compiled)
+    except _Diverged:
+        pass
+    finally:
+        net._trace = None
+        checker.close()
+    return checker.divergence
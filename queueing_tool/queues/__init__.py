@@ -3,15 +3,24 @@
     :nosignatures:
 
     Agent
+    DataCollector
+    DiskDataStore
+    Distribution
+    Exponential
+    Gamma
     InfoAgent
     InfoQueue
     GreedyAgent
     LossQueue
     NullQueue
     poisson_random_measure
+    QuantileSketch
     QueueServer
     ResourceAgent
     ResourceQueue
+    RingCollector
+    SQLiteDataStore
+    Uniform
 """
 
 from queueing_tool.queues.queue_servers import (
@@ -20,6 +29,19 @@ from queueing_tool.queues.queue_servers import (
     NullQueue,
     poisson_random_measure
 )
+from queueing_tool.queues.collector import (
+    DataCollector,
+    DiskDataStore,
+    RingCollector,
+    SQLiteDataStore
+)
+from queueing_tool.queues.distributions import (
+    Distribution,
+    Exponential,
+    Gamma,
+    Uniform
+)
+from queueing_tool.queues.sketch import QuantileSketch
 from queueing_tool.queues.agents import (
     Agent,
     GreedyAgent
@@ -41,5 +63,14 @@ __all__ = [
     'Agent',
     'GreedyAgent',
     'InfoAgent',
-    'ResourceAgent'
+    'ResourceAgent',
+    'DataCollector',
+    'DiskDataStore',
+    'RingCollector',
+    'SQLiteDataStore',
+    'Distribution',
+    'Exponential',
+    'Gamma',
+    'Uniform',
+    'QuantileSketch'
 ]
@@ -0,0 +1,19 @@
+from cpython cimport array
+
+
+cdef class AgentHeap:
+
+    cdef array.array array_times, array_seqs
+    cdef double [::1] times
+    cdef long [::1] seqs
+    cdef public list agents
+    cdef public long counter
+    cdef Py_ssize_t capacity
+
+    cpdef push(self, object agent)
+    cpdef object pop(self)
+    cdef int _append(self, double t, long seq, object agent) except -1
+    cdef int _reserve(self, Py_ssize_t n) except -1
+    cdef bint _less(self, Py_ssize_t a, Py_ssize_t b) nogil
+    cdef void _siftdown(self, Py_ssize_t startpos, Py_ssize_t pos)
+    cdef void _siftup(self, Py_ssize_t pos)
@@ -0,0 +1,206 @@
+cimport cython
+from cpython cimport array
+import array
+
+from libc.math cimport INFINITY
+
+
+def _rebuild(times, seqs, agents, counter):
+    cdef AgentHeap heap = AgentHeap()
+    cdef Py_ssize_t k
+
+    for k in range(len(agents)):
+        heap._append(times[k], seqs[k], agents[k])
+    heap.counter = counter
+    return heap
+
+
+cdef class AgentHeap:
+    """A heap of agents ordered by their ``_time`` attribute.
+
+    Each agent's time is copied into a C array when the agent is
+    pushed, so the heap never calls :meth:`.Agent.__lt__`. Agents with
+    the same time come out in the order they were pushed.
+
+    Parameters
+    ----------
+    agents : iterable (optional)
+        Agents to push onto the heap.
+
+    Notes
+    -----
+    An agent's ``_time`` should not be changed while the agent is in
+    the heap. Pop it, change the time, and push it back instead.
+    """
+
+    def __init__(self, agents=None):
+        self.agents = []
+        self.counter = 0
+        self.capacity = 0
+        self._reserve(4)
+
+        if agents is not None:
+            for agent in agents:
+                self.push(agent)
+
+    def __len__(self):
+        return len(self.agents)
+
+    def __iter__(self):
+        return iter(list(self.agents))
+
+    def __getitem__(self, Py_ssize_t k):
+        return self.agents[k]
+
+    def __reduce__(self):
+        n = len(self.agents)
+        times = [self.times[k] for k in range(n)]
+        seqs = [self.seqs[k] for k in range(n)]
+        return (_rebuild, (times, seqs, list(self.agents), self.counter))
+
+    def __repr__(self):
+        return "AgentHeap: {0} agents, next time: {1}".format(len(self.agents), self.next_time)
+
+    @property
+    def next_time(self):
+        """The time of the first agent, or ``inf`` if the heap is
+        empty.
+        """
+        return self.times[0] if len(self.agents) > 0 else INFINITY
+
+    def peek(self):
+        """Returns the first agent without removing it, or ``None`` if
+        the heap is empty.
+        """
+        return self.agents[0] if len(self.agents) > 0 else None
+
+    def clear(self):
+        """Removes every agent from the heap."""
+        self.agents = []
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cpdef push(self, object agent):
+        """Pushes ``agent`` onto the heap, keyed by its ``_time``."""
+        self._append(agent._time, self.counter, agent)
+        self.counter += 1
+        self._siftdown(0, len(self.agents) - 1)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cpdef object pop(self):
+        """Removes and returns the agent with the smallest time.
+
+        Raises
+        ------
+        IndexError
+            If the heap is empty.
+        """
+        cdef Py_ssize_t n = len(self.agents)
+        cdef object last, first
+
+        if n == 0:
+            raise IndexError("pop from an empty heap")
+
+        last = self.agents.pop()
+        n -= 1
+        if n == 0:
+            return last
+
+        first = self.agents[0]
+        self.agents[0] = last
+        self.times[0] = self.times[n]
+        self.seqs[0] = self.seqs[n]
+        self._siftup(0)
+        return first
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int _append(self, double t, long seq, object agent) except -1:
+        # Appends without sifting; used when the order is already a
+        # valid heap.
+        cdef Py_ssize_t n = len(self.agents)
+
+        if n == self.capacity:
+            self._reserve(2 * self.capacity)
+
+        self.times[n] = t
+        self.seqs[n] = seq
+        self.agents.append(agent)
+        return 0
+
+    cdef int _reserve(self, Py_ssize_t n) except -1:
+        if n <= self.capacity:
+            return 0
+
+        if self.capacity == 0:
+            self.array_times = array.array('d', [0.0] * n)
+            self.array_seqs = array.array('l', [0] * n)
+        else:
+            array.resize_smart(self.array_times, n)
+            array.resize_smart(self.array_seqs, n)
+
+        self.times = self.array_times
+        self.seqs = self.array_seqs
+        self.capacity = n
+        return 0
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline bint _less(self, Py_ssize_t a, Py_ssize_t b) nogil:
+        if self.times[a] < self.times[b]:
+            return True
+        return self.times[a] == self.times[b] and self.seqs[a] < self.seqs[b]
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _siftdown(self, Py_ssize_t startpos, Py_ssize_t pos):
+        cdef double newtime = self.times[pos]
+        cdef long newseq = self.seqs[pos]
+        cdef object newagent = self.agents[pos]
+        cdef Py_ssize_t parentpos
+
+        while pos > startpos:
+            parentpos = (pos - 1) >> 1
+            if newtime < self.times[parentpos] or \
+                    (newtime == self.times[parentpos] and newseq < self.seqs[parentpos]):
+                self.times[pos] = self.times[parentpos]
+                self.seqs[pos] = self.seqs[parentpos]
+                self.agents[pos] = self.agents[parentpos]
+                pos = parentpos
+                continue
+            break
+
+        self.times[pos] = newtime
+        self.seqs[pos] = newseq
+        self.agents[pos] = newagent
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _siftup(self, Py_ssize_t pos):
+        cdef Py_ssize_t endpos = len(self.agents)
+        cdef Py_ssize_t startpos = pos
+        cdef Py_ssize_t childpos, rightpos
+        cdef double newtime = self.times[pos]
+        cdef long newseq = self.seqs[pos]
+        cdef object newagent = self.agents[pos]
+
+        # Bubble up the smaller child until hitting a leaf.
+        childpos = 2 * pos + 1
+        while childpos < endpos:
+            rightpos = childpos + 1
+            if rightpos < endpos and not self._less(childpos, rightpos):
+                childpos = rightpos
+
+            self.times[pos] = self.times[childpos]
+            self.seqs[pos] = self.seqs[childpos]
+            self.agents[pos] = self.agents[childpos]
+            pos = childpos
+            childpos = 2 * pos + 1
+
+        # The leaf at pos is empty now. Put the item there and sift it
+        # back towards startpos.
+        self.times[pos] = newtime
+        self.seqs[pos] = newseq
+        self.agents[pos] = newagent
+        self._siftdown(startpos, pos)
@@ -1,7 +1,4 @@
-from numpy import infty
-from numpy.random import uniform
-
-from queueing_tool.queues.choice import _choice, _argmin
+from queueing_tool.queues.choice import _alias_choice, _argmin
 
 
 class Agent(object):
@@ -39,6 +36,11 @@ class Agent(object):
         self.agent_id = agent_id
         self.blocked = 0
         self._time = 0  # The agents arrival or departure time
+        self._row = -1  # The agents latest row in a DataCollector
+        self._arrival = -1  # The time the agent arrived at its queue
+        self._entered = -1  # The time the agent entered the network
+        self._hops = 0  # The number of queues the agent has left
+        self._sampled = True  # Whether queues collect data on the agent
 
     def __repr__(self):
         return "Agent; agent_id:{0}. time: {1}".format(self.agent_id, round(self._time, 3))
@@ -100,12 +102,13 @@ class Agent(object):
         if n <= 1:
             return network.out_edges[edge[1]][0]
 
-        u = uniform()
-        pr = network._route_probs[edge[1]]
-        k = _choice(pr, u, n)
+        u = network._uniforms.sample()
+        prob, alias = network._route_alias[edge[1]]
+        k = _alias_choice(prob, alias, u, n)
 
-        # _choice returns an integer between 0 and n-1 where the
-        # probability of k being selected is equal to pr[k].
+        # _alias_choice returns an integer between 0 and n-1 where the
+        # probability of k being selected is the transition probability
+        # of the k-th out edge.
         return network.out_edges[edge[1]][k]
 
     def queue_action(self, queue, *args, **kwargs):
@@ -165,25 +168,3 @@ class GreedyAgent(Agent):
         adjacent_edges = network.out_edges[edge[1]]
         d = _argmin([network.edge2queue[d].number_queued() for d in adjacent_edges])
         return adjacent_edges[d]
-
-
-class InftyAgent(object):
-    """An special agent that only operates within the
-    :class:`.QueueServer` class.
-
-    This agent never interacts with the :class:`.QueueNetwork`.
-    """
-    def __init__(self):
-        self._time = infty
-
-    def __repr__(self):
-        return "InftyAgent"
-
-    def __lt__(self, b):
-        return self._time < b._time
-
-    def __gt__(self, b):
-        return self._time > b._time
-
-    def __eq__(self, b):
-        return self._time == b._time
@@ -36,3 +36,85 @@ def _argmin(list a):
             minv = v
             amin = k
     return amin + 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+@cython.cdivision(True)
+def _alias_table(double [::1] pr):
+    """Builds a Walker alias table for the probabilities in ``pr``
+    using Vose's method.
+
+    Returns a pair of arrays ``(prob, alias)``. See :func:`_alias_choice`.
+    """
+    cdef Py_ssize_t n = pr.shape[0]
+    cdef Py_ssize_t k, s, g, num_small = 0, num_large = 0
+    cdef double total = 0
+
+    prob = array.array('d', [1.0 for k in range(n)])
+    alias = array.array('i', [k for k in range(n)])
+    cdef double [::1] p = prob
+    cdef int [::1] a = alias
+    cdef double [::1] scaled = array.array('d', [0.0 for k in range(n)])
+    cdef int [::1] small = array.array('i', [0 for k in range(n)])
+    cdef int [::1] large = array.array('i', [0 for k in range(n)])
+
+    for k in range(n):
+        total += pr[k]
+
+    if total <= 0:
+        return prob, alias
+
+    for k in range(n):
+        scaled[k] = pr[k] * n / total
+        if scaled[k] < 1:
+            small[num_small] = k
+            num_small += 1
+        else:
+            large[num_large] = k
+            num_large += 1
+
+    while num_small > 0 and num_large > 0:
+        num_small -= 1
+        s = small[num_small]
+        num_large -= 1
+        g = large[num_large]
+
+        p[s] = scaled[s]
+        a[s] = g
+        scaled[g] = (scaled[g] + scaled[s]) - 1
+
+        if scaled[g] < 1:
+            small[num_small] = g
+            num_small += 1
+        else:
+            large[num_large] = g
+            num_large += 1
+
+    # Whatever is left over is only off from 1 by rounding error.
+    for k in range(num_small):
+        p[small[k]] = 1.0
+    for k in range(num_large):
+        p[large[k]] = 1.0
+
+    return prob, alias
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def _alias_choice(double [::1] prob, int [::1] alias, double u, Py_ssize_t n):
+    """Returns an index between ``0`` and ``n - 1``, chosen with the
+    probabilities used to build the alias table ``(prob, alias)``.
+    ``u`` is a uniform random number on ``[0, 1)``.
+    """
+    cdef double x = u * n
+    cdef Py_ssize_t k = <Py_ssize_t> x
+
+    if k >= n:
+        k = n - 1
+
+    if x - k < prob[k]:
+        return k
+    return alias[k]
@@ -0,0 +1,886 @@
+import array
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+
+def _group_by_agent(dat, ids):
+    # Sorts the six column rows in dat by agent and then by arrival,
+    # and splits them at the agent boundaries.
+    keys = tuple(dat[:, ::-1].T) + (ids[:, 1], ids[:, 0])
+    order = np.lexsort(keys)
+    dat = dat[order]
+    ids = ids[order]
+
+    new = np.flatnonzero((np.diff(ids, axis=0) != 0).any(axis=1)) + 1
+    starts = np.concatenate(([0], new)).astype(int) if len(dat) > 0 else new
+    offsets = np.append(starts, len(dat))
+    return ids[starts], offsets, dat
+
+
+def _sampled(agent_id, rate, every):
+    # Whether data is collected on the agent with agent_id when the
+    # queue it entered at keeps a fraction rate, or one in every, of
+    # its agents. The fraction is chosen with a splitmix64 hash of the
+    # id rather than random draws, so sampling doesn't change the
+    # simulation and the same agents are picked every time.
+    if every > 1:
+        return agent_id[1] % every == 0
+
+    mask = 0xFFFFFFFFFFFFFFFF
+    z = (agent_id[0] * 0x9E3779B97F4A7C15 + agent_id[1] + 0x632BE59BD9B4E019) & mask
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & mask
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & mask
+    return (z ^ (z >> 31)) < rate * 2.0**64
+
+
+def _in_window(arrival, window):
+    if window is None:
+        return np.ones(len(arrival), bool)
+    return (arrival >= window[0]) & (arrival < window[1])
+
+
+def _keep(dat, edges, window):
+    # Which of the six column rows in dat are from the queues on edges
+    # and arrived in window.
+    keep = _in_window(dat[:, 0], window)
+    if edges is not None:
+        keep &= np.isin(dat[:, 5], np.asarray(edges, int))
+    return keep
+
+
+class DataCollector(object):
+    """Stores the data queues collect on agents in typed columns.
+
+    Each time an agent arrives at a queue that is collecting data one
+    row is appended. The row's id is kept on the agent, so the service
+    start and departure times are filled in without any lookups. A
+    collector can be used by a single :class:`.QueueServer` or shared
+    by every queue in a :class:`.QueueNetwork`; the ``edge`` column
+    says which queue a row belongs to.
+
+    The columns are growable :mod:`array` arrays, which take 49 bytes
+    per row in total. :meth:`column` returns a column as a
+    :class:`~numpy.ndarray`.
+
+    A row is complete once the agent has left the queue. Complete rows
+    can be removed with :meth:`drain`, which returns them as a record
+    array. If ``sink`` is set, it is called with a record array each
+    time ``batch`` rows are complete, so long runs can stream their
+    data elsewhere instead of keeping it in memory.
+
+    Attributes
+    ----------
+    arrival : :class:`~array.array`
+        The arrival time of the agent.
+    service : :class:`~array.array`
+        The time the agent started service, or ``0``.
+    departure : :class:`~array.array`
+        The time the agent departed, or ``0``.
+    num_queued : :class:`~array.array`
+        The number of agents waiting for service when the agent
+        arrived, including the agent.
+    num_total : :class:`~array.array`
+        The number of agents in the queue when the agent arrived,
+        including the agent.
+    agent_edge : :class:`~array.array`
+        The first entry of the agent's ``agent_id``.
+    agent_num : :class:`~array.array`
+        The second entry of the agent's ``agent_id``.
+    edge : :class:`~array.array`
+        The edge index of the queue, or ``-1`` if the row has been
+        cleared.
+    done : :class:`~array.array`
+        ``1`` if the row is complete, otherwise ``0``.
+    sink : function or ``None``
+        Called with the record array of every ``batch`` complete rows.
+    batch : int
+        How many complete rows are passed to ``sink`` at once.
+    version : int
+        Goes up each time the collector's rows change, so views built
+        from them know when to be rebuilt.
+    """
+
+    columns = (
+        'arrival',
+        'service',
+        'departure',
+        'num_queued',
+        'num_total',
+        'agent_edge',
+        'agent_num',
+        'edge',
+        'done'
+    )
+
+    dtype = np.dtype([
+        ('arrival', np.float64),
+        ('service', np.float64),
+        ('departure', np.float64),
+        ('num_queued', np.int32),
+        ('num_total', np.int32),
+        ('edge', np.int32),
+        ('agent_edge', np.int32),
+        ('agent_num', np.int64)
+    ])
+
+    _typecodes = {
+        'arrival': 'd',
+        'service': 'd',
+        'departure': 'd',
+        'num_queued': 'i',
+        'num_total': 'i',
+        'agent_edge': 'i',
+        'agent_num': 'q',
+        'edge': 'i',
+        'done': 'b'
+    }
+
+    def __init__(self, sink=None, batch=4096):
+        self.sink = sink
+        self.batch = batch
+        self.version = 0
+        self._base = 0
+        self._groups = None
+        self._reset()
+
+    def __len__(self):
+        return self._live
+
+    def __repr__(self):
+        return 'DataCollector: {0} rows'.format(self._live)
+
+    def _reset(self):
+        # Row ids keep increasing, so ids held by agents never point at
+        # a newer row.
+        self._base += len(getattr(self, 'edge', ()))
+        for name in self.columns:
+            setattr(self, name, array.array(self._typecodes[name]))
+        self.version += 1
+        self._live = 0
+        self._num_done = 0
+        self._moved = {}
+
+    @property
+    def num_done(self):
+        """The number of complete rows that have not been drained."""
+        return self._num_done
+
+    def append(self, agent, edge, arrival, num_queued, num_total,
+               service=0, departure=0, done=False):
+        """Appends a row for ``agent`` arriving at the queue on
+        ``edge`` and returns the row's index. If ``done`` is ``True``
+        the row is already complete. Agents that were not sampled for
+        data collection are skipped and ``-1`` is returned.
+        """
+        if not getattr(agent, '_sampled', True):
+            return -1
+
+        row = len(self.edge)
+        self.arrival.append(arrival)
+        self.service.append(service)
+        self.departure.append(departure)
+        self.num_queued.append(num_queued)
+        self.num_total.append(num_total)
+        self.agent_edge.append(agent.agent_id[0])
+        self.agent_num.append(agent.agent_id[1])
+        self.edge.append(edge)
+        self.done.append(0)
+        self.version += 1
+        self._live += 1
+        agent._row = self._base + row
+        if done:
+            self._complete(row)
+        return row
+
+    def serve(self, row, t):
+        """Sets the time ``row``'s agent started service."""
+        self.service[row] = t
+        self.version += 1
+
+    def depart(self, row, t):
+        """Sets the departure time of ``row`` and marks it complete."""
+        self.departure[row] = t
+        self.version += 1
+        if not self.done[row]:
+            self._complete(row)
+
+    def _complete(self, row):
+        self.done[row] = 1
+        self._num_done += 1
+        if self.sink is not None and self._num_done >= self.batch:
+            self.sink(self.drain(self.batch))
+
+    def find(self, agent, edge):
+        """Returns the index of ``agent``'s latest row if it was
+        written by the queue on ``edge``, otherwise ``-1``.
+        """
+        row = getattr(agent, '_row', -1)
+        if row < self._base and row in self._moved:
+            row = agent._row = self._moved.pop(row)
+
+        row -= self._base
+        if 0 <= row < len(self.edge) and self.edge[row] == edge and \
+                self.agent_num[row] == agent.agent_id[1] and \
+                self.agent_edge[row] == agent.agent_id[0]:
+            return row
+        return -1
+
+    def column(self, name):
+        """Returns a copy of the column ``name`` as a
+        :class:`~numpy.ndarray`. Cleared rows are included, their
+        ``edge`` is ``-1``.
+        """
+        return self._view(name).copy()
+
+    def _view(self, name):
+        # A view of the column's memory. The column can't grow while
+        # the view is alive, so views must not outlive the caller.
+        col = getattr(self, name)
+        if len(col) == 0:
+            return np.zeros(0, np.dtype(self._typecodes[name]))
+        return np.frombuffer(col, np.dtype(self._typecodes[name]))
+
+    def rows(self, edges=None):
+        """Returns the indices of the rows written by the queues on
+        ``edges``, or of every row that has not been cleared.
+        """
+        edge = self._view('edge')
+        if edges is None:
+            return np.flatnonzero(edge >= 0)
+        return np.flatnonzero(np.isin(edge, np.asarray(edges, int)))
+
+    def edge_rows(self, edge):
+        """Returns the indices of the rows written by the queue on
+        ``edge``, in the order they were appended.
+
+        The rows are grouped by edge with one sort, which is kept until
+        the collector changes, so reading the rows of every queue in
+        turn only looks at each row once.
+        """
+        if self._groups is None or self._groups[0] != self.version:
+            edge_col = self._view('edge')
+            order = np.argsort(edge_col, kind='stable')
+            edges, starts = np.unique(edge_col[order], return_index=True)
+            self._groups = (self.version, order, edges, np.append(starts, len(order)))
+            del edge_col
+
+        version, order, edges, starts = self._groups
+        k = np.searchsorted(edges, edge)
+        if k == len(edges) or edges[k] != edge or edge < 0:
+            return order[:0]
+        return order[starts[k]:starts[k + 1]]
+
+    def fetch(self, edges=None):
+        """Returns the rows of the queues on ``edges`` (or every row)
+        as a six column array, sorted by arrival time.
+
+        The columns are the same as :meth:`.QueueServer.fetch_data`.
+        """
+        dat = self._gather(self.rows(edges))
+        order = np.lexsort(dat[:, ::-1].T)
+        return dat[order]
+
+    def batches(self, edges=None, window=None, batch_size=None):
+        """Yields the rows of the queues on ``edges`` (or every row)
+        that arrived in ``window``, ``batch_size`` rows at a time.
+
+        Each batch is a dict that maps the names in :attr:`dtype` to a
+        contiguous :class:`~numpy.ndarray` of that type. The rows are
+        copied straight out of the collector's columns, in the order
+        they were appended, and one batch is copied at a time. If
+        ``batch_size`` is ``None`` then every row is in one batch.
+
+        The collector must not change while the batches are read.
+        """
+        rows = self.rows(edges)
+        rows = rows[_in_window(self._view('arrival')[rows], window)]
+        size = batch_size or max(len(rows), 1)
+        for k in range(0, len(rows), size):
+            part = rows[k:k + size]
+            yield dict((name, self._view(name)[part]) for name in self.dtype.names)
+
+    def by_agent(self, edges=None):
+        """Returns the rows of the queues on ``edges`` (or every row)
+        grouped by agent.
+
+        Returns
+        -------
+        agent_ids : :class:`~numpy.ndarray`
+            A two column array with the ``agent_id`` of each agent, in
+            increasing order.
+        offsets : :class:`~numpy.ndarray`
+            An array with one more entry than ``agent_ids``. The rows
+            of the ``k``-th agent are ``data[offsets[k]:offsets[k+1]]``.
+        data : :class:`~numpy.ndarray`
+            A six column array with the same columns as :meth:`fetch`.
+            Each agent's rows are sorted by arrival time.
+        """
+        rows = self.rows(edges)
+        return _group_by_agent(self._gather(rows), self._agent_ids(rows))
+
+    def _agent_ids(self, rows):
+        ids = np.zeros((len(rows), 2), np.int64)
+        ids[:, 0] = self._view('agent_edge')[rows]
+        ids[:, 1] = self._view('agent_num')[rows]
+        return ids
+
+    def _gather(self, rows):
+        dat = np.zeros((len(rows), 6))
+        if len(rows) == 0:
+            return dat
+
+        for k, name in enumerate(('arrival', 'service', 'departure',
+                                  'num_queued', 'num_total', 'edge')):
+            dat[:, k] = self._view(name)[rows]
+        return dat
+
+    def drain(self, n=None):
+        """Removes up to ``n`` complete rows (or all of them) and
+        returns them as a record array with dtype :attr:`dtype`.
+
+        The rows are returned in the order they were appended.
+        """
+        edge = self._view('edge')
+        rows = np.flatnonzero((self._view('done') == 1) & (edge >= 0))
+        if n is not None:
+            rows = rows[:n]
+
+        records = np.zeros(len(rows), self.dtype)
+        for name in self.dtype.names:
+            records[name] = self._view(name)[rows]
+
+        edge[rows] = -1
+        self.version += 1
+        self._live -= len(rows)
+        self._num_done -= len(rows)
+        del edge
+        self._compact()
+        return records
+
+    def close(self, edges=None):
+        """Marks the rows of the queues on ``edges`` (or every row) as
+        complete, whether or not the agent has departed.
+        """
+        done = self._view('done')
+        rows = self.rows(edges)
+        rows = rows[done[rows] == 0]
+        done[rows] = 1
+        self.version += 1
+        self._num_done += len(rows)
+
+    def clear(self, edges=None):
+        """Removes the rows written by the queues on ``edges``, or every
+        row.
+        """
+        if edges is None or self._live == 0:
+            self._reset()
+            return
+
+        edge = self._view('edge')
+        rows = self.rows(edges)
+        edge[rows] = -1
+        self.version += 1
+        self._live -= len(rows)
+        self._num_done -= int(np.sum(self._view('done')[rows]))
+        del edge
+        self._compact()
+
+    def _compact(self):
+        # Drops the rows that have been drained or cleared once they
+        # make up half of the columns. The remaining rows get new ids,
+        # and agents holding an old id are moved over in find.
+        size = len(self.edge)
+        if self._live == 0:
+            self._reset()
+            return
+        elif size < 1024 or size < 2 * self._live:
+            return
+
+        live = self.rows()
+        for name in self.columns:
+            col = self._view(name)[live]
+            setattr(self, name, array.array(self._typecodes[name], col.tobytes()))
+
+        old_ids = (live + self._base).tolist()
+        self._base += size
+        new_ids = range(self._base, self._base + len(live))
+        moved = dict(zip(old_ids, new_ids))
+        for old, new in self._moved.items():
+            if new in moved:
+                moved[old] = moved.pop(new)
+        self._moved = moved
+
+
+class RingCollector(DataCollector):
+    """A :class:`.DataCollector` that keeps only the latest ``size``
+    rows.
+
+    The columns are allocated once, with ``size`` rows, and used as a
+    circular buffer: each new row overwrites the oldest one, so the
+    memory used stays fixed however long the simulation runs.
+    :meth:`rows` returns the rows in the order they were appended.
+
+    Parameters
+    ----------
+    size : int
+        The number of rows kept.
+
+    Examples
+    --------
+    >>> import queueing_tool as qt
+    >>> q = qt.QueueServer(collect_data='ring', ring_size=100, seed=2)
+    >>> q.set_active()
+    >>> q.simulate(n=5000)
+    >>> data = q.fetch_data()
+    >>> data.shape
+    (100, 6)
+    >>> bool((data[:, 0] == sorted(data[:, 0])).all())
+    True
+    """
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("size must be a positive integer.")
+
+        self.size = size
+        self._next = 0
+        super(RingCollector, self).__init__()
+
+    def __repr__(self):
+        return 'RingCollector: {0} of {1} rows'.format(self._live, self.size)
+
+    def _reset(self):
+        for name in self.columns:
+            col = array.array(self._typecodes[name], [0]) * self.size
+            setattr(self, name, col)
+        self.edge = array.array('i', [-1]) * self.size
+        # The id of the row in each slot; ids keep increasing so that
+        # agents holding an overwritten id are not matched.
+        self.row_id = array.array('q', [-1]) * self.size
+        self.version += 1
+        self._live = 0
+        self._num_done = 0
+        self._moved = {}
+
+    def append(self, agent, edge, arrival, num_queued, num_total,
+               service=0, departure=0, done=False):
+        """Writes a row for ``agent`` arriving at the queue on
+        ``edge`` over the oldest row, and returns the row's index.
+
+        See :meth:`.DataCollector.append`.
+        """
+        if not getattr(agent, '_sampled', True):
+            return -1
+
+        row = self._next % self.size
+        if self.edge[row] >= 0:
+            self._live -= 1
+            self._num_done -= self.done[row]
+
+        self.arrival[row] = arrival
+        self.service[row] = service
+        self.departure[row] = departure
+        self.num_queued[row] = num_queued
+        self.num_total[row] = num_total
+        self.agent_edge[row] = agent.agent_id[0]
+        self.agent_num[row] = agent.agent_id[1]
+        self.edge[row] = edge
+        self.done[row] = 0
+        self.row_id[row] = self._next
+        self.version += 1
+        agent._row = self._next
+        self._next += 1
+        self._live += 1
+        if done:
+            self._complete(row)
+        return row
+
+    def find(self, agent, edge):
+        """Returns the index of ``agent``'s latest row if it was
+        written by the queue on ``edge`` and has not been overwritten,
+        otherwise ``-1``.
+        """
+        row_id = getattr(agent, '_row', -1)
+        row = row_id % self.size
+        if row_id >= 0 and self.row_id[row] == row_id and self.edge[row] == edge:
+            return row
+        return -1
+
+    def rows(self, edges=None):
+        """Returns the indices of the rows written by the queues on
+        ``edges``, or of every row that has not been cleared, in the
+        order they were appended.
+        """
+        rows = super(RingCollector, self).rows(edges)
+        return rows[np.argsort(self._view('row_id')[rows])]
+
+    def edge_rows(self, edge):
+        """Returns the indices of the rows written by the queue on
+        ``edge``, in the order they were appended.
+        """
+        rows = super(RingCollector, self).edge_rows(edge)
+        return rows[np.argsort(self._view('row_id')[rows])]
+
+    def _view(self, name):
+        if name == 'row_id':
+            return np.frombuffer(self.row_id, np.int64)
+        return super(RingCollector, self)._view(name)
+
+    def _compact(self):
+        pass
+
+
+class DiskDataStore(object):
+    """Keeps collected data on disk in chunks that are read back
+    through memory maps.
+
+    A ``DiskDataStore`` is given to
+    :meth:`.QueueNetwork.start_collecting_data`, which then writes
+    completed visits to it in chunks of ``chunk_size`` rows instead of
+    keeping them in memory. Each chunk is a ``.npy`` file with the six
+    columns returned by :meth:`.QueueNetwork.get_queue_data`, plus a
+    second ``.npy`` file with the two entries of each visit's
+    ``agent_id``. The file ``index.jsonl`` has one line of JSON for
+    every chunk, added when the chunk is written, with its number of
+    rows, the range of arrival times and the edges in it. Chunks that
+    can't match a query are never opened.
+
+    Parameters
+    ----------
+    path : str
+        The directory the chunks are written to. It is created if it
+        does not exist. If it already holds a store then new chunks
+        are added to it.
+    chunk_size : int (optional, default: ``65536``)
+        The number of rows in each chunk. The last chunk written by
+        :meth:`.QueueNetwork.stop_collecting_data` may be smaller.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> import queueing_tool as qt
+    >>> g = qt.generate_pagerank_graph(100, seed=13)
+    >>> net = qt.QueueNetwork(g, seed=13)
+    >>> net.initialize(10)
+    >>> store = qt.DiskDataStore(tempfile.mkdtemp(), chunk_size=1000)
+    >>> net.start_collecting_data(store=store)
+    >>> net.simulate(n=20000)
+    >>> net.stop_collecting_data()
+    >>> len(store) == len(net.get_queue_data())
+    True
+
+    Data for some of the queues, and some of the time, is read without
+    loading the rest:
+
+    >>> data = net.get_queue_data(queues=[0, 1, 2], window=(10, 20))
+    >>> bool((data[:, 0] >= 10).all() and (data[:, 0] < 20).all())
+    True
+    """
+
+    def __init__(self, path, chunk_size=65536):
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be a positive integer.")
+
+        self.path = path
+        self.chunk_size = chunk_size
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.index = []
+        index = os.path.join(path, 'index.jsonl')
+        if os.path.exists(index):
+            with open(index) as f:
+                self.index = [json.loads(line) for line in f if line.strip()]
+
+    def __len__(self):
+        return sum(c['rows'] for c in self.index)
+
+    def __repr__(self):
+        return 'DiskDataStore: {0} chunks, {1} rows'.format(len(self.index), len(self))
+
+    def __call__(self, records):
+        self.write(records)
+
+    def __deepcopy__(self, memo):
+        # Copies of a network write to the same files, so they share
+        # the same store.
+        return self
+
+    def write(self, records):
+        """Writes a record array, with dtype
+        :attr:`.DataCollector.dtype`, to the store as one chunk.
+        """
+        if len(records) == 0:
+            return
+
+        dat = np.zeros((len(records), 6))
+        for k, name in enumerate(('arrival', 'service', 'departure',
+                                  'num_queued', 'num_total', 'edge')):
+            dat[:, k] = records[name]
+
+        ids = np.zeros((len(records), 2), np.int64)
+        ids[:, 0] = records['agent_edge']
+        ids[:, 1] = records['agent_num']
+
+        name = 'chunk_{0:06d}'.format(len(self.index))
+        np.save(os.path.join(self.path, name + '.npy'), dat)
+        np.save(os.path.join(self.path, name + '_agents.npy'), ids)
+
+        chunk = {
+            'name': name,
+            'rows': len(dat),
+            't_min': float(dat[:, 0].min()),
+            't_max': float(dat[:, 0].max()),
+            'edges': np.unique(dat[:, 5]).astype(int).tolist()
+        }
+        self.index.append(chunk)
+        with open(os.path.join(self.path, 'index.jsonl'), 'a') as f:
+            f.write(json.dumps(chunk) + '\n')
+
+    def chunks(self, edges=None, window=None):
+        """Yields the chunks that may hold rows from the queues on
+        ``edges`` with an arrival time in ``window``.
+
+        Yields
+        ------
+        data : :class:`~numpy.memmap`
+            The chunk's six columns.
+        agent_ids : :class:`~numpy.memmap`
+            The chunk's ``agent_id`` entries.
+        """
+        edges = None if edges is None else set(int(e) for e in edges)
+
+        for chunk in self.index:
+            if window is not None and \
+                    (chunk['t_max'] < window[0] or chunk['t_min'] >= window[1]):
+                continue
+            if edges is not None and edges.isdisjoint(chunk['edges']):
+                continue
+
+            name = os.path.join(self.path, chunk['name'])
+            yield (np.load(name + '.npy', mmap_mode='r'),
+                   np.load(name + '_agents.npy', mmap_mode='r'))
+
+    def batches(self, edges=None, window=None, batch_size=None):
+        """Yields the rows from the queues on ``edges`` (or every
+        queue) that arrived in ``window``, ``batch_size`` rows at a
+        time.
+
+        The batches are dicts of typed columns, as in
+        :meth:`.DataCollector.batches`. Only one chunk is read at a
+        time, and no batch spans two chunks.
+        """
+        names = ('arrival', 'service', 'departure', 'num_queued', 'num_total', 'edge')
+        for dat, agents in self.chunks(edges, window):
+            rows = np.flatnonzero(_keep(dat, edges, window))
+            size = batch_size or max(len(rows), 1)
+            for k in range(0, len(rows), size):
+                part = rows[k:k + size]
+                batch = {
+                    'agent_edge': np.ascontiguousarray(agents[part, 0], np.int32),
+                    'agent_num': np.ascontiguousarray(agents[part, 1])
+                }
+                for j, name in enumerate(names):
+                    batch[name] = np.ascontiguousarray(dat[part, j], DataCollector.dtype[name])
+                yield batch
+
+    def read(self, edges=None, window=None, agent_ids=False):
+        """Reads the rows from the queues on ``edges`` (or every queue)
+        that arrived in ``window``.
+
+        Parameters
+        ----------
+        edges : *array_like* (optional)
+            The edge indices of the queues to read.
+        window : 2-tuple of float (optional)
+            Only rows with an arrival time ``t`` where
+            ``window[0] <= t < window[1]`` are read.
+        agent_ids : bool (optional, default: ``False``)
+            Whether the agent ids are returned as well.
+
+        Returns
+        -------
+        data : :class:`~numpy.ndarray`
+            The six column rows, in the order they were written.
+        agent_ids : :class:`~numpy.ndarray` (optional)
+            A two column array with each row's ``agent_id``.
+        """
+        dats, ids = [np.zeros((0, 6))], [np.zeros((0, 2), np.int64)]
+        for dat, agents in self.chunks(edges, window):
+            keep = _keep(dat, edges, window)
+            dats.append(np.asarray(dat[keep]))
+            ids.append(np.asarray(agents[keep]))
+
+        if agent_ids:
+            return np.concatenate(dats), np.concatenate(ids)
+        return np.concatenate(dats)
+
+
+class SQLiteDataStore(object):
+    """Keeps collected data in a SQLite database.
+
+    A ``SQLiteDataStore`` is given to
+    :meth:`.QueueNetwork.start_collecting_data` in the same way as a
+    :class:`.DiskDataStore`. Completed visits are inserted
+    ``chunk_size`` rows at a time, each chunk with one ``executemany``
+    in one transaction, and the database runs in WAL mode. The visits
+    go in the table ``visits``, whose columns are the fields of
+    :attr:`.DataCollector.dtype`. The table is indexed on
+    ``(edge, arrival)`` and on ``(agent_edge, agent_num)``, so queries
+    on a queue, or on an agent, don't scan the whole table; see
+    :meth:`.QueueNetwork.query_data`. The indexes are built the first
+    time the store is read, since inserting into an indexed table is
+    several times slower.
+
+    Parameters
+    ----------
+    path : str
+        The database file. It is created if it does not exist. If it
+        already holds visits then new visits are added to them.
+    chunk_size : int (optional, default: ``65536``)
+        The number of rows inserted in each transaction.
+
+    Examples
+    --------
+    >>> import os, tempfile
+    >>> import queueing_tool as qt
+    >>> g = qt.generate_pagerank_graph(100, seed=13)
+    >>> net = qt.QueueNetwork(g, seed=13)
+    >>> net.initialize(10)
+    >>> path = os.path.join(tempfile.mkdtemp(), 'visits.db')
+    >>> net.start_collecting_data(store=qt.SQLiteDataStore(path, chunk_size=1000))
+    >>> net.simulate(n=20000)
+    >>> net.stop_collecting_data()
+    >>> rows = net.query_data('SELECT edge, COUNT(*) FROM visits GROUP BY edge')
+    >>> sum(n for edge, n in rows) == len(net.get_queue_data())
+    True
+    """
+
+    _columns = ('arrival', 'service', 'departure', 'num_queued',
+                'num_total', 'edge', 'agent_edge', 'agent_num')
+
+    def __init__(self, path, chunk_size=65536):
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be a positive integer.")
+
+        self.path = path
+        self.chunk_size = chunk_size
+        self._connect()
+
+    def __getstate__(self):
+        return {'path': self.path, 'chunk_size': self.chunk_size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connect()
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM visits').fetchone()[0]
+
+    def __repr__(self):
+        return 'SQLiteDataStore: {0}, {1} rows'.format(self.path, len(self))
+
+    def __call__(self, records):
+        self.write(records)
+
+    def __deepcopy__(self, memo):
+        # Copies of a network write to the same file, so they share
+        # the same store.
+        return self
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS visits ('
+                'arrival REAL, service REAL, departure REAL, '
+                'num_queued INTEGER, num_total INTEGER, edge INTEGER, '
+                'agent_edge INTEGER, agent_num INTEGER)'
+            )
+        self._indexed = False
+
+    def _index(self):
+        if self._indexed:
+            return
+        with self._conn:
+            self._conn.execute('CREATE INDEX IF NOT EXISTS visits_edge '
+                               'ON visits (edge, arrival)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS visits_agent '
+                               'ON visits (agent_edge, agent_num)')
+        self._indexed = True
+
+    def _select(self, edges, window):
+        # The SELECT statement, and its parameters, for the rows from
+        # the queues on edges that arrived in window.
+        where, params = [], []
+        if edges is not None:
+            edges = ','.join(str(int(e)) for e in edges)
+            where.append('edge IN ({0})'.format(edges))
+        if window is not None:
+            where.append('arrival >= ? AND arrival < ?')
+            params.extend([float(window[0]), float(window[1])])
+
+        self._index()
+        sql = 'SELECT {0} FROM visits'.format(', '.join(self._columns))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return sql + ' ORDER BY rowid', params
+
+    def write(self, records):
+        """Inserts a record array, with dtype
+        :attr:`.DataCollector.dtype`, in one transaction.
+        """
+        if len(records) == 0:
+            return
+
+        rows = records[list(self._columns)].tolist()
+        sql = 'INSERT INTO visits VALUES ({0})'.format(','.join('?' * len(self._columns)))
+        with self._conn:
+            self._conn.executemany(sql, rows)
+
+    def query(self, sql, params=()):
+        """Runs the SQL statement ``sql`` and returns the rows it
+        selects as a list of tuples.
+        """
+        self._index()
+        return self._conn.execute(sql, params).fetchall()
+
+    def batches(self, edges=None, window=None, batch_size=None):
+        """Yields the rows from the queues on ``edges`` (or every
+        queue) that arrived in ``window``, ``batch_size`` rows at a
+        time.
+
+        The batches are dicts of typed columns, as in
+        :meth:`.DataCollector.batches`.
+        """
+        cursor = self._conn.execute(*self._select(edges, window))
+        while True:
+            rows = cursor.fetchmany(batch_size or max(len(self), 1))
+            if len(rows) == 0:
+                break
+            cols = zip(*rows)
+            yield dict((name, np.array(col, DataCollector.dtype[name]))
+                       for name, col in zip(self._columns, cols))
+
+    def read(self, edges=None, window=None, agent_ids=False):
+        """Reads the rows from the queues on ``edges`` (or every queue)
+        that arrived in ``window``.
+
+        See :meth:`.DiskDataStore.read`.
+        """
+        rows = self._conn.execute(*self._select(edges, window)).fetchall()
+        rows = np.array(rows, np.float64).reshape(-1, len(self._columns))
+        dat = rows[:, :6]
+        if agent_ids:
+            return dat, rows[:, 6:].astype(np.int64)
+        return dat
+
+    def close(self):
+        """Closes the connection to the database."""
+        self._conn.close()
@@ -0,0 +1,26 @@
+cdef class Distribution:
+
+    cdef object array_buffer
+    cdef double [::1] buffer
+    cdef Py_ssize_t pos, size
+    cdef public Py_ssize_t block_size
+    cdef public object rng
+    cdef Py_ssize_t next_block
+
+    cdef int _refill(self) except -1
+    cdef double _draw(self) except? -1
+
+
+cdef class Exponential(Distribution):
+
+    cdef public double rate
+
+
+cdef class Gamma(Distribution):
+
+    cdef public double k, theta
+
+
+cdef class Uniform(Distribution):
+
+    cdef public double low, high
@@ -0,0 +1,206 @@
+cimport cython
+
+import numpy as np
+
+
+def _rebuild(cls, args, block_size, rng, buffered, next_block):
+    cdef Distribution dist = cls(*args, block_size=block_size, rng=rng)
+
+    dist.next_block = next_block
+
+    if len(buffered) > 0:
+        dist.array_buffer = np.array(buffered, dtype=np.float64)
+        dist.buffer = dist.array_buffer
+        dist.size = len(buffered)
+    return dist
+
+
+cdef class Distribution:
+    """Base class for random variates that are drawn in blocks.
+
+    Calling a distribution with a time ``t`` returns ``t`` plus one
+    random variate, so instances can be used as the ``arrival_f`` and
+    ``service_f`` functions of a :class:`.QueueServer`. The variates
+    are drawn from ``rng`` a block at a time and handed out one by
+    one, which avoids the overhead of calling numpy once per event.
+    Blocks start small and double in size with each refill until they
+    reach ``block_size``.
+
+    Subclasses implement :meth:`_fill`.
+
+    Parameters
+    ----------
+    block_size : int (optional, default: ``1024``)
+        The largest number of variates drawn at once.
+    rng : :class:`~numpy.random.Generator` (optional)
+        The generator the variates are drawn from. If it is ``None``
+        then numpy's global random state is used.
+
+    Notes
+    -----
+    Variates already in the buffer are not affected by reseeding
+    numpy's random number generator. Call :meth:`reset` after seeding
+    to throw them away.
+    """
+
+    def __init__(self, block_size=1024, rng=None):
+        if block_size < 1:
+            raise ValueError("block_size must be a positive integer.")
+
+        self.block_size = block_size
+        self.rng = rng
+        self.reset()
+
+    def __call__(self, double t):
+        return t + self._draw()
+
+    def __reduce__(self):
+        buffered = [self.buffer[k] for k in range(self.pos, self.size)]
+        args = (type(self), self._args(), self.block_size, self.rng, buffered, self.next_block)
+        return (_rebuild, args)
+
+    def __repr__(self):
+        args = ', '.join(repr(a) for a in self._args())
+        return '{0}({1})'.format(type(self).__name__, args)
+
+    def _args(self):
+        return ()
+
+    def _fill(self, n):
+        """Returns an array of ``n`` new random variates."""
+        raise NotImplementedError
+
+    def _generator(self):
+        return np.random if self.rng is None else self.rng
+
+    def bind(self, rng):
+        """Returns a copy of this distribution that draws its variates
+        from ``rng``.
+        """
+        return type(self)(*self._args(), block_size=self.block_size, rng=rng)
+
+    def reset(self):
+        """Throws away any variates that are waiting in the buffer."""
+        self.array_buffer = None
+        self.pos = 0
+        self.size = 0
+        self.next_block = min(16, self.block_size)
+
+    def sample(self):
+        """Returns a single random variate."""
+        return self._draw()
+
+    cdef int _refill(self) except -1:
+        self.array_buffer = np.ascontiguousarray(self._fill(self.next_block), dtype=np.float64)
+        self.buffer = self.array_buffer
+        self.size = self.buffer.shape[0]
+        self.pos = 0
+        self.next_block = min(2 * self.next_block, self.block_size)
+        if self.size == 0:
+            raise ValueError("_fill returned no variates.")
+        return 0
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef double _draw(self) except? -1:
+        if self.pos == self.size:
+            self._refill()
+
+        self.pos += 1
+        return self.buffer[self.pos - 1]
+
+
+cdef class Exponential(Distribution):
+    """Exponentially distributed variates with the given ``rate``.
+
+    Parameters
+    ----------
+    rate : float
+        The rate of the distribution, the mean is ``1 / rate``.
+    block_size : int (optional, default: ``1024``)
+        The largest number of variates drawn at once.
+    rng : :class:`~numpy.random.Generator` (optional)
+        The generator the variates are drawn from.
+
+    Examples
+    --------
+    >>> import queueing_tool as qt
+    >>> q = qt.QueueServer(arrival_f=qt.Exponential(2.0),
+    ...                    service_f=qt.Exponential(2.5))
+    >>> q.arrival_f
+    Exponential(2.0)
+    """
+
+    def __init__(self, rate, block_size=1024, rng=None):
+        if not rate > 0:
+            raise ValueError("rate must be positive.")
+
+        self.rate = rate
+        super(Exponential, self).__init__(block_size, rng)
+
+    def _args(self):
+        return (self.rate,)
+
+    def _fill(self, n):
+        return self._generator().exponential(1.0 / self.rate, n)
+
+
+cdef class Gamma(Distribution):
+    """Gamma distributed variates with shape ``k`` and scale
+    ``theta``.
+
+    Parameters
+    ----------
+    k : float
+        The shape of the distribution.
+    theta : float
+        The scale of the distribution, the mean is ``k * theta``.
+    block_size : int (optional, default: ``1024``)
+        The largest number of variates drawn at once.
+    rng : :class:`~numpy.random.Generator` (optional)
+        The generator the variates are drawn from.
+    """
+
+    def __init__(self, k, theta, block_size=1024, rng=None):
+        if not k > 0 or not theta > 0:
+            raise ValueError("k and theta must be positive.")
+
+        self.k = k
+        self.theta = theta
+        super(Gamma, self).__init__(block_size, rng)
+
+    def _args(self):
+        return (self.k, self.theta)
+
+    def _fill(self, n):
+        return self._generator().gamma(self.k, self.theta, n)
+
+
+cdef class Uniform(Distribution):
+    """Uniformly distributed variates on ``[low, high)``.
+
+    Parameters
+    ----------
+    low : float (optional, default: ``0``)
+        The lower bound of the distribution.
+    high : float (optional, default: ``1``)
+        The upper bound of the distribution.
+    block_size : int (optional, default: ``1024``)
+        The largest number of variates drawn at once.
+    rng : :class:`~numpy.random.Generator` (optional)
+        The generator the variates are drawn from.
+    """
+
+    def __init__(self, low=0.0, high=1.0, block_size=1024, rng=None):
+        if not high > low:
+            raise ValueError("high must be larger than low.")
+
+        self.low = low
+        self.high = high
+        super(Uniform, self).__init__(block_size, rng)
+
+    def _args(self):
+        return (self.low, self.high)
+
+    def _fill(self, n):
+        return self._generator().uniform(self.low, self.high, n)
@@ -1,9 +1,8 @@
-from heapq import heappush, heappop
-
 from numpy import logical_or, infty
 import numpy as np
 
 from queueing_tool.queues.agents import Agent
+from queueing_tool.queues.collector import _sampled
 from queueing_tool.queues.queue_servers import LossQueue
 
 
@@ -130,27 +129,26 @@ class ResourceQueue(LossQueue):
 
         Use :meth:`~QueueServer.simulate` for simulating instead.
         """
-        if isinstance(self._arrivals[0], ResourceAgent):
-            if self._departures[0]._time < self._arrivals[0]._time:
+        if isinstance(self._arrivals.peek(), ResourceAgent):
+            if self._departures.next_time < self._arrivals.next_time:
                 return super(ResourceQueue, self).next_event()
-            elif self._arrivals[0]._time < infty:
+            elif self._arrivals.next_time < infty:
                 if self._arrivals[0]._has_resource:
-                    arrival = heappop(self._arrivals)
+                    arrival = self._arrivals.pop()
                     self._current_t = arrival._time
                     self._num_total -= 1
                     self.set_num_servers(self.num_servers + 1)
 
                     if self.collect_data:
                         t = arrival._time
-                        if arrival.agent_id not in self.data:
-                            self.data[arrival.agent_id] = [[t, t, t, len(self.queue), self.num_system]]
-                        else:
-                            self.data[arrival.agent_id].append([t, t, t, len(self.queue), self.num_system])
+                        self._data.append(arrival, self.edge[2], t, len(self.queue),
+                                          self.num_system, service=t, departure=t,
+                                          done=True)
 
-                    if self._arrivals[0]._time < self._departures[0]._time:
-                        self._time = self._arrivals[0]._time
+                    if self._arrivals.next_time < self._departures.next_time:
+                        self._time = self._arrivals.next_time
                     else:
-                        self._time = self._departures[0]._time
+                        self._time = self._departures.next_time
 
                 elif self.num_system < self.num_servers:
                     super(ResourceQueue, self).next_event()
@@ -159,19 +157,17 @@ class ResourceQueue(LossQueue):
                     self.num_blocked += 1
                     self._num_arrivals += 1
                     self._num_total -= 1
-                    arrival = heappop(self._arrivals)
+                    arrival = self._arrivals.pop()
                     self._current_t = arrival._time
 
                     if self.collect_data:
-                        if arrival.agent_id not in self.data:
-                            self.data[arrival.agent_id] = [[arrival._time, 0, 0, len(self.queue), self.num_system]]
-                        else:
-                            self.data[arrival.agent_id].append([arrival._time, 0, 0, len(self.queue), self.num_system])
+                        self._data.append(arrival, self.edge[2], arrival._time,
+                                          len(self.queue), self.num_system, done=True)
 
-                    if self._arrivals[0]._time < self._departures[0]._time:
-                        self._time = self._arrivals[0]._time
+                    if self._arrivals.next_time < self._departures.next_time:
+                        self._time = self._arrivals.next_time
                     else:
-                        self._time = self._departures[0]._time
+                        self._time = self._departures.next_time
         else:
             return super(ResourceQueue, self).next_event()
 
@@ -252,8 +248,9 @@ class InfoAgent(Agent):
 
             # stamp this information
             n = queue.edge[2]    # This is the edge_index of the queue
-            if self.agent_id in queue.data:
-                tmp = queue.data[self.agent_id][-1][1] - queue.data[self.agent_id][-1][0]
+            row = queue._data.find(self, n)
+            if row >= 0:
+                tmp = queue._data.service[row] - queue._data.arrival[row]
                 self.stats[n, 0] = self.stats[n, 0] + tmp
                 self.stats[n, 1] += 1 if tmp > 0 else 0
             self.net_data[n, :] = queue._current_t, queue.num_servers, queue.num_system / queue.num_servers
@@ -307,7 +304,7 @@ class InfoQueue(LossQueue):
     def _add_arrival(self, agent=None):
         if agent is not None:
             self._num_total += 1
-            heappush(self._arrivals, agent)
+            self._arrivals.push(agent)
         else:
             if self._current_t >= self._next_ct:
                 self._next_ct = self.arrival_f(self._current_t)
@@ -319,19 +316,23 @@ class InfoQueue(LossQueue):
                 self._num_total += 1
                 new_agent = self.AgentFactory((self.edge[2], self._oArrivals), len(self.net_data))
                 new_agent._time = self._next_ct
-                heappush(self._arrivals, new_agent)
+                new_agent._entered = self._next_ct
+                if self._sample_rate < 1 or self._sample_every > 1:
+                    new_agent._sampled = _sampled(new_agent.agent_id, self._sample_rate,
+                                                  self._sample_every)
+                self._arrivals.push(new_agent)
 
                 self._oArrivals += 1
 
                 if self._oArrivals >= self.active_cap:
                     self._active = False
 
-        if self._arrivals[0]._time < self._departures[0]._time:
-            self._time = self._arrivals[0]._time
+        if self._arrivals.next_time < self._departures.next_time:
+            self._time = self._arrivals.next_time
 
     def next_event(self):
-        if self._arrivals[0]._time < self._departures[0]._time:
-            self.extract_information(self._arrivals[0])
+        if self._arrivals.next_time < self._departures.next_time:
+            self.extract_information(self._arrivals.peek())
 
         return super(InfoQueue, self).next_event()
 
@@ -1,16 +1,19 @@
 import collections
 import copy
+import functools
 import numbers
-from heapq import heappush, heappop
 
-from numpy.random import uniform, exponential
 from numpy import infty
 import numpy as np
 
-from queueing_tool.queues.agents import Agent, InftyAgent
+from queueing_tool.queues.agent_heap import AgentHeap
+from queueing_tool.queues.agents import Agent
+from queueing_tool.queues.collector import DataCollector, RingCollector, _sampled
+from queueing_tool.queues.distributions import Distribution, Exponential
+from queueing_tool.queues.stats import QueueStats, StateLog
 
 
-def poisson_random_measure(t, rate, rate_max):
+def poisson_random_measure(t, rate, rate_max, rng=None):
     """A function that returns the arrival time of the next arrival for
     a Poisson random measure.
 
@@ -23,6 +26,11 @@ def poisson_random_measure(t, rate, rate_max):
         the expected arrival rate at time ``t``.
     rate_max : float
         The maximum value of the ``rate`` function.
+    rng : :class:`~numpy.random.Generator` (optional)
+        The generator used to draw the arrival times. If it is
+        ``None`` then numpy's global random state is used. A
+        :class:`.QueueServer` with its own generator passes it in when
+        ``arrival_f`` is a :func:`functools.partial` of this function.
 
     Returns
     -------
@@ -72,13 +80,37 @@ def poisson_random_measure(t, rate, rate_max):
            Mathematics. Vol. 261. Springer, New York, 2011.\
            :doi:`10.1007/978-0-387-87859-1`
     """
+    if rng is None:
+        rng = np.random
+
     scale = 1.0 / rate_max
-    t = t + exponential(scale)
-    while rate_max * uniform() > rate(t):
-        t = t + exponential(scale)
+    t = t + rng.exponential(scale)
+    while rate_max * rng.uniform() > rate(t):
+        t = t + rng.exponential(scale)
     return t
 
 
+class _Visit(object):
+    # Stands in for the agent when rows are written from a dict.
+    def __init__(self, agent_id):
+        self.agent_id = agent_id
+
+
+def _bind_rng(f, rng, old=None):
+    """Makes ``f`` draw from ``rng`` if it is a distribution or a
+    partial of :func:`poisson_random_measure` that draws from ``old``.
+    Other functions are returned as they are.
+    """
+    if rng is None:
+        return f
+    elif isinstance(f, Distribution) and f.rng is old:
+        return f.bind(rng)
+    elif isinstance(f, functools.partial) and f.func is poisson_random_measure \
+            and f.keywords.get('rng') is old:
+        return functools.partial(f, rng=rng)
+    return f
+
+
 class QueueServer(object):
     """The base queue-server class.
 
@@ -103,14 +135,18 @@ class QueueServer(object):
     ----------
     num_servers : int or ``numpy.infty`` (optional, default: ``1``)
         The number of servers servicing agents.
-    arrival_f : function (optional, default: ``lambda t: t + exponential(1)``)
+    arrival_f : function (optional, default: ``Exponential(1.0)``)
         A function that returns the time of next arrival from outside
         the network. When this function is called, ``t`` is always
-        taken to be the current time.
-    service_f : function (optional, default: ``lambda t: t + exponential(0.9)``)
+        taken to be the current time. A :class:`.Distribution`, like
+        :class:`.Exponential` or :class:`.Gamma`, draws its random
+        numbers in blocks and is much cheaper per call than a plain
+        function.
+    service_f : function (optional, default: ``Exponential(1 / 0.9)``)
         A function that returns the time of an agent's service time.
         When this function is called, ``t`` is the time the agent is
-        entering service.
+        entering service. Like ``arrival_f`` it can be a
+        :class:`.Distribution`.
     edge : 4-tuple of int (optional, default: ``(0, 0, 0, 1)``)
         A tuple that uniquely identifies which edge this queue lays on
         and the edge type. The first slot of the tuple is the source
@@ -128,11 +164,29 @@ class QueueServer(object):
         Sets a stopping time, after which no more arrivals (from
         outside the network) will attempt to enter the
         :class:`.QueueServer`.
-    collect_data : bool (optional, default: ``False``)
+    collect_data : bool or ``'ring'`` (optional, default: ``False``)
         A bool that defines whether the queue collects each
         :class:`Agent's<.Agent>` arrival, service start, and departure
         times and other data. See :meth:`~QueueServer.fetch_data` for
-        more on the information that is collected.
+        more on the information that is collected. If it is ``'ring'``
+        then only the latest ``ring_size`` visits are kept, see
+        :class:`.RingCollector`.
+    ring_size : int (optional, default: ``1024``)
+        The number of visits kept when ``collect_data`` is ``'ring'``.
+    collect_stats : bool (optional, default: ``False``)
+        A bool that defines whether the queue keeps running statistics
+        of waiting times, sojourn times and time averages, without
+        storing anything per agent. See :meth:`~QueueServer.get_stats`.
+    collect_quantiles : bool (optional, default: ``False``)
+        A bool that defines whether the statistics include sketches of
+        the waiting and sojourn times, so that their quantiles can be
+        estimated in constant memory. Only used when ``collect_stats``
+        is set. See :meth:`~QueueServer.get_quantiles`.
+    collect_states : bool (optional, default: ``False``)
+        A bool that defines whether the queue logs the time of every
+        change to ``num_system``, so that time averages over any
+        window can be computed exactly. See
+        :meth:`~QueueServer.time_average`.
     colors : dict (optional)
         A dictionary of the colors used when drawing the graph. The
         possible colors are:
@@ -152,9 +206,17 @@ class QueueServer(object):
         Specifies how sensitive the coloring of the queue is to the
         number of arrivals. See the notes for how this parameter
         affects coloring.
-    seed : int (optional)
-        If supplied ``seed`` is used to initialize numpy's
-        psuedo-random number generator.
+    seed : int or :class:`~numpy.random.SeedSequence` (optional)
+        If supplied, ``seed`` is used to create the queue's own
+        :class:`~numpy.random.Generator`. Ignored if ``rng`` is given.
+    rng : :class:`~numpy.random.Generator` (optional)
+        The generator used by the queue's random draws. The default
+        arrival and service distributions draw from it, as does any
+        :class:`.Distribution` or :func:`functools.partial` of
+        :func:`.poisson_random_measure` that does not have a generator
+        of its own. If neither ``seed`` nor ``rng`` is given then
+        numpy's global random state is used. Functions that call
+        :mod:`numpy.random` directly always use the global state.
 
     Attributes
     ----------
@@ -173,10 +235,13 @@ class QueueServer(object):
         start, and departure times, as well as how many other agents
         were waiting to be served and the total number agents in the
         system (upon arrival). The keys are the :class:`Agent's<.Agent>`
-        unique ``agent_id``, and the values is a list of lists. Each
-        time an agent arrives at the queue it appends this data to the
-        end of the list. Use :meth:`.fetch_data` to retrieve a formated
-        version of this data.
+        unique ``agent_id``, and the values is a list of lists, one
+        for each time the agent arrived at the queue. The dict is built
+        from the queue's :class:`.DataCollector` and kept until the
+        collector changes, so it should not be modified in place;
+        assigning a dict to ``data`` replaces the queue's rows with
+        its contents. Use :meth:`.fetch_data` to retrieve the data as
+        an array.
     num_arrivals : list
         A list with two entries. The first slot is the total number of
         arrivals, while the second slot is the number of arrivals from
@@ -188,6 +253,9 @@ class QueueServer(object):
         this includes those being served and those waiting to be served.
     queue : :class:`~.collections.deque`
         A queue for the agents waiting to enter service.
+    rng : :class:`~numpy.random.Generator` or ``None``
+        The queue's random number generator, or ``None`` if it uses
+        numpy's global random state.
     time : float
         The time of the next event.
 
@@ -277,7 +345,9 @@ class QueueServer(object):
                  service_f=None, edge=(0, 0, 0, 1),
                  AgentFactory=Agent, collect_data=False, active_cap=infty,
                  deactive_t=infty, colors=None, seed=None,
-                 coloring_sensitivity=2, **kwargs):
+                 coloring_sensitivity=2, rng=None, collect_stats=False,
+                 collect_quantiles=False, collect_states=False, ring_size=1024,
+                 **kwargs):
 
         if not isinstance(num_servers, numbers.Integral) and num_servers is not infty:
             msg = "num_servers must be an integer or infinity."
@@ -290,27 +360,33 @@ class QueueServer(object):
         self.num_servers = kwargs.get('nServers', num_servers)
         self.num_departures = 0
         self.num_system = 0
-        self.data = {}   # times; agent_id : [arrival, service start, departure]
+        if collect_data == 'ring':
+            self._data = RingCollector(ring_size)
+        else:
+            self._data = DataCollector()
         self.queue = collections.deque()
 
+        if rng is None and seed is not None:
+            rng = np.random.default_rng(seed)
+
         if arrival_f is None:
-            def arrival_f(t):
-                return t + exponential(1.0)
+            arrival_f = Exponential(1.0)
 
         if service_f is None:
-            def service_f(t):
-                return t + exponential(0.9)
+            service_f = Exponential(1 / 0.9)
 
-        self.arrival_f = arrival_f
-        self.service_f = service_f
+        self.rng = rng
+        self.arrival_f = _bind_rng(arrival_f, rng)
+        self.service_f = _bind_rng(service_f, rng)
         self.AgentFactory = AgentFactory
         self.collect_data = collect_data
+        self.collect_stats = collect_stats
+        self.collect_states = collect_states
         self.active_cap = active_cap
         self.deactive_t = deactive_t
 
-        inftyAgent = InftyAgent()
-        self._arrivals = [inftyAgent]    # A list of arriving agents.
-        self._departures = [inftyAgent]    # A list of departing agents.
+        self._arrivals = AgentHeap()      # A heap of arriving agents.
+        self._departures = AgentHeap()    # A heap of departing agents.
         self._num_arrivals = 0
         self._oArrivals = 0
         self._num_total = 0       # The number of agents scheduled to arrive + num_system
@@ -318,11 +394,13 @@ class QueueServer(object):
         self._current_t = 0       # The time of the last event.
         self._time = infty   # The time of the next event.
         self._next_ct = 0       # The next time an arrival from outside the network can arrive.
+        self._sample_rate = 1.0   # The fraction of new agents data is collected on,
+        self._sample_every = 1    # or collect data on one in this many new agents.
+        self._data_view = None    # (collector, version, dict) behind self.data
+        self._stats = QueueStats(0, self, quantiles=collect_quantiles)
+        self._states = StateLog()
         self.coloring_sensitivity = coloring_sensitivity
 
-        if isinstance(seed, numbers.Integral):
-            np.random.seed(seed)
-
         if colors is not None:
             self.colors = colors
             for col in set(self._default_colors.keys()) - set(self.colors.keys()):
@@ -346,6 +424,37 @@ class QueueServer(object):
     def num_arrivals(self):
         return [self._num_arrivals, self._oArrivals]
 
+    @property
+    def data(self):
+        cols = self._data
+        view = self._data_view
+        if view is not None and view[0] is cols and view[1] == cols.version:
+            return view[2]
+
+        data = {}
+        for row in cols.edge_rows(self.edge[2]):
+            agent_id = (cols.agent_edge[row], cols.agent_num[row])
+            datum = [cols.arrival[row], cols.service[row], cols.departure[row],
+                     cols.num_queued[row], cols.num_total[row]]
+            data.setdefault(agent_id, []).append(datum)
+
+        self._data_view = (cols, cols.version, data)
+        return data
+
+    @data.setter
+    def data(self, data):
+        # Used to be a plain dict, so ``q.data = {}`` was how a queue's
+        # data was cleared. Each entry is written as a complete row,
+        # or an incomplete one if the agent hasn't departed.
+        self._data.clear([self.edge[2]])
+        for agent_id, rows in data.items():
+            for datum in rows:
+                visit = _Visit(agent_id)
+                row = self._data.append(visit, self.edge[2], datum[0], datum[3],
+                                        datum[4], datum[1], datum[2])
+                if datum[2] > 0:
+                    self._data.depart(row, datum[2])
+
     def __repr__(self):
         my_str = ("QueueServer:{0}. Servers: {1}, queued: {2}, arrivals: {3}, "
                   "departures: {4}, next time: {5}")
@@ -356,7 +465,7 @@ class QueueServer(object):
     def _add_arrival(self, agent=None):
         if agent is not None:
             self._num_total += 1
-            heappush(self._arrivals, agent)
+            self._arrivals.push(agent)
         else:
             if self._current_t >= self._next_ct:
                 self._next_ct = self.arrival_f(self._current_t)
@@ -368,15 +477,19 @@ class QueueServer(object):
                 self._num_total += 1
                 new_agent = self.AgentFactory((self.edge[2], self._oArrivals))
                 new_agent._time = self._next_ct
-                heappush(self._arrivals, new_agent)
+                new_agent._entered = self._next_ct
+                if self._sample_rate < 1 or self._sample_every > 1:
+                    new_agent._sampled = _sampled(new_agent.agent_id, self._sample_rate,
+                                                  self._sample_every)
+                self._arrivals.push(new_agent)
 
                 self._oArrivals += 1
 
                 if self._oArrivals >= self.active_cap:
                     self._active = False
 
-        if self._arrivals[0]._time < self._departures[0]._time:
-            self._time = self._arrivals[0]._time
+        if self._arrivals.next_time < self._departures.next_time:
+            self._time = self._arrivals.next_time
 
     def at_capacity(self):
         """Returns whether the queue is at capacity or not.
@@ -393,10 +506,12 @@ class QueueServer(object):
         """Clears out the queue. Removes all arrivals, departures, and
         queued agents from the :class:`.QueueServer`, resets
         ``num_arrivals``, ``num_departures``, ``num_system``, and the clock to
-        zero. It also clears any stored ``data`` and the server is then
-        set to inactive.
+        zero. It also clears any stored ``data``, restarts the
+        statistics, and the server is then set to inactive. Random
+        numbers buffered by a :class:`.Distribution` ``arrival_f`` or
+        ``service_f`` are thrown away.
         """
-        self.data = {}
+        self._data.clear([self.edge[2]])
         self._num_arrivals = 0
         self._oArrivals = 0
         self.num_departures = 0
@@ -407,14 +522,27 @@ class QueueServer(object):
         self._next_ct = 0
         self._active = False
         self.queue = collections.deque()
-        inftyAgent = InftyAgent()
-        self._arrivals = [inftyAgent]
-        self._departures = [inftyAgent]
+        self._arrivals = AgentHeap()
+        self._departures = AgentHeap()
+
+        for f in (self.arrival_f, self.service_f):
+            if isinstance(f, Distribution):
+                f.reset()
+
+        self._stats.start(0, self)
+        self._states.start(0, 0)
 
     def copy(self):
         """Returns a deep copy of itself."""
         return copy.deepcopy(self)
 
+    def _set_rng(self, rng):
+        # Moves the queue, and the functions that drew from its old
+        # generator, over to rng.
+        self.arrival_f = _bind_rng(self.arrival_f, rng, self.rng)
+        self.service_f = _bind_rng(self.service_f, rng, self.rng)
+        self.rng = rng
+
     def _current_color(self, which=0):
         """Returns a color for the queue.
 
@@ -475,15 +603,15 @@ class QueueServer(object):
             to depart next. If ``t`` is not given, then an additional
             service time is added to the next departing agent.
         """
-        if len(self._departures) > 1:
-            agent = heappop(self._departures)
+        if len(self._departures) > 0:
+            agent = self._departures.pop()
 
             if t is None:
                 agent._time = self.service_f(agent._time)
             else:
                 agent._time = t
 
-            heappush(self._departures, agent)
+            self._departures.push(agent)
             self._update_time()
 
     def fetch_data(self, return_header=False):
@@ -512,33 +640,159 @@ class QueueServer(object):
             A comma seperated string of the column headers. Returns
             ``'arrival,service,departure,num_queued,num_total,q_id'``
         """
-
-        qdata = []
-        for d in self.data.values():
-            qdata.extend(d)
-
-        dat = np.zeros((len(qdata), 6))
-        if len(qdata) > 0:
-            dat[:, :5] = np.array(qdata)
-            dat[:, 5] = self.edge[2]
-
-            dType = [
-                ('a', float),
-                ('s', float),
-                ('d', float),
-                ('q', float),
-                ('n', float),
-                ('id', float)
-            ]
-            dat = np.array([tuple(d) for d in dat], dtype=dType)
-            dat = np.sort(dat, order='a')
-            dat = np.array([tuple(d) for d in dat])
+        dat = self._data.fetch([self.edge[2]])
 
         if return_header:
             return dat, 'arrival,service,departure,num_queued,num_total,q_id'
 
         return dat
 
+    def get_stats(self, t=None):
+        """Returns the statistics the queue has kept since it started
+        collecting them.
+
+        The queue must have ``collect_stats`` set, see the class
+        parameters.
+
+        Parameters
+        ----------
+        t : float (optional)
+            The time the time averages run up to. Defaults to the time
+            of the last event. Ignored once the queue has stopped
+            collecting statistics.
+
+        Returns
+        -------
+        dict
+            A dict with the following keys:
+
+            * ``elapsed``: The length of time covered.
+            * ``num_arrivals``, ``num_departures``, ``num_blocked``:
+              The number of arrivals, departures and blocked arrivals.
+            * ``num_waits``, ``mean_wait``, ``var_wait``: The number,
+              mean and variance of the waiting times, the time from an
+              agent's arrival until it starts service.
+            * ``num_sojourns``, ``mean_sojourn``, ``var_sojourn``:
+              The same for the sojourn times, the time from an agent's
+              arrival until it departs.
+            * ``mean_num_system``: The time average of ``num_system``.
+            * ``mean_num_queued``: The time average of the number of
+              agents waiting for service.
+            * ``mean_busy``: The time average of the number of agents
+              in service.
+            * ``utilization``: ``mean_busy`` divided by
+              ``num_servers``.
+
+            Means and variances without any samples are ``nan``.
+
+        Examples
+        --------
+        >>> import queueing_tool as qt
+        >>> q = qt.QueueServer(num_servers=2, collect_stats=True, seed=4,
+        ...                    arrival_f=qt.Exponential(1.2),
+        ...                    service_f=qt.Exponential(1.0))
+        >>> q.set_active()
+        >>> q.simulate(n=100000)
+        >>> stats = q.get_stats()
+        >>> round(stats['utilization'], 1)
+        0.6
+
+        Little's law holds for the time averages:
+
+        >>> lam = stats['num_departures'] / stats['elapsed']
+        >>> abs(stats['mean_num_system'] - lam * stats['mean_sojourn']) < 0.05
+        True
+        """
+        if self.collect_stats:
+            t = self._current_t if t is None else t
+        else:
+            t = None
+        return self._stats.summary(self, t)
+
+    def get_quantiles(self, q=(0.5, 0.95, 0.99)):
+        """Returns estimates of quantiles of the waiting and sojourn
+        times seen since the queue started collecting statistics.
+
+        The queue must have ``collect_stats`` and
+        ``collect_quantiles`` set, see the class parameters. Each
+        estimate is within a relative error of 1% of the true sample
+        quantile.
+
+        Parameters
+        ----------
+        q : float or *array_like* (optional, default: ``(0.5, 0.95, 0.99)``)
+            The quantiles, each between 0 and 1.
+
+        Returns
+        -------
+        dict
+            A dict with keys ``'wait'`` and ``'sojourn'``, whose values
+            are :class:`~numpy.ndarray` with the shape of ``q``. The
+            estimates are ``nan`` if there are no samples.
+
+        Examples
+        --------
+        >>> import queueing_tool as qt
+        >>> q = qt.QueueServer(collect_stats=True, collect_quantiles=True,
+        ...                    arrival_f=qt.Exponential(0.5),
+        ...                    service_f=qt.Exponential(1.0), seed=7)
+        >>> q.set_active()
+        >>> q.simulate(n=200000)
+        >>> p = q.get_quantiles([0.5, 0.9])
+
+        The sojourn time of an M/M/1 queue is exponential with rate
+        ``mu - lambda``, so its 90th percentile is ``log(10) / 0.5``:
+
+        >>> abs(p['sojourn'][1] - 4.605) < 0.2
+        True
+        """
+        return self._stats.quantiles(q)
+
+    def time_average(self, metric='num_system', t0=None, t1=None):
+        """Returns the exact time average of the state of the queue
+        over a window of time.
+
+        The queue must have ``collect_states`` set, see the class
+        parameters.
+
+        Parameters
+        ----------
+        metric : str (optional, default: ``'num_system'``)
+            One of ``'num_system'``, ``'num_queued'`` (the number of
+            agents waiting for service), ``'num_busy'`` (the number of
+            agents in service), or ``'utilization'`` (``num_busy``
+            divided by ``num_servers``).
+        t0 : float (optional)
+            The start of the window. Defaults to the time the log
+            started.
+        t1 : float (optional)
+            The end of the window. Defaults to the time of the last
+            event, or the time the log stopped.
+
+        Returns
+        -------
+        float
+            The time average. Parts of the window outside of the log
+            are ignored, and if nothing is left it is ``nan``.
+
+        Examples
+        --------
+        >>> import queueing_tool as qt
+        >>> q = qt.QueueServer(collect_states=True, seed=3,
+        ...                    arrival_f=qt.Exponential(0.5),
+        ...                    service_f=qt.Exponential(1.0))
+        >>> q.set_active()
+        >>> q.simulate(n=200000)
+
+        The mean number in an M/M/1 queue is ``rho / (1 - rho)``:
+
+        >>> round(q.time_average('num_system'), 1)
+        1.0
+        >>> round(q.time_average('utilization'), 1)
+        0.5
+        """
+        return self._states.average(t0, t1, metric, self.num_servers, self._current_t)
+
     def _key(self):
         return self._time, self.edge[2]
 
@@ -567,61 +821,94 @@ class QueueServer(object):
         --------
         :meth:`.simulate` : Simulates the queue forward.
         """
-        if self._departures[0]._time < self._arrivals[0]._time:
-            new_depart = heappop(self._departures)
+        if self._departures.next_time < self._arrivals.next_time:
+            new_depart = self._departures.pop()
             self._current_t = new_depart._time
+
+            if self.collect_stats:
+                stats = self._stats
+                stats.advance(self._current_t, self.num_system, len(self.queue))
+                if new_depart._arrival >= stats.t_start:
+                    stats.add_sojourn(self._current_t - new_depart._arrival)
+
             self._num_total -= 1
             self.num_system -= 1
             self.num_departures += 1
 
-            if self.collect_data and new_depart.agent_id in self.data:
-                self.data[new_depart.agent_id][-1][2] = self._current_t
+            if self.collect_states:
+                self._states.append(self._current_t, self.num_system)
+
+            if self.collect_data:
+                row = self._data.find(new_depart, self.edge[2])
+                if row >= 0:
+                    self._data.depart(row, self._current_t)
 
             if len(self.queue) > 0:
                 agent = self.queue.popleft()
-                if self.collect_data and agent.agent_id in self.data:
-                    self.data[agent.agent_id][-1][1] = self._current_t
+                if self.collect_data:
+                    row = self._data.find(agent, self.edge[2])
+                    if row >= 0:
+                        self._data.serve(row, self._current_t)
+
+                if self.collect_stats and agent._arrival >= self._stats.t_start:
+                    self._stats.add_wait(self._current_t - agent._arrival)
 
                 agent._time = self.service_f(self._current_t)
                 agent.queue_action(self, 1)
-                heappush(self._departures, agent)
+                self._departures.push(agent)
 
             new_depart.queue_action(self, 2)
             self._update_time()
             return new_depart
 
-        elif self._arrivals[0]._time < infty:
-            arrival = heappop(self._arrivals)
-            self._current_t = arrival._time
+        elif self._arrivals.next_time < infty:
+            self._serve_arrival(self._arrivals.pop())
 
-            if self._active:
-                self._add_arrival()
+    def _receive(self, agent):
+        # Same as calling self._add_arrival(agent) and then
+        # self.next_event() for an agent arriving at the current time,
+        # but the agent never enters the arrivals heap. Subclasses
+        # that change how arrivals are handled must not rely on this;
+        # the QueueNetwork only uses it for the built-in queues.
+        self._num_total += 1
+        self._serve_arrival(agent)
 
-            self.num_system += 1
-            self._num_arrivals += 1
+    def _serve_arrival(self, arrival):
+        self._current_t = arrival._time
 
-            if self.collect_data:
-                b = 0 if self.num_system <= self.num_servers else 1
-                if arrival.agent_id not in self.data:
-                    self.data[arrival.agent_id] = \
-                        [[arrival._time, 0, 0, len(self.queue) + b, self.num_system]]
-                else:
-                    self.data[arrival.agent_id]\
-                        .append([arrival._time, 0, 0, len(self.queue) + b, self.num_system])
+        if self._active:
+            self._add_arrival()
 
-            arrival.queue_action(self, 0)
+        if self.collect_stats:
+            self._stats.advance(arrival._time, self.num_system, len(self.queue))
 
-            if self.num_system <= self.num_servers:
-                if self.collect_data:
-                    self.data[arrival.agent_id][-1][1] = arrival._time
+        self.num_system += 1
+        self._num_arrivals += 1
+        arrival._arrival = arrival._time
 
-                arrival._time = self.service_f(arrival._time)
-                arrival.queue_action(self, 1)
-                heappush(self._departures, arrival)
-            else:
-                self.queue.append(arrival)
+        if self.collect_states:
+            self._states.append(arrival._time, self.num_system)
 
-            self._update_time()
+        if self.collect_data:
+            b = 0 if self.num_system <= self.num_servers else 1
+            row = self._data.append(arrival, self.edge[2], arrival._time,
+                                    len(self.queue) + b, self.num_system)
+
+        arrival.queue_action(self, 0)
+
+        if self.num_system <= self.num_servers:
+            if self.collect_data and row >= 0:
+                self._data.serve(row, arrival._time)
+            if self.collect_stats:
+                self._stats.add_wait(0.0)
+
+            arrival._time = self.service_f(arrival._time)
+            arrival.queue_action(self, 1)
+            self._departures.push(arrival)
+        else:
+            self.queue.append(arrival)
+
+        self._update_time()
 
     def next_event_description(self):
         """Returns an integer representing whether the next event is
@@ -635,9 +922,9 @@ class QueueServer(object):
             ``2`` corresponds to a departure, and ``0`` corresponds to
             nothing scheduled to occur.
         """
-        if self._departures[0]._time < self._arrivals[0]._time:
+        if self._departures.next_time < self._arrivals.next_time:
             return 2
-        elif self._arrivals[0]._time < infty:
+        elif self._arrivals.next_time < infty:
             return 1
         else:
             return 0
@@ -704,9 +991,10 @@ class QueueServer(object):
 
         >>> import queueing_tool as qt
         >>> import numpy as np
+        >>> import functools
         >>> rate = lambda t: 2 + 16 * np.sin(np.pi * t / 8)**2
-        >>> arr = lambda t: qt.poisson_random_measure(t, rate, 18)
-        >>> ser = lambda t: t + np.random.gamma(4, 0.1)
+        >>> arr = functools.partial(qt.poisson_random_measure, rate=rate, rate_max=18)
+        >>> ser = qt.Gamma(4, 0.1)
         >>> q = qt.QueueServer(5, arrival_f=arr, service_f=ser, seed=54)
         >>> q.set_active()
 
@@ -724,21 +1012,21 @@ class QueueServer(object):
         >>> round(float(q.time - t0), 1)
         75.1
         >>> q.num_arrivals[1] + q.num_departures - num_events
-        1597
+        1622
 
         To simulate forward until 1000 new departures are observed run:
 
         >>> nA0, nD0 = q.num_arrivals[1], q.num_departures
         >>> q.simulate(nD=1000)
         >>> q.num_departures - nD0, q.num_arrivals[1] - nA0
-        (1000, 983)
+        (1000, 1016)
 
         To simulate until 1000 new arrivals are observed run:
 
         >>> nA0, nD0 = q.num_arrivals[1], q.num_departures
         >>> q.simulate(nA=1000)
         >>> q.num_departures - nD0, q.num_arrivals[1] - nA0,
-        (987, 1000)
+        (1002, 1000)
         """
         if t is None and nD is None and nA is None:
             for dummy in range(n):
@@ -757,10 +1045,10 @@ class QueueServer(object):
                 self.next_event()
 
     def _update_time(self):
-        if self._arrivals[0]._time < self._departures[0]._time:
-            self._time = self._arrivals[0]._time
+        if self._arrivals.next_time < self._departures.next_time:
+            self._time = self._arrivals.next_time
         else:
-            self._time = self._departures[0]._time
+            self._time = self._departures.next_time
 
 
 class LossQueue(QueueServer):
@@ -828,38 +1116,40 @@ class LossQueue(QueueServer):
         return self.num_system >= self.num_servers + self.buffer
 
     def clear(self):
-        super(LossQueue, self).clear()
         self.num_blocked = 0
+        super(LossQueue, self).clear()
 
     def next_event(self):
 
-        if self._departures[0]._time < self._arrivals[0]._time:
+        if self._departures.next_time < self._arrivals.next_time:
             return super(LossQueue, self).next_event()
-        elif self._arrivals[0]._time < infty:
+        elif self._arrivals.next_time < infty:
             if self.num_system < self.num_servers + self.buffer:
                 super(LossQueue, self).next_event()
             else:
-                self.num_blocked += 1
                 self._num_total -= 1
+                self._block_arrival(self._arrivals.pop())
 
-                arrival = heappop(self._arrivals)
-                arrival.add_loss(self.edge)
+    def _receive(self, agent):
+        if self.num_system < self.num_servers + self.buffer:
+            super(LossQueue, self)._receive(agent)
+        else:
+            self._block_arrival(agent)
 
-                self._current_t = arrival._time
+    def _block_arrival(self, arrival):
+        self.num_blocked += 1
+        arrival.add_loss(self.edge)
 
-                if self._active:
-                    self._add_arrival()
+        self._current_t = arrival._time
 
-                if self.collect_data:
-                    if arrival.agent_id in self.data:
-                        self.data[arrival.agent_id].append([arrival._time, 0, 0, len(self.queue), self.num_system])
-                    else:
-                        self.data[arrival.agent_id] = [[arrival._time, 0, 0, len(self.queue), self.num_system]]
+        if self._active:
+            self._add_arrival()
+
+        if self.collect_data:
+            self._data.append(arrival, self.edge[2], arrival._time,
+                              len(self.queue), self.num_system, done=True)
 
-                if self._arrivals[0]._time < self._departures[0]._time:
-                    self._time = self._arrivals[0]._time
-                else:
-                    self._time = self._departures[0]._time
+        self._update_time()
 
 
 class NullQueue(QueueServer):
@@ -906,10 +1196,10 @@ class NullQueue(QueueServer):
 
     def _add_arrival(self, agent=None):
         if self.collect_data and agent is not None:
-            if agent.agent_id not in self.data:
-                self.data[agent.agent_id] = [[agent._time, 0, 0, 0, 0]]
-            else:
-                self.data[agent.agent_id].append([agent._time, 0, 0, 0, 0])
+            self._data.append(agent, self.edge[2], agent._time, 0, 0, done=True)
+
+    def _receive(self, agent):
+        self._add_arrival(agent)
 
     def delay_service(self, *args, **kwargs):
         pass
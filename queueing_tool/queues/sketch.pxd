@@ -0,0 +1,14 @@
+cdef class QuantileSketch:
+
+    cdef readonly double rel_error, min_value
+    cdef readonly Py_ssize_t max_bins
+    cdef double gamma, log_gamma
+    cdef object array_counts
+    cdef long long [::1] counts
+    cdef Py_ssize_t offset, nbins
+    cdef readonly long long count, zero_count
+    cdef readonly double min, max
+
+    cdef int _add(self, double x) except -1
+    cdef int _reserve(self, Py_ssize_t lo, Py_ssize_t hi) except -1
+    cdef double _quantile(self, double q)
@@ -0,0 +1,239 @@
+cimport cython
+from libc.math cimport INFINITY, NAN, ceil, log, pow
+
+import numpy as np
+
+
+def _rebuild(args, Py_ssize_t offset, counts, zero_count, count, low, high):
+    cdef QuantileSketch sketch = QuantileSketch(*args)
+    cdef Py_ssize_t k, n = len(counts)
+
+    if n > 0:
+        sketch._reserve(offset, offset + n - 1)
+        for k in range(n):
+            sketch.counts[offset + k - sketch.offset] = counts[k]
+    sketch.zero_count = zero_count
+    sketch.count = count
+    sketch.min = low
+    sketch.max = high
+    return sketch
+
+
+cdef class QuantileSketch:
+    """A mergeable sketch of a distribution that answers quantile
+    queries using a fixed amount of memory.
+
+    Values are counted in logarithmically spaced buckets, so that any
+    quantile returned by :meth:`.quantile` is within a relative error
+    of ``rel_error`` of a true sample quantile. Values no larger than
+    ``min_value`` are counted in a separate bucket for zero. At most
+    ``max_bins`` buckets are kept; if the values span a wider range
+    then the lowest buckets are merged together, which only affects
+    the smallest quantiles.
+
+    Parameters
+    ----------
+    rel_error : float (optional, default: ``0.01``)
+        The relative accuracy of the quantiles, between 0 and 1.
+    min_value : float (optional, default: ``1e-9``)
+        Values that are at most this large are treated as zero.
+    max_bins : int (optional, default: ``2048``)
+        The largest number of buckets the sketch keeps.
+
+    Notes
+    -----
+    Two sketches with the same ``rel_error`` and ``min_value`` can be
+    combined with :meth:`.merge`, for example to pool the sketches of
+    several independent replications. Sketches can be pickled.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> import queueing_tool as qt
+    >>> sketch = qt.QuantileSketch(rel_error=0.01)
+    >>> for x in np.arange(1, 1001):
+    ...     sketch.add(x)
+    >>> abs(sketch.quantile(0.99) - 990) <= 0.01 * 990
+    True
+    """
+
+    def __init__(self, rel_error=0.01, min_value=1e-9, max_bins=2048):
+        if not 0 < rel_error < 1:
+            raise ValueError("rel_error must be between 0 and 1.")
+        elif not min_value > 0:
+            raise ValueError("min_value must be positive.")
+        elif max_bins < 1:
+            raise ValueError("max_bins must be a positive integer.")
+
+        self.rel_error = rel_error
+        self.min_value = min_value
+        self.max_bins = max_bins
+        self.gamma = (1 + rel_error) / (1 - rel_error)
+        self.log_gamma = log(self.gamma)
+        self.reset()
+
+    def __len__(self):
+        return self.count
+
+    def __reduce__(self):
+        counts = np.array(self.array_counts[:self.nbins], copy=True) if self.nbins > 0 else []
+        args = (self.rel_error, self.min_value, self.max_bins)
+        return (_rebuild, (args, self.offset, counts, self.zero_count,
+                           self.count, self.min, self.max))
+
+    def __repr__(self):
+        return 'QuantileSketch(rel_error={0}): {1} values'.format(self.rel_error, self.count)
+
+    def add(self, double x):
+        """Adds the value ``x`` to the sketch."""
+        self._add(x)
+
+    def copy(self):
+        """Returns a copy of the sketch."""
+        func, args = self.__reduce__()
+        return func(*args)
+
+    def merge(self, QuantileSketch other):
+        """Adds every value counted by ``other`` to this sketch.
+
+        Parameters
+        ----------
+        other : :class:`.QuantileSketch`
+            A sketch with the same ``rel_error`` and ``min_value``.
+
+        Raises
+        ------
+        ValueError
+            If the sketches have different ``rel_error`` or
+            ``min_value``.
+        """
+        cdef Py_ssize_t k, j, lo, hi
+
+        if other.rel_error != self.rel_error or other.min_value != self.min_value:
+            raise ValueError("Only sketches with the same rel_error and min_value can be merged.")
+
+        lo = other.nbins
+        hi = -1
+        for k in range(other.nbins):
+            if other.counts[k] > 0:
+                lo = min(lo, k)
+                hi = k
+
+        if hi >= 0:
+            self._reserve(other.offset + lo, other.offset + hi)
+            for k in range(lo, hi + 1):
+                j = other.offset + k - self.offset
+                self.counts[j if j > 0 else 0] += other.counts[k]
+
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Returns estimates of the ``q`` quantiles of the values added
+        to the sketch.
+
+        Parameters
+        ----------
+        q : float or *array_like*
+            The quantiles, each between 0 and 1.
+
+        Returns
+        -------
+        float or :class:`~numpy.ndarray`
+            The estimates, with the shape of ``q``. They are ``nan``
+            if the sketch is empty.
+        """
+        qs = np.asarray(q, dtype=float)
+        if np.any((qs < 0) | (qs > 1)):
+            raise ValueError("Quantiles must be between 0 and 1.")
+
+        out = np.array([self._quantile(p) for p in qs.ravel()]).reshape(qs.shape)
+        return float(out) if out.ndim == 0 else out
+
+    def reset(self):
+        """Removes every value from the sketch."""
+        self.array_counts = None
+        self.offset = 0
+        self.nbins = 0
+        self.count = 0
+        self.zero_count = 0
+        self.min = INFINITY
+        self.max = -INFINITY
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int _add(self, double x) except -1:
+        cdef Py_ssize_t k, j
+
+        if x <= self.min_value:
+            self.zero_count += 1
+        else:
+            k = <Py_ssize_t> ceil(log(x) / self.log_gamma)
+            j = k - self.offset
+            if j < 0 or j >= self.nbins:
+                self._reserve(k, k)
+                j = k - self.offset
+                if j < 0:
+                    j = 0
+            self.counts[j] += 1
+
+        self.count += 1
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+        return 0
+
+    cdef int _reserve(self, Py_ssize_t lo, Py_ssize_t hi) except -1:
+        # Makes room for the buckets lo through hi. If the buckets
+        # would span more than max_bins then the lowest are collapsed
+        # into the first one kept.
+        cdef Py_ssize_t k, j, n, m, new_lo
+
+        if self.nbins > 0:
+            if lo >= self.offset and hi < self.offset + self.nbins:
+                return 0
+            lo = min(lo, self.offset)
+            hi = max(hi, self.offset + self.nbins - 1)
+
+        if hi - lo + 1 > self.max_bins:
+            lo = hi - self.max_bins + 1
+
+        n = hi - lo + 1
+        m = min(max(n, 2 * self.nbins, 32), self.max_bins)
+        new_lo = lo - (m - n) // 2
+
+        array_counts = np.zeros(m, dtype=np.longlong)
+        cdef long long [::1] counts = array_counts
+        for k in range(self.nbins):
+            j = self.offset + k - new_lo
+            counts[j if j > 0 else 0] += self.counts[k]
+
+        self.array_counts = array_counts
+        self.counts = counts
+        self.offset = new_lo
+        self.nbins = m
+        return 0
+
+    cdef double _quantile(self, double q):
+        cdef double rank, cum, value
+        cdef Py_ssize_t k
+
+        if self.count == 0:
+            return NAN
+
+        rank = q * (self.count - 1)
+        cum = self.zero_count
+        if rank < cum:
+            value = 0.0
+        else:
+            value = self.max
+            for k in range(self.nbins):
+                cum += self.counts[k]
+                if cum > rank:
+                    value = 2 * pow(self.gamma, self.offset + k) / (self.gamma + 1)
+                    break
+
+        return min(max(value, self.min), self.max)
@@ -0,0 +1,594 @@
+import array
+import math
+
+import numpy as np
+
+from queueing_tool.queues.sketch import QuantileSketch
+
+
+class QueueStats(object):
+    """Running statistics for a single queue.
+
+    A :class:`.QueueServer` with ``collect_stats`` set updates its
+    ``QueueStats`` on every arrival and departure, using a constant
+    amount of memory however long the simulation runs. The mean and
+    variance of the waiting and sojourn times are kept with Welford's
+    algorithm, and the number of agents in the queue, waiting, and in
+    service are integrated over time, so time averages such as the
+    utilization are exact.
+
+    Use :meth:`.QueueServer.get_stats` or :meth:`.QueueNetwork.get_stats`
+    to read the statistics.
+
+    Attributes
+    ----------
+    t_start : float
+        The time the statistics started.
+    t_last : float
+        The time the integrals were last brought up to date.
+    area_system : float
+        The integral of ``num_system`` over time.
+    area_queued : float
+        The integral of the number of agents waiting for service.
+    area_busy : float
+        The integral of the number of agents in service.
+    num_waits, mean_wait, m2_wait : int, float, float
+        The count, mean and sum of squared differences from the mean
+        of the waiting times (the time from arrival until service
+        starts).
+    num_sojourns, mean_sojourn, m2_sojourn : int, float, float
+        The same for the sojourn times (the time from arrival until
+        departure).
+    wait_sketch, sojourn_sketch : :class:`.QuantileSketch` or ``None``
+        Sketches of the waiting and sojourn times, used for quantiles.
+        They are ``None`` unless quantiles were asked for.
+    """
+
+    keys = (
+        'elapsed',
+        'num_arrivals',
+        'num_departures',
+        'num_blocked',
+        'num_waits',
+        'mean_wait',
+        'var_wait',
+        'num_sojourns',
+        'mean_sojourn',
+        'var_sojourn',
+        'mean_num_system',
+        'mean_num_queued',
+        'mean_busy',
+        'utilization'
+    )
+
+    def __init__(self, t=0, queue=None, quantiles=False, rel_error=0.01):
+        self.wait_sketch = None
+        self.sojourn_sketch = None
+        self.start(t, queue, quantiles, rel_error)
+
+    def __repr__(self):
+        return 'QueueStats: {0} waits, {1} sojourns'.format(self.num_waits, self.num_sojourns)
+
+    def start(self, t, queue=None, quantiles=None, rel_error=None):
+        """Resets the statistics so they start at time ``t``.
+
+        If ``quantiles`` is ``True`` then sketches of the waiting and
+        sojourn times are kept as well, with relative accuracy
+        ``rel_error``. If either is ``None`` the current setting is
+        kept.
+        """
+        if quantiles is None:
+            quantiles = self.wait_sketch is not None
+        if rel_error is None:
+            rel_error = 0.01 if self.wait_sketch is None else self.wait_sketch.rel_error
+        if quantiles:
+            self.wait_sketch = QuantileSketch(rel_error)
+            self.sojourn_sketch = QuantileSketch(rel_error)
+        else:
+            self.wait_sketch = None
+            self.sojourn_sketch = None
+
+        self.t_start = t
+        self.t_last = t
+        self.area_system = 0.0
+        self.area_queued = 0.0
+        self.area_busy = 0.0
+        self.num_waits = 0
+        self.mean_wait = 0.0
+        self.m2_wait = 0.0
+        self.num_sojourns = 0
+        self.mean_sojourn = 0.0
+        self.m2_sojourn = 0.0
+
+        # The counters on the queue are read as differences from these.
+        self._counts0 = self._counts(queue)
+        self._final = None
+
+    @staticmethod
+    def _counts(queue):
+        if queue is None:
+            return (0, 0, 0)
+        return (queue._num_arrivals, queue.num_departures,
+                getattr(queue, 'num_blocked', 0))
+
+    def stop(self, t, queue):
+        """Brings the statistics up to time ``t`` and freezes the
+        counts taken from ``queue``.
+        """
+        self.advance(t, queue.num_system, len(queue.queue))
+        self._final = self._counts(queue)
+
+    def advance(self, t, num_system, num_queued):
+        """Adds the time since the last update to the integrals. Must
+        be called before the state of the queue changes.
+        """
+        dt = t - self.t_last
+        self.area_system += num_system * dt
+        self.area_queued += num_queued * dt
+        self.area_busy += (num_system - num_queued) * dt
+        self.t_last = t
+
+    def add_wait(self, x):
+        """Adds a waiting time."""
+        self.num_waits += 1
+        delta = x - self.mean_wait
+        self.mean_wait += delta / self.num_waits
+        self.m2_wait += delta * (x - self.mean_wait)
+        if self.wait_sketch is not None:
+            self.wait_sketch.add(x)
+
+    def add_sojourn(self, x):
+        """Adds a sojourn time."""
+        self.num_sojourns += 1
+        delta = x - self.mean_sojourn
+        self.mean_sojourn += delta / self.num_sojourns
+        self.m2_sojourn += delta * (x - self.mean_sojourn)
+        if self.sojourn_sketch is not None:
+            self.sojourn_sketch.add(x)
+
+    def quantiles(self, q):
+        """Returns the ``q`` quantiles of the waiting and sojourn times
+        as a dict with keys ``'wait'`` and ``'sojourn'``. The values
+        are ``nan`` if no sketches are kept.
+        """
+        out = {}
+        for key, sketch in [('wait', self.wait_sketch), ('sojourn', self.sojourn_sketch)]:
+            if sketch is None:
+                out[key] = np.full(np.shape(q), np.nan)
+            else:
+                out[key] = np.asarray(sketch.quantile(q))
+        return out
+
+    def summary(self, queue, t=None):
+        """Returns the statistics of ``queue`` up to time ``t`` as a
+        dict, see :meth:`.QueueServer.get_stats`.
+        """
+        t = self.t_last if t is None or t < self.t_last else t
+        if self._final is not None:
+            t = self.t_last
+        counts = self._counts(queue) if self._final is None else self._final
+        counts = [c - c0 for c, c0 in zip(counts, self._counts0)]
+
+        dt = t - self.t_last
+        num_queued = len(queue.queue)
+        area_system = self.area_system + queue.num_system * dt
+        area_queued = self.area_queued + num_queued * dt
+        area_busy = self.area_busy + (queue.num_system - num_queued) * dt
+        elapsed = t - self.t_start
+
+        def _mean(area):
+            return area / elapsed if elapsed > 0 else np.nan
+
+        def _var(m2, n):
+            return m2 / (n - 1) if n > 1 else np.nan
+
+        mean_busy = _mean(area_busy)
+        servers = queue.num_servers
+        return {
+            'elapsed': elapsed,
+            'num_arrivals': counts[0],
+            'num_departures': counts[1],
+            'num_blocked': counts[2],
+            'num_waits': self.num_waits,
+            'mean_wait': self.mean_wait if self.num_waits > 0 else np.nan,
+            'var_wait': _var(self.m2_wait, self.num_waits),
+            'num_sojourns': self.num_sojourns,
+            'mean_sojourn': self.mean_sojourn if self.num_sojourns > 0 else np.nan,
+            'var_sojourn': _var(self.m2_sojourn, self.num_sojourns),
+            'mean_num_system': _mean(area_system),
+            'mean_num_queued': _mean(area_queued),
+            'mean_busy': mean_busy,
+            'utilization': mean_busy / servers if servers > 0 else np.nan
+        }
+
+
+class SojournStats(object):
+    """Running statistics of the time agents spend in a network.
+
+    A :class:`.QueueNetwork` collecting sojourn statistics updates
+    them each time an agent is routed onto an edge with a
+    :class:`.NullQueue`, which is where agents leave the network. For
+    every agent it records the time since the agent arrived from
+    outside the network, the number of queues it was served at, and
+    the number of times it was blocked. The statistics are kept
+    separately for each edge agents enter the network through, in
+    arrays indexed by edge index.
+
+    Parameters
+    ----------
+    num_edges : int
+        The number of edges in the network.
+    t : float (optional, default: ``0``)
+        The time the statistics start. Agents that entered the network
+        before then are not counted.
+
+    Attributes
+    ----------
+    num : :class:`~numpy.ndarray`
+        The number of agents that left the network.
+    mean, m2 : :class:`~numpy.ndarray`
+        The mean and sum of squared differences from the mean of the
+        sojourn times.
+    hops, blocked : :class:`~numpy.ndarray`
+        The total number of queues visited and the total number of
+        times agents were blocked.
+    """
+
+    def __init__(self, num_edges, t=0):
+        self.num_edges = num_edges
+        self.start(t)
+
+    def __repr__(self):
+        return 'SojournStats: {0} sojourns'.format(np.sum(self.num))
+
+    def start(self, t):
+        """Resets the statistics so they start at time ``t``."""
+        self.t_start = t
+        self.num = np.zeros(self.num_edges, np.int_)
+        self.mean = np.zeros(self.num_edges)
+        self.m2 = np.zeros(self.num_edges)
+        self.hops = np.zeros(self.num_edges, np.int_)
+        self.blocked = np.zeros(self.num_edges, np.int_)
+
+    def add(self, edge, x, hops, blocked):
+        """Adds the sojourn time ``x`` of an agent that entered the
+        network at the edge with index ``edge``.
+        """
+        self.num[edge] += 1
+        delta = x - self.mean[edge]
+        self.mean[edge] += delta / self.num[edge]
+        self.m2[edge] += delta * (x - self.mean[edge])
+        self.hops[edge] += hops
+        self.blocked[edge] += blocked
+
+    def summary(self, by_entry=True):
+        """Returns the statistics as a dict, see
+        :meth:`.QueueNetwork.get_sojourns`.
+        """
+        num, mean, m2 = self.num, self.mean, self.m2
+        hops, blocked = self.hops, self.blocked
+
+        if not by_entry:
+            # Chan et al.'s formula for combining the variances.
+            n = np.sum(num)
+            total = np.sum(num * mean) / n if n > 0 else 0.0
+            m2 = np.sum(m2 + num * (mean - total) ** 2)
+            num, mean = n, total
+            hops, blocked = np.sum(hops), np.sum(blocked)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out = {
+                'num_sojourns': num,
+                'mean_sojourn': np.where(num > 0, mean, np.nan),
+                'var_sojourn': np.where(num > 1, m2 / (num - 1), np.nan),
+                'mean_hops': np.where(num > 0, hops / num, np.nan),
+                'mean_blocked': np.where(num > 0, blocked / num, np.nan)
+            }
+
+        if not by_entry:
+            out = {key: np.asarray(value).item() for key, value in out.items()}
+        return out
+
+
+class BatchMeans(object):
+    """Confidence intervals from batch means, in constant memory.
+
+    A long run is cut into batches, and each batch adds a total and a
+    weight, for example the sum and the number of waiting times seen
+    during the batch. The estimate is the ratio of the grand totals.
+    Its confidence interval comes from the spread of the batch means,
+    which are close to independent once the batches are long.
+
+    At most ``2 * num_batches`` batches are kept. When there are more,
+    neighbouring batches are merged in pairs, so the batches get
+    longer as the run does while their number stays between
+    ``num_batches`` and ``2 * num_batches``.
+
+    Parameters
+    ----------
+    num_batches : int (optional, default: ``20``)
+        The fewest batches a confidence interval is computed from. It
+        must be at least ``5``.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from queueing_tool.queues.stats import BatchMeans
+    >>> rng = np.random.default_rng(3)
+    >>> bm = BatchMeans()
+    >>> for x in rng.normal(10, 2, (1000, 50)):
+    ...     bm.add(x.sum(), len(x))
+    >>> bool(abs(bm.estimate() - 10) < bm.half_width(0.99))
+    True
+    """
+
+    def __init__(self, num_batches=20):
+        if num_batches < 5:
+            raise ValueError("num_batches must be at least 5.")
+
+        self.num_batches = num_batches
+        self.totals = []
+        self.weights = []
+        self.batch_size = 1
+        self._fill = 0
+
+    def __len__(self):
+        return len(self.totals)
+
+    def __repr__(self):
+        return 'BatchMeans: {0} batches of {1}'.format(len(self), self.batch_size)
+
+    def add(self, total, weight, parts=1):
+        """Adds the total and the weight of the next ``parts`` parts
+        of the run.
+
+        Each batch is made of ``batch_size`` parts, and ``parts`` must
+        be no more than the number the last batch is missing, see
+        :attr:`remaining`.
+        """
+        if self._fill == 0:
+            self.totals.append(total)
+            self.weights.append(weight)
+        else:
+            self.totals[-1] += total
+            self.weights[-1] += weight
+
+        self._fill = (self._fill + parts) % self.batch_size
+        if self._fill == 0 and len(self.totals) == 2 * self.num_batches:
+            self.totals = [a + b for a, b in zip(self.totals[::2], self.totals[1::2])]
+            self.weights = [a + b for a, b in zip(self.weights[::2], self.weights[1::2])]
+            self.batch_size *= 2
+
+    @property
+    def remaining(self):
+        """The number of parts until the last batch is complete."""
+        return self.batch_size - self._fill
+
+    def estimate(self):
+        """Returns the ratio of the grand totals, or ``nan``."""
+        weight = sum(self.weights)
+        return sum(self.totals) / weight if weight > 0 else np.nan
+
+    def half_width(self, confidence=0.95):
+        """Returns the half width of the ``confidence`` level interval
+        around :meth:`estimate`, or ``nan`` if there are fewer than
+        ``num_batches`` complete batches or one of them has no weight.
+        """
+        num = len(self.totals) - (self._fill > 0)
+        weights = np.asarray(self.weights[:num], float)
+        if num < self.num_batches or not (weights > 0).all():
+            return np.nan
+
+        means = np.asarray(self.totals[:num]) / weights
+        quantile = _t_quantile(0.5 + confidence / 2.0, num - 1)
+        return quantile * np.std(means, ddof=1) / math.sqrt(num)
+
+
+def mser_truncation(means, batch=5):
+    """Returns the number of observations to drop from the start of a
+    series to remove its initial transient, with the MSER rule.
+
+    The observations are averaged in batches of ``batch``, and the
+    truncation point ``d`` minimizes the MSER statistic
+
+    .. math::
+
+       \\frac{1}{(m - d)^2} \\sum_{j=d+1}^m (Y_j - \\bar{Y}_{m,d})^2
+
+    over the first half of the ``m`` batch means :math:`Y_j`. A minimum
+    at the end of that range means the series is too short to tell,
+    and ``None`` is returned.
+
+    Parameters
+    ----------
+    means : *array_like*
+        The observations, in order.
+    batch : int (optional, default: ``5``)
+        The number of observations in each batch.
+
+    Returns
+    -------
+    int or ``None``
+        The number of observations to drop, a multiple of ``batch``.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from queueing_tool.queues.stats import mser_truncation
+    >>> rng = np.random.default_rng(1)
+    >>> x = 5 + rng.normal(size=2000)
+    >>> x[:200] += np.linspace(10, 0, 200)
+    >>> d = mser_truncation(x)
+    >>> bool(100 <= d <= 300)
+    True
+    >>> mser_truncation(x[:300]) is None
+    True
+    """
+    means = np.asarray(means, float)
+    m = len(means) // batch
+    if m < 4:
+        return None
+
+    y = means[:m * batch].reshape(m, batch).mean(axis=1)
+    # The sums over the tails y[d:], for every d.
+    s1 = np.cumsum(y[::-1])[::-1]
+    s2 = np.cumsum(y[::-1]**2)[::-1]
+    n = np.arange(m, 0, -1, dtype=float)
+    stat = (s2 - s1**2 / n) / n**2
+
+    half = m // 2
+    d = int(np.argmin(stat[:half + 1]))
+    return d * batch if d < half else None
+
+
+class StateLog(object):
+    """A log of the number of agents in a queue over time.
+
+    A :class:`.QueueServer` with ``collect_states`` set appends the
+    time and its new ``num_system`` every time ``num_system`` changes.
+    The log is a step function, so time averages over any window can
+    be computed exactly; see :meth:`.average`.
+
+    Parameters
+    ----------
+    compress : bool (optional, default: ``True``)
+        If ``True`` then a change to the value the log already ends
+        with is not recorded, and a change at the same time as the
+        last record replaces it. Neither affects the time averages.
+
+    Attributes
+    ----------
+    times : :class:`~array.array`
+        The times of the records, in non-decreasing order.
+    values : :class:`~array.array`
+        The value of ``num_system`` from each time until the next one.
+    t_end : float
+        The time the log stopped, or ``inf`` while it is running.
+    """
+
+    metrics = ('num_system', 'num_queued', 'num_busy', 'utilization')
+
+    def __init__(self, compress=True):
+        self.compress = compress
+        self.start(0, 0)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __repr__(self):
+        return 'StateLog: {0} records'.format(len(self.times))
+
+    def start(self, t, value):
+        """Throws away the log and starts it again at time ``t``."""
+        self.times = array.array('d', [t])
+        self.values = array.array('l', [value])
+        self.t_end = np.inf
+
+    def stop(self, t):
+        """Stops the log at time ``t``."""
+        self.t_end = t
+
+    def append(self, t, value):
+        """Records that the value changed to ``value`` at time ``t``."""
+        if self.compress:
+            if self.values[-1] == value:
+                return
+            elif self.times[-1] == t:
+                self.values[-1] = value
+                return
+        self.times.append(t)
+        self.values.append(value)
+
+    def end(self, t=None):
+        """Returns the time the log runs until: ``t_end`` if it has
+        stopped, otherwise ``t`` or, if that is ``None``, the time of
+        the last record.
+        """
+        if self.t_end < np.inf:
+            return self.t_end
+        return self.times[-1] if t is None else max(t, self.times[-1])
+
+    def series(self, grid, metric='num_system', num_servers=1, t=None):
+        """Returns the time average of ``metric`` over each interval
+        between consecutive times in ``grid``.
+
+        Parameters
+        ----------
+        grid : *array_like*
+            Increasing times.
+        metric : str (optional, default: ``'num_system'``)
+            One of ``'num_system'``, ``'num_queued'`` (the number of
+            agents waiting for service), ``'num_busy'`` (the number
+            in service), or ``'utilization'`` (``num_busy`` divided by
+            ``num_servers``).
+        num_servers : int (optional, default: ``1``)
+            The number of servers used for the last three metrics.
+        t : float (optional)
+            The current time, used as the end of a log that is still
+            running; see :meth:`.end`.
+
+        Returns
+        -------
+        :class:`~numpy.ndarray`
+            An array with one fewer entry than ``grid``. Parts of an
+            interval outside of the log are ignored, and intervals
+            that do not overlap the log are ``nan``.
+        """
+        times = np.array(self.times)
+        values = _metric(np.array(self.values), metric, num_servers)
+
+        cum = np.zeros(len(times))
+        np.cumsum(values[:-1] * np.diff(times), out=cum[1:])
+
+        grid = np.clip(np.asarray(grid, dtype=float), times[0], self.end(t))
+        k = np.searchsorted(times, grid, side='right') - 1
+        area = cum[k] + values[k] * (grid - times[k])
+
+        dt = np.diff(grid)
+        out = np.full(len(dt), np.nan)
+        np.divide(np.diff(area), dt, out=out, where=dt > 0)
+        return out
+
+    def average(self, t0=None, t1=None, metric='num_system', num_servers=1, t=None):
+        """Returns the time average of ``metric`` between ``t0`` and
+        ``t1``, which default to the start and end of the log. The
+        other parameters are the same as for :meth:`.series`.
+        """
+        t0 = self.times[0] if t0 is None else t0
+        t1 = self.end(t) if t1 is None else t1
+        return self.series([t0, t1], metric, num_servers, t)[0]
+
+
+def _metric(values, metric, num_servers):
+    if metric == 'num_system':
+        return values.astype(float)
+    elif metric == 'num_queued':
+        return np.maximum(values - num_servers, 0).astype(float)
+    elif metric == 'num_busy':
+        return np.minimum(values, num_servers).astype(float)
+    elif metric == 'utilization':
+        return np.minimum(values, num_servers) / float(num_servers)
+    raise ValueError("metric must be one of {0}.".format(', '.join(StateLog.metrics)))
+
+
+def _normal_quantile(p):
+    # Inverts the normal CDF by bisection.
+    lo, hi = -40.0, 40.0
+    for k in range(100):
+        mid = (lo + hi) / 2.0
+        if 0.5 * math.erfc(-mid / math.sqrt(2)) < p:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2.0
+
+
+def _t_quantile(p, df):
+    # The Cornish-Fisher expansion of the quantile of Student's t
+    # distribution about the normal one (Abramowitz and Stegun 26.7.5).
+    z = _normal_quantile(p)
+    g1 = (z**3 + z) / 4.0
+    g2 = (5 * z**5 + 16 * z**3 + 3 * z) / 96.0
+    g3 = (3 * z**7 + 19 * z**5 + 17 * z**3 - 15 * z) / 384.0
+    g4 = (79 * z**9 + 776 * z**7 + 1482 * z**5 - 1920 * z**3 - 945 * z) / 92160.0
+    return z + g1 / df + g2 / df**2 + g3 / df**3 + g4 / df**4
@@ -11,14 +11,18 @@ except ImportError:
 
 
 python_version = sys.version_info[:2]
-if python_version < (2, 7) or (3, 0) <= python_version < (3, 3):
-    raise RuntimeError('Python version 2.7 or >= 3.3 required.')
+if python_version < (3, 5):
+    raise RuntimeError('Python version >= 3.5 required.')
 
 cmdclass = {'build_ext': build_ext}
 
 extension_paths = [
     'queueing_tool.network.priority_queue',
-    'queueing_tool.queues.choice'
+    'queueing_tool.network._simulate',
+    'queueing_tool.queues.agent_heap',
+    'queueing_tool.queues.choice',
+    'queueing_tool.queues.distributions',
+    'queueing_tool.queues.sketch'
 ]
 
 ext_modules = [
@@ -43,10 +47,8 @@ classifiers = [
     'Operating System :: Microsoft :: Windows',
     'Operating System :: POSIX :: Linux',
     'Operating System :: Unix',
-    'Programming Language :: Python :: 2',
-    'Programming Language :: Python :: 2.7',
     'Programming Language :: Python :: 3',
-    'Programming Language :: Python :: 3.4',
+    'Programming Language :: Python :: 3 :: Only',
     'Programming Language :: Python :: 3.5',
     'Programming Language :: Python :: 3.6',
     'Programming Language :: Python :: 3.7',
@@ -55,7 +57,7 @@ classifiers = [
     'Topic :: Scientific/Engineering :: Mathematics'
 ]
 
-install_requires = ['networkx>=1.9', 'numpy>=1.9']
+install_requires = ['networkx>=1.9', 'numpy>=1.17']
 
 keywords = [
     'queueing theory',
@@ -80,9 +82,6 @@ tests_require = [
     'pytest-sugar>=0.7.1',
 ]
 
-if python_version[0] == 2:
-    tests_require.append('mock')
-
 setup(
     author='Daniel Jordon',
     author_email='dan.jordon@gmail.com',
@@ -96,6 +95,7 @@ setup(
     license='MIT',
     name='queueing-tool',
     packages=packages,
+    python_requires='>=3.5',
     tests_require=tests_require,
     test_suite='nose.collector',
     url='https://github.com/djordon/queueing-tool',
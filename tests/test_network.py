@@ -1,4 +1,7 @@
 import os
+import pickle
+import shutil
+import tempfile
 import unittest
 try:
     import unittest.mock as mock
@@ -11,6 +14,18 @@ try:
 except ImportError:
     HAS_MATPLOTLIB = False
 
+try:
+    import pandas as pd
+    HAS_PANDAS = True
+except ImportError:
+    HAS_PANDAS = False
+
+try:
+    import pyarrow as pa
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
 import networkx as nx
 import numpy as np
 
@@ -40,16 +55,46 @@ class TestQueueNetwork(unittest.TestCase):
         ans = np.zeros(num_events, bool)
         na = np.zeros(self.qn.nE, int)
         for q in self.qn.edge2queue:
-            na[q.edge[2]] = len(q._arrivals) + len(q._departures) + len(q.queue) - 2
+            na[q.edge[2]] = len(q._arrivals) + len(q._departures) + len(q.queue)
 
         for k in range(num_events):
             ans[k] = (self.qn.num_agents == na).all()
             self.qn.simulate(n=1)
             for q in self.qn.edge2queue:
-                na[q.edge[2]] = len(q._arrivals) + len(q._departures) + len(q.queue) - 2
+                na[q.edge[2]] = len(q._arrivals) + len(q._departures) + len(q.queue)
 
         self.assertTrue(ans.all())
 
+    def test_QueueNetwork_agent_counts(self):
+
+        def check(qn):
+            by_type = {}
+            by_vertex = np.zeros(qn.nV, int)
+            for q in qn.edge2queue:
+                by_type[q.edge[3]] = by_type.get(q.edge[3], 0) + qn.num_agents[q.edge[2]]
+                by_vertex[q.edge[1]] += q.num_system
+
+            self.assertEqual(qn.total_agents, np.sum(qn.num_agents))
+            self.assertEqual(qn.agents_by_type, by_type)
+            self.assertTrue((qn.agents_by_vertex == by_vertex).all())
+
+        check(self.qn)
+        for k in range(500):
+            self.qn.simulate(n=1)
+            check(self.qn)
+
+        self.qn.simulate(n=5000)
+        check(self.qn)
+        check(self.qn.copy())
+        self.assertIn('agents: {0}'.format(self.qn.total_agents), repr(self.qn))
+
+        self.qn.clear()
+        check(self.qn)
+        self.assertEqual(self.qn.total_agents, 0)
+
+        with self.assertRaises(AttributeError):
+            self.qn.total_agents = 10
+
     def test_QueueNetwork_add_arrival(self):
 
         adj = {0: [1], 1: [2, 3]}
@@ -120,12 +165,12 @@ class TestQueueNetwork(unittest.TestCase):
         ans = np.zeros(num_events, bool)
         na = np.zeros(self.qn.nE, int)
         for q in self.qn.edge2queue:
-            na[q.edge[2]] = len(q._arrivals) + len(q._departures) + len(q.queue) - 2
+            na[q.edge[2]] = len(q._arrivals) + len(q._departures) + len(q.queue)
 
         for k in range(num_events):
             ans[k] = np.sum(self.qn.num_agents) >= np.sum(na)
             for q in self.qn.edge2queue:
-                na[q.edge[2]] = len(q._arrivals) + len(q._departures) + len(q.queue) - 2
+                na[q.edge[2]] = len(q._arrivals) + len(q._departures) + len(q.queue)
 
             self.qn.simulate(n=1)
 
@@ -222,6 +267,440 @@ class TestQueueNetwork(unittest.TestCase):
         self.assertTrue((c == dat0[dat0[:, 2] > 0, 2]).all())
         self.assertTrue((dat0[1:, 0] == dat0[dat0[:, 2] > 0, 2]).all())
 
+    def test_QueueNetwork_get_agent_data_arrays(self):
+        g = qt.generate_random_graph(30, seed=5)
+        qn = qt.QueueNetwork(g, seed=5)
+        qn.initialize(queues=range(qn.nE))
+        qn.start_collecting_data()
+        qn.simulate(n=10000)
+
+        data = qn.get_agent_data()
+        agent_ids, offsets, dat = qn.get_agent_data(as_dict=False)
+
+        self.assertEqual(len(agent_ids), len(data))
+        self.assertEqual(len(dat), len(qn.get_queue_data()))
+        for k, agent_id in enumerate(agent_ids.tolist()):
+            rows = dat[offsets[k]:offsets[k + 1]]
+            self.assertTrue((rows == data[tuple(agent_id)]).all())
+            self.assertTrue((np.diff(rows[:, 0]) >= 0).all())
+
+    def test_QueueNetwork_iter_events(self):
+        g = qt.generate_random_graph(30, seed=11)
+        qn1 = qt.QueueNetwork(g, seed=11)
+        qn1.initialize(queues=range(qn1.nE))
+        qn2 = qn1.copy()
+        qn3 = qn1.copy()
+
+        qn1.start_collecting_data()
+        qn1.simulate(n=10000)
+        data = qn1.get_queue_data()
+
+        qn2.start_collecting_data()
+        batches = list(qn2.iter_events(n=10000, batch=500))
+        self.assertTrue(all(len(b) <= 500 for b in batches))
+        self.assertEqual(qn2.num_events, 10000)
+
+        visits = np.concatenate(batches)
+        streamed = np.column_stack([visits[name] for name in visits.dtype.names[:6]])
+        # The visits still in progress are all that is left
+        pending = qn2.get_queue_data()
+        self.assertTrue((pending[:, 2] == 0).all())
+        self.assertLess(len(qn2._data.edge), 2 * len(pending) + 2048)
+
+        ans = np.vstack((streamed, pending))
+        ans = ans[np.lexsort(ans[:, ::-1].T)]
+        data = data[np.lexsort(data[:, ::-1].T)]
+        np.testing.assert_array_equal(ans, data)
+
+        # Collection started by iter_events stops when it is done
+        visits = np.concatenate(list(qn3.iter_events(n=10000, batch=500)))
+        self.assertEqual(len(visits), len(streamed))
+        self.assertFalse(any(q.collect_data for q in qn3.edge2queue))
+        self.assertEqual(len(qn3.get_queue_data()), 0)
+
+        events = qn3.iter_events(n=10000, batch=10)
+        next(events)
+        self.assertTrue(all(q.collect_data for q in qn3.edge2queue))
+        events.close()
+        self.assertFalse(any(q.collect_data for q in qn3.edge2queue))
+        self.assertEqual(len(qn3.get_queue_data()), 0)
+
+    def test_QueueNetwork_iter_events_sink(self):
+        g = qt.generate_random_graph(30, seed=12)
+        qn = qt.QueueNetwork(g, seed=12)
+        qn.initialize(queues=range(qn.nE))
+
+        batches = []
+        qn.start_collecting_data(sink=batches.append, batch=100)
+        with self.assertRaises(ValueError):
+            next(qn.iter_events(n=5000))
+        self.assertEqual(qn.num_events, 0)
+
+        # Without the sink every completed visit is yielded
+        qn.stop_collecting_data()
+        qn2 = qn.copy()
+        visits = np.concatenate(list(qn.iter_events(n=5000, batch=100)))
+        self.assertEqual(batches, [])
+
+        qn2.start_collecting_data()
+        qn2.simulate(n=5000)
+        self.assertEqual(len(visits), qn2._data.num_done)
+
+    def test_QueueNetwork_data_sink(self):
+        g = qt.generate_random_graph(30, seed=12)
+        qn = qt.QueueNetwork(g, seed=12)
+        qn.initialize(queues=range(qn.nE))
+
+        batches = []
+        qn.start_collecting_data(sink=batches.append, batch=100)
+        qn.simulate(n=5000)
+
+        self.assertTrue(all(len(b) == 100 for b in batches))
+        self.assertLess(len(qn._data), 100 + qn.num_agents.sum())
+
+        num_visits = sum(len(b) for b in batches) + len(qn._data)
+        qn.stop_collecting_data()
+        self.assertEqual(sum(len(b) for b in batches), num_visits)
+        self.assertEqual(len(qn._data), 0)
+        self.assertIsNone(qn._data.sink)
+
+    def test_QueueNetwork_disk_store(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        g = qt.generate_random_graph(30, seed=13)
+        qn1 = qt.QueueNetwork(g, seed=13)
+        qn1.initialize(queues=range(qn1.nE))
+        qn2 = qn1.copy()
+
+        qn1.start_collecting_data()
+        qn1.simulate(n=10000)
+
+        store = qt.DiskDataStore(path, chunk_size=500)
+        qn2.start_collecting_data(store=store)
+        qn2.simulate(n=10000)
+        self.assertGreater(len(store.index), 1)
+        self.assertLess(len(qn2._data.edge), len(qn1._data.edge))
+
+        for kwargs in [{}, {'queues': [3, 1, 4]}, {'window': (5, 10)},
+                       {'queues': range(10), 'window': (2, 3)}]:
+            data1 = qn1.get_queue_data(**kwargs)
+            data2 = qn2.get_queue_data(**kwargs)
+            np.testing.assert_array_equal(data1, data2)
+
+            ids1, offsets1, agents1 = qn1.get_agent_data(as_dict=False, **kwargs)
+            ids2, offsets2, agents2 = qn2.get_agent_data(as_dict=False, **kwargs)
+            np.testing.assert_array_equal(ids1, ids2)
+            np.testing.assert_array_equal(offsets1, offsets2)
+            np.testing.assert_array_equal(agents1, agents2)
+
+        qn2.stop_collecting_data()
+        self.assertEqual(len(qn2._data), 0)
+        self.assertEqual(len(qt.DiskDataStore(path)), len(qn1.get_queue_data()))
+
+        # The index has one line per chunk, added as each one is written
+        with open(os.path.join(path, 'index.jsonl')) as f:
+            self.assertEqual(len(f.readlines()), len(store.index))
+        self.assertEqual(qt.DiskDataStore(path).index, store.index)
+
+    def test_QueueNetwork_sqlite_store(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        g = qt.generate_random_graph(30, seed=14)
+        qn1 = qt.QueueNetwork(g, seed=14)
+        qn1.initialize(queues=range(qn1.nE))
+        qn2 = qn1.copy()
+
+        with self.assertRaises(qt.QueueingToolError):
+            qn2.query_data('SELECT * FROM visits')
+
+        qn1.start_collecting_data()
+        qn1.simulate(n=10000)
+
+        store = qt.SQLiteDataStore(os.path.join(path, 'visits.db'), chunk_size=500)
+        qn2.start_collecting_data(store=store)
+        qn2.simulate(n=10000)
+        self.assertGreater(len(store), 0)
+        self.assertLess(len(qn2._data.edge), len(qn1._data.edge))
+
+        for kwargs in [{}, {'queues': [3, 1, 4]}, {'window': (5, 10)}]:
+            data1 = qn1.get_queue_data(**kwargs)
+            data2 = qn2.get_queue_data(**kwargs)
+            np.testing.assert_array_equal(data1, data2)
+
+            ids1, offsets1, agents1 = qn1.get_agent_data(as_dict=False, **kwargs)
+            ids2, offsets2, agents2 = qn2.get_agent_data(as_dict=False, **kwargs)
+            np.testing.assert_array_equal(ids1, ids2)
+            np.testing.assert_array_equal(offsets1, offsets2)
+            np.testing.assert_array_equal(agents1, agents2)
+
+        # Queries see every completed visit, including those that were
+        # still in memory.
+        data = qn1.get_queue_data()
+        done = data[data[:, 2] > 0]
+        rows = qn2.query_data('SELECT edge, COUNT(*), SUM(departure - arrival) '
+                              'FROM visits WHERE departure > 0 GROUP BY edge')
+        for edge, num, total in rows:
+            sojourns = done[done[:, 5] == edge]
+            self.assertEqual(num, len(sojourns))
+            self.assertAlmostEqual(total, np.sum(sojourns[:, 2] - sojourns[:, 0]))
+
+        agents = qn1.get_agent_data()
+        agent_id = sorted(agents)[0]
+        rows = qn2.query_data('SELECT arrival FROM visits WHERE agent_edge = ? '
+                              'AND agent_num = ? ORDER BY arrival', agent_id)
+        arrivals = agents[agent_id][agents[agent_id][:, 2] > 0, 0]
+        np.testing.assert_array_equal([r[0] for r in rows], arrivals)
+
+        qn2.stop_collecting_data()
+        store.close()
+        store = qt.SQLiteDataStore(os.path.join(path, 'visits.db'))
+        self.assertEqual(len(store), len(data))
+        store.close()
+
+    def test_QueueNetwork_stats(self):
+        g = qt.generate_random_graph(40, seed=21)
+        q_cls = {1: qt.LossQueue, 2: qt.QueueServer, 3: qt.QueueServer}
+        q_args = {1: {'num_servers': 2, 'qbuffer': 1}, 2: {'num_servers': 3}}
+        qn = qt.QueueNetwork(g, q_classes=q_cls, q_args=q_args, seed=21)
+        qn.initialize(queues=range(qn.nE))
+        qn.simulate(n=500)
+        qn.start_collecting_stats(edge_type=(1, 2))
+
+        qn1, qn2 = qn.copy(), qn.copy()
+        qn1.simulate(n=20000)
+        for k in range(20000):
+            qn2._simulate_next_event(slow=False)
+
+        stats1 = qn1.get_stats()
+        stats2 = qn2.get_stats()
+        for key in stats1:
+            np.testing.assert_allclose(stats1[key], stats2[key], rtol=1e-10)
+
+        types = np.array([q.edge[3] for q in qn1.edge2queue])
+        self.assertTrue(np.isnan(stats1['mean_wait'][types == 3]).all())
+        self.assertFalse(np.isnan(stats1['mean_wait'][types == 1]).any())
+
+        qn1.stop_collecting_stats()
+        qn1.simulate(n=1000)
+        stats3 = qn1.get_stats()
+        for key in stats1:
+            np.testing.assert_allclose(stats1[key], stats3[key], rtol=1e-10)
+
+    def test_QueueNetwork_quantiles(self):
+        g = qt.generate_random_graph(40, seed=22)
+        q_cls = {1: qt.LossQueue, 2: qt.QueueServer, 3: qt.QueueServer}
+        q_args = {1: {'num_servers': 2, 'qbuffer': 1}, 2: {'num_servers': 3}}
+        qn = qt.QueueNetwork(g, q_classes=q_cls, q_args=q_args, seed=22)
+        qn.initialize(queues=range(qn.nE))
+        qn.start_collecting_stats(edge_type=(1, 2), quantiles=True)
+
+        qn1, qn2 = qn, qn.copy()
+        qn1.simulate(n=20000)
+        for k in range(20000):
+            qn2._simulate_next_event(slow=False)
+
+        p = [0.5, 0.95, 0.99]
+        q1 = qn1.get_quantiles(p)
+        q2 = qn2.get_quantiles(p)
+        for key in ['wait', 'sojourn']:
+            self.assertEqual(q1[key].shape, (qn.nE, 3))
+            np.testing.assert_array_equal(q1[key], q2[key])
+
+        types = np.array([q.edge[3] for q in qn1.edge2queue])
+        self.assertTrue(np.isnan(q1['wait'][types == 3]).all())
+        self.assertFalse(np.isnan(q1['sojourn'][types == 2]).any())
+
+        sketches = qn1.get_sketches(edge_type=2)
+        merged = qn1.get_quantiles(p, edge_type=2, merge=True)
+        stats = qn1.get_stats()
+        self.assertEqual(len(sketches['sojourn']), np.sum(stats['num_sojourns'][types == 2]))
+        np.testing.assert_array_equal(merged['sojourn'], sketches['sojourn'].quantile(p))
+
+    def test_QueueNetwork_states(self):
+        g = qt.generate_random_graph(40, seed=23)
+        q_cls = {1: qt.LossQueue, 2: qt.QueueServer, 3: qt.QueueServer}
+        q_args = {1: {'num_servers': 2, 'qbuffer': 1}, 2: {'num_servers': 3}}
+        qn = qt.QueueNetwork(g, q_classes=q_cls, q_args=q_args, seed=23)
+        qn.initialize(queues=range(qn.nE))
+        qn.simulate(n=500)
+        qn.start_collecting_states(edge_type=(1, 2))
+        qn.start_collecting_stats(edge_type=(1, 2))
+
+        qn1, qn2 = qn, qn.copy()
+        qn1.simulate(n=20000)
+        for k in range(20000):
+            qn2._simulate_next_event(slow=False)
+
+        types = np.array([q.edge[3] for q in qn1.edge2queue])
+        stats = qn1.get_stats()
+        for metric, key in [('num_system', 'mean_num_system'),
+                            ('num_queued', 'mean_num_queued'),
+                            ('utilization', 'utilization')]:
+            avg1 = qn1.time_average(metric)
+            avg2 = qn2.time_average(metric)
+            np.testing.assert_allclose(avg1, avg2, rtol=1e-10)
+            np.testing.assert_allclose(avg1, stats[key], rtol=1e-8)
+            self.assertTrue(np.isnan(avg1[types == 3]).all())
+
+        # The averages over a grid combine into the average over the
+        # whole window.
+        t0, t1 = qn1.current_time / 4, qn1.current_time / 2
+        k = np.flatnonzero(types == 2)[0]
+        grid = np.linspace(t0, t1, 11)
+        series = qn1.occupancy_series(k, grid)
+        total = qn1.time_average(t0=t0, t1=t1, queues=k)[k]
+        self.assertAlmostEqual(series.mean(), total)
+
+        qn1.stop_collecting_states()
+        qn1.simulate(n=1000)
+        np.testing.assert_allclose(qn1.time_average('num_system'),
+                                   stats['mean_num_system'], rtol=1e-8)
+
+    def test_QueueNetwork_sojourns(self):
+        g = qt.generate_random_graph(60, seed=5)
+        qn = qt.QueueNetwork(g, q_args={2: {'qbuffer': 1}}, seed=5)
+        qn.initialize(edge_type=1)
+        qn.start_collecting_sojourns()
+        qn.start_collecting_data()
+
+        qn1, qn2 = qn, qn.copy()
+        qn1.simulate(n=40000)
+        for k in range(40000):
+            qn2._simulate_next_event(slow=False)
+
+        res1 = qn1.get_sojourns()
+        res2 = qn2.get_sojourns()
+        for key in res1:
+            np.testing.assert_allclose(res1[key], res2[key], rtol=1e-10)
+
+        # Rebuild the sojourn times from the data on each agent.
+        types = np.array([q.edge[3] for q in qn1.edge2queue])
+        sojourns, hops = [], []
+        for agent_id, dat in qn1.get_agent_data().items():
+            if types[int(dat[-1, 5])] == 0:
+                sojourns.append(dat[-1, 0] - dat[0, 0])
+                hops.append(len(dat) - 1)
+
+        total = qn1.get_sojourns(by_entry=False)
+        self.assertEqual(total['num_sojourns'], len(sojourns))
+        self.assertAlmostEqual(total['mean_sojourn'], np.mean(sojourns))
+        self.assertAlmostEqual(total['var_sojourn'], np.var(sojourns, ddof=1))
+        self.assertAlmostEqual(total['mean_hops'], np.mean(hops))
+        self.assertEqual(np.sum(res1['num_sojourns'][types != 1]), 0)
+
+        qn1.stop_collecting_sojourns()
+        qn1.simulate(n=5000)
+        self.assertEqual(qn1.get_sojourns(False)['num_sojourns'], len(sojourns))
+
+    def test_QueueNetwork_sampled_data(self):
+        g = qt.generate_random_graph(50, seed=24)
+        qn = qt.QueueNetwork(g, seed=24)
+        qn.initialize(edge_type=1)
+        qn.simulate(n=100)
+
+        qn1, qn2, qn3 = qn.copy(), qn.copy(), qn.copy()
+        qn1.start_collecting_data()
+        qn2.start_collecting_data(sample_rate=0.2)
+        qn3.start_collecting_data(every=5)
+        for net in [qn1, qn2, qn3]:
+            net.simulate(n=20000)
+
+        # Sampling doesn't change the simulation, and every visit of a
+        # sampled agent is recorded.
+        self.assertEqual(qn1.current_time, qn2.current_time)
+        full = qn1.get_agent_data()
+        for net in [qn2, qn3]:
+            data, weights = net.get_agent_data(return_weights=True)
+            self.assertEqual(set(data.keys()), set(weights.keys()))
+            self.assertTrue(set(data.keys()) < set(full.keys()))
+            for agent_id, dat in data.items():
+                np.testing.assert_array_equal(dat, full[agent_id])
+
+        data, weights = qn2.get_agent_data(return_weights=True)
+        self.assertTrue(0.1 < len(data) / float(len(full)) < 0.3)
+        self.assertEqual(set(weights.values()), {5.0})
+
+        data, weights = qn3.get_agent_data(return_weights=True)
+        self.assertTrue(all(agent_id[1] % 5 == 0 for agent_id in data))
+        self.assertEqual(set(weights.values()), {5.0})
+
+        with self.assertRaises(ValueError):
+            qn.start_collecting_data(sample_rate=0.5, every=2)
+
+    def test_QueueNetwork_ring_data(self):
+        g = qt.generate_random_graph(50, seed=25)
+        qn = qt.QueueNetwork(g, seed=25)
+        qn.initialize(edge_type=1)
+        qn.simulate(n=100)
+
+        ring = [q.edge[2] for q in qn.edge2queue if q.edge[3] == 1]
+        rest = [q.edge[2] for q in qn.edge2queue if q.edge[3] != 1]
+
+        qn1, qn2 = qn, qn.copy()
+        qn1.start_collecting_data()
+        qn2.start_collecting_data(queues=ring, ring_size=20)
+        qn2.start_collecting_data(queues=rest)
+        qn1.simulate(n=20000)
+        qn2.simulate(n=20000)
+        for k in ring:
+            full = qn1.get_queue_data(queues=k)
+            dat = qn2.get_queue_data(queues=k)
+            np.testing.assert_array_equal(dat, full[-20:])
+
+        dat1 = qn1.get_queue_data(queues=rest)
+        dat2 = qn2.get_queue_data(queues=rest)
+        np.testing.assert_array_equal(dat1, dat2)
+
+        size = len(qn2.edge2queue[ring[0]]._data.column('arrival'))
+        qn2.simulate(n=20000)
+        self.assertEqual(len(qn2.edge2queue[ring[0]]._data.column('arrival')), size)
+
+        qn2.clear_data()
+        self.assertEqual(len(qn2.get_queue_data()), 0)
+
+    @unittest.skipIf(not (HAS_PANDAS and HAS_PYARROW), "Requires pandas and pyarrow")
+    def test_QueueNetwork_export(self):
+        g = qt.generate_random_graph(50, seed=26)
+        qn = qt.QueueNetwork(g, seed=26)
+        qn.initialize(edge_type=1)
+        qn.start_collecting_data()
+        qn.simulate(n=20000)
+
+        df = qn.to_dataframe()
+        self.assertEqual(str(df['edge'].dtype), 'int32')
+        self.assertEqual(str(df['agent_num'].dtype), 'int64')
+
+        # The export has the same rows as get_queue_data, with the
+        # agent ids of get_agent_data.
+        df = df.sort_values(['edge', 'arrival'], kind='mergesort')
+        cols = ['arrival', 'service', 'departure', 'num_queued', 'num_total', 'edge']
+        data = np.vstack([qn.get_queue_data(queues=k) for k in range(qn.nE)])
+        np.testing.assert_array_equal(df[cols].values, data)
+
+        types = np.array([q.edge[3] for q in qn.edge2queue])
+        np.testing.assert_array_equal(df['edge_type'].values, types[df['edge'].values])
+
+        agents = qn.get_agent_data()
+        ids = set(zip(df['agent_edge'], df['agent_num']))
+        self.assertEqual(ids, set(agents.keys()))
+
+        table = qn.to_arrow(edge_type=2)
+        np.testing.assert_array_equal(table.column('arrival').to_numpy(),
+                                      qn.to_dataframe(edge_type=2)['arrival'].values)
+        self.assertEqual(table.schema.field('edge_type').type, pa.int32())
+
+        batches = list(qn.to_dataframe(batch_size=1000))
+        self.assertTrue(all(len(b) <= 1000 for b in batches))
+        self.assertEqual(sum(len(b) for b in batches), len(df))
+        reader = qn.to_arrow(batch_size=1000)
+        self.assertEqual(reader.read_all().num_rows, len(df))
+
+        with mock.patch('queueing_tool.network.queue_network.HAS_PANDAS', False):
+            with self.assertRaises(ImportError):
+                qn.to_dataframe()
+
     def test_QueueNetwork_get_queue_data(self):
 
         g = nx.random_geometric_graph(50, 0.5).to_directed()
@@ -462,6 +941,220 @@ class TestQueueNetwork(unittest.TestCase):
 
         self.assertGreater(qn.current_time, t0)
 
+    def test_QueueNetwork_simulate_compiled(self):
+
+        def network(blocking):
+            g = qt.generate_pagerank_graph(100, seed=3)
+            qn = qt.QueueNetwork(g, blocking=blocking, seed=13)
+            qn.max_agents = 2000
+            qn.initialize(25)
+            return qn
+
+        def state(qn):
+            ans = [qn.current_time, qn.num_events, qn.num_agents.tolist()]
+            for q in qn.edge2queue:
+                agents = list(q._arrivals) + list(q._departures) + list(q.queue)
+                ans.append([q.time, q.num_system, q._num_total, q.num_departures,
+                            q.num_arrivals, q.active, getattr(q, 'num_blocked', 0),
+                            [(a._time, getattr(a, 'agent_id', None)) for a in agents]])
+            return ans
+
+        for blocking in ['BAS', 'RS']:
+            qn1 = network(blocking)
+            for k in range(10000):
+                qn1._simulate_next_event(slow=False)
+
+            qn2 = network(blocking)
+            self.assertTrue(qt.network._simulate.is_supported(qn2))
+            qn2.simulate(n=10000)
+
+            self.assertEqual(state(qn1), state(qn2))
+
+    def test_QueueNetwork_simulate_compiled_short_runs(self):
+        g = qt.generate_pagerank_graph(200, seed=3)
+        qn1 = qt.QueueNetwork(g, seed=13)
+        qn1.initialize(50)
+        qn2 = qt.QueueNetwork(g, seed=13)
+        qn2.initialize(50)
+        work = qn1.nE + qn1.max_agents
+        self.assertGreater(work, 1000)
+
+        # Runs too short to pay for handing the network to the compiled
+        # loop stay in Python, however many of them there are.
+        sim = mock.Mock(wraps=qt.network._simulate.simulate)
+        with mock.patch('queueing_tool.network.queue_network._simulate.simulate', sim):
+            for k in range(100):
+                qn1.simulate(n=300)
+                qn1.simulate(t=0.01)
+            self.assertFalse(sim.called)
+
+            qn1.simulate(n=work)
+            self.assertEqual(sim.call_count, 1)
+            qn1.simulate(t=100)
+            self.assertEqual(sim.call_count, 2)
+
+        qn2._run(qn1.num_events, None, compiled=False)
+        self.assertEqual(qn1.current_time, qn2.current_time)
+        self.assertEqual(qn1.num_agents.tolist(), qn2.num_agents.tolist())
+
+    def test_QueueNetwork_simulate_compiled_fallback(self):
+        g = qt.generate_pagerank_graph(50, seed=3)
+        qn = qt.QueueNetwork(g, q_classes={1: qt.InfoQueue},
+                             q_args={1: {'net_size': g.number_of_edges()}})
+        qn.initialize(10)
+        self.assertFalse(qt.network._simulate.is_supported(qn))
+
+        qn = qt.QueueNetwork(g)
+        qn.initialize(10)
+        qn.start_collecting_data()
+        self.assertFalse(qt.network._simulate.is_supported(qn))
+
+        with mock.patch('queueing_tool.network.queue_network._simulate.simulate') as sim:
+            qn.simulate(n=1000)
+            self.assertFalse(sim.called)
+        self.assertEqual(qn.num_events, 1000)
+
+    def test_QueueNetwork_simulate_until_precision(self):
+        # An M/M/1 queue with arrival rate 0.8 and service rate 1, where
+        # the mean sojourn time is 5 and the mean number in the queue
+        # is 4.
+        g = qt.adjacency2graph({0: [1], 1: []}, edge_type={0: {1: 1}})
+        q_args = {1: {'arrival_f': qt.Exponential(0.8), 'service_f': qt.Exponential(1.0)}}
+        qn = qt.QueueNetwork(g, q_classes={1: qt.QueueServer}, q_args=q_args, seed=2)
+        qn.initialize(edge_type=1)
+
+        spec = {'metric': 'sojourn', 'edge_type': 1, 'rel_half_width': 0.02}
+        ans = qn.simulate(until_precision=spec)
+        self.assertTrue(ans['converged'])
+        self.assertLessEqual(ans['half_width'], 0.02 * ans['estimate'])
+        self.assertLess(ans['lower'], 5)
+        self.assertGreater(ans['upper'], 5)
+        self.assertEqual(qn.num_events, ans['num_events'])
+        self.assertFalse(qn.edge2queue[0].collect_stats)
+
+        spec = {'metric': 'num_system', 'queues': [0], 'half_width': 0.1}
+        ans = qn.simulate(until_precision=spec)
+        self.assertTrue(ans['converged'])
+        self.assertLess(abs(ans['estimate'] - 4), 3 * ans['half_width'])
+
+        # Budgets stop the run before the target is reached.
+        spec = {'metric': 'wait', 'edge_type': 1, 'rel_half_width': 1e-4,
+                'max_events': 55555}
+        ans = qn.simulate(until_precision=spec)
+        self.assertFalse(ans['converged'])
+        self.assertEqual(ans['num_events'], 55555)
+
+        with self.assertRaises(ValueError):
+            qn.simulate(until_precision={'metric': 'wait'})
+        with self.assertRaises(ValueError):
+            qn.simulate(until_precision={'metric': 'blocked', 'half_width': 1})
+
+    def test_QueueNetwork_warm_up(self):
+        g = qt.generate_pagerank_graph(100, seed=13)
+        qn = qt.QueueNetwork(g, seed=13)
+        qn.initialize(10)
+        qn.start_collecting_stats(edge_type=1)
+        qn.start_collecting_states()
+        qn.start_collecting_sojourns()
+        qn.start_collecting_data()
+
+        # Nothing is reset when the budget runs out first.
+        ans = qn.warm_up(edge_type=2, max_events=20000)
+        self.assertFalse(ans['detected'])
+        self.assertEqual(qn.num_events, 20000)
+        self.assertGreater(len(qn.get_queue_data()), 0)
+
+        ans = qn.warm_up(edge_type=2, max_events=10**6)
+        self.assertTrue(ans['detected'])
+        self.assertEqual(qn.num_events, 20000 + ans['num_events'])
+        self.assertLessEqual(2 * ans['truncation_events'], ans['num_events'])
+        self.assertLessEqual(ans['truncation_time'], qn.current_time)
+
+        # Everything collected starts again now.
+        self.assertEqual(len(qn.get_queue_data()), 0)
+        self.assertEqual(qn.get_sojourns(False)['num_sojourns'], 0)
+        types = np.array([q.edge[3] for q in qn.edge2queue])
+        stats = qn.get_stats()
+        self.assertTrue(np.isnan(stats['mean_wait'][types != 1]).all())
+        for q in qn.edge2queue:
+            self.assertEqual(q.collect_stats, q.edge[3] == 1)
+            if q.collect_stats:
+                self.assertEqual(q._stats.t_start, qn.current_time)
+            self.assertEqual(q._states.times[0], qn.current_time)
+
+        with self.assertRaises(ValueError):
+            qn.warm_up(metric='blocked')
+
+    def test_QueueNetwork_simulate_trace(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        trace = os.path.join(path, 'trace.bin')
+
+        def network(blocking):
+            g = qt.generate_pagerank_graph(100, seed=3)
+            q_cls = {1: qt.QueueServer, 2: qt.LossQueue, 3: qt.LossQueue}
+            qn = qt.QueueNetwork(g, q_classes=q_cls, q_args={2: {'qbuffer': 1}},
+                                 blocking=blocking, seed=13)
+            qn.initialize(25)
+            return qn
+
+        for blocking in ['BAS', 'RS']:
+            qn1 = network(blocking)
+            qn1.record_trace(trace, n=10000, compiled=False, buffer_size=1000)
+            data = qt.read_trace(trace)
+            self.assertEqual(len(data), 10000)
+            self.assertEqual(data['time'][-1], qn1.current_time)
+            self.assertTrue((np.diff(data['time']) >= 0).all())
+            self.assertGreater(np.sum(data['event'] == 3), 0)
+
+            # The compiled loop goes through the same events.
+            qn2 = network(blocking)
+            self.assertIsNone(qt.verify_trace(qn2, trace, compiled=True, buffer_size=777))
+            self.assertEqual(qn2.current_time, qn1.current_time)
+
+        # The first event that differs is reported, and the simulation
+        # stops there.
+        qn3 = network('RS')
+        qn3.simulate(n=1)
+        out = qt.verify_trace(qn3, trace, buffer_size=10)
+        self.assertEqual(out['index'], 0)
+        self.assertEqual(out['expected'], data[0].item())
+        self.assertLessEqual(qn3.num_events, 12)
+
+        qn1.record_trace(trace, t=5, compiled=True)
+        self.assertTrue((qt.read_trace(trace)['time'] <= qn1.current_time).all())
+
+        qn4 = network('BAS')
+        qn4.clear()
+        with self.assertRaises(qt.QueueingToolError):
+            qn4.record_trace(trace, n=10)
+
+    def test_QueueNetwork_simulate_handoff(self):
+        # Routed agents handed straight to the next queue must give the
+        # same results as going through the queue's arrivals heap.
+        g = qt.generate_pagerank_graph(100, seed=3)
+        q_cls = {1: qt.QueueServer, 2: qt.LossQueue, 3: qt.LossQueue}
+        q_arg = {2: {'qbuffer': 1}}
+
+        def state(qn):
+            ans = [qn.current_time, qn.num_events, qn.num_agents.tolist()]
+            for q in qn.edge2queue:
+                ans.append([q._time, q.num_system, q.num_departures, q.num_arrivals,
+                             getattr(q, 'num_blocked', 0), q.data])
+            return ans
+
+        ans = []
+        for handoff in [qt.network.queue_network.HANDOFF_QUEUES, ()]:
+            qn = qt.QueueNetwork(g, q_classes=q_cls, q_args=q_arg, seed=13)
+            qn.initialize(25)
+            qn.start_collecting_data()
+            with mock.patch('queueing_tool.network.queue_network.HANDOFF_QUEUES', handoff):
+                for k in range(5000):
+                    qn._simulate_next_event(slow=False)
+            ans.append(state(qn))
+
+        self.assertEqual(ans[0], ans[1])
+
     def test_QueueNetwork_simulate_error(self):
         self.qn.clear()
         with self.assertRaises(qt.QueueingToolError):
@@ -571,3 +1264,254 @@ class TestQueueNetwork(unittest.TestCase):
         tra = self.qn.transitions()
 
         self.assertTrue(np.allclose(tra[v], mat[v]))
+
+    def test_QueueNetwork_routing(self):
+        adj = {0: [1], 1: [2, 3, 4, 5, 6]}
+        qn = qt.QueueNetwork(qt.adjacency2graph(adj))
+        qn.set_transitions({1: {2: 0.1, 3: 0.0, 4: 0.2, 5: 0.3, 6: 0.4}})
+
+        agent = qt.Agent()
+        edge = qn.edge2queue[qn.in_edges[1][0]].edge
+        out_edges = qn.out_edges[1]
+
+        def route(n):
+            qn.clear()
+            np.random.seed(10)
+            return [agent.desired_destination(qn, edge) for k in range(n)]
+
+        routes = route(100000)
+        freq = np.array([routes.count(e) for e in out_edges]) / 100000.
+        trans = np.array([0.1, 0.0, 0.2, 0.3, 0.4])
+
+        self.assertEqual(freq[1], 0)
+        self.assertTrue(np.allclose(freq, trans, atol=0.01))
+        self.assertEqual(routes, route(100000))
+
+
+class TestPriorityQueue(unittest.TestCase):
+
+    def test_PriorityQueue_update_remove(self):
+        self._check_scheduler(qt.PriorityQueue)
+
+    def test_CalendarQueue_update_remove(self):
+        self._check_scheduler(qt.CalendarQueue)
+
+    def _check_scheduler(self, scheduler):
+        np.random.seed(10)
+        n = 50
+        pq = scheduler([(1.0, 3), (0.5, 7)], n)
+        ans = {3: 1.0, 7: 0.5}
+
+        for k in range(5000):
+            e = np.random.randint(0, n)
+            u = np.random.uniform()
+            if u < 0.2:
+                pq.remove(e)
+                ans.pop(e, None)
+            elif u < 0.3:
+                pq.update(e, np.infty)
+                ans.pop(e, None)
+            elif u < 0.4 and ans:
+                key = pq.pop()
+                t = min(ans.values())
+                e = min(k for k, v in ans.items() if v == t)
+                self.assertEqual(key, (t, e))
+                del ans[e]
+            else:
+                t = float(np.random.randint(0, 20))
+                pq.update(e, t)
+                ans[e] = t
+
+            self.assertEqual(pq.size, len(ans))
+            self.assertTrue(pq.size <= n)
+            self.assertEqual(set(e for t, e in pq.keys()), set(ans))
+            if ans:
+                t = min(ans.values())
+                e = min(k for k, v in ans.items() if v == t)
+                self.assertEqual(pq.peek(), (t, e))
+                keys = sorted((v, k) for k, v in ans.items())
+                for j in [1, 3, len(ans) + 1]:
+                    self.assertEqual(pq.peek_k(j), keys[:j])
+            else:
+                self.assertIsNone(pq.peek())
+
+        stats = pq.stats
+        self.assertTrue(stats['updates'] > 0)
+        self.assertEqual(stats['stale_avoided'], stats['updates'] + stats['removals'])
+
+    def test_PriorityQueue_peek_k(self):
+        self._check_peek_k(qt.PriorityQueue)
+
+    def test_CalendarQueue_peek_k(self):
+        self._check_peek_k(qt.CalendarQueue)
+
+    def _check_peek_k(self, scheduler):
+        np.random.seed(10)
+        n = 500
+        for scale in [0.01, 1, 1000]:
+            # A few keys far in the future leave most of the calendar
+            # empty between them and the rest.
+            times = np.random.exponential(scale, n)
+            times[::50] += 1e6
+            pq = scheduler(list(zip(times, range(n))), n)
+            for k in range(50):
+                pq.pop()
+
+            keys = sorted(pq.keys())
+            self.assertEqual(pq.peek_k(0), [])
+            for k in [1, 10, 100, len(keys), len(keys) + 5]:
+                self.assertEqual(pq.peek_k(k), keys[:k])
+            self.assertEqual(pq.size, len(keys))
+
+    def test_PriorityQueue_bounded_size(self):
+        g = qt.generate_pagerank_graph(50, seed=3)
+        qn = qt.QueueNetwork(g, q_classes={1: qt.LossQueue}, q_args={1: {'num_servers': 1}}, seed=13)
+        qn.initialize(20)
+
+        for k in range(5000):
+            qn._simulate_next_event(slow=False)
+            self.assertTrue(qn._fancy_heap.size <= qn.nE)
+
+        self.assertTrue(qn._fancy_heap.arraysize <= qn.nE)
+        self.assertTrue(qn._fancy_heap.stats['stale_avoided'] > 0)
+
+    def test_QueueNetwork_seed(self):
+        g = qt.generate_pagerank_graph(50, seed=3)
+
+        def network(seed, q_args=None):
+            q_cls = {1: qt.QueueServer, 2: qt.QueueServer, 3: qt.QueueServer}
+            return qt.QueueNetwork(g, q_classes=q_cls, q_args=q_args, seed=seed)
+
+        qn1 = network(13)
+        qn2 = network(13, {2: {'service_f': qt.Exponential(5.0)}})
+        qn3 = network(14)
+
+        # Each queue has its own stream, so changing the queues of one
+        # edge type does not change the streams of the others.
+        for q1, q2, q3 in zip(qn1.edge2queue, qn2.edge2queue, qn3.edge2queue):
+            x = q1.rng.random(5)
+            self.assertTrue((x == q2.rng.random(5)).all())
+            self.assertFalse((x == q3.rng.random(5)).any())
+            if q1.edge[3] == 2:
+                self.assertIs(q2.service_f.rng, q2.rng)
+
+        ans = []
+        for qn in [network(13), network(np.random.SeedSequence(13)), network(14)]:
+            qn.initialize(10)
+            qn.simulate(n=2000)
+            ans.append([(q.time, q.num_departures) for q in qn.edge2queue])
+
+        self.assertEqual(ans[0], ans[1])
+        self.assertNotEqual(ans[0], ans[2])
+
+        # The global random state is left alone.
+        np.random.seed(3)
+        x = np.random.random()
+        np.random.seed(3)
+        qn = network(13)
+        qn.initialize(10)
+        qn.simulate(n=100)
+        self.assertEqual(np.random.random(), x)
+
+    def test_QueueNetwork_replicate(self):
+        g = qt.generate_pagerank_graph(50, seed=3)
+        qn = qt.QueueNetwork(g, seed=13)
+        qn.initialize(10)
+        qn.simulate(n=500)
+        state = (qn.current_time, qn.num_events)
+
+        ans1 = qn.replicate(4, n_events=1000, processes=1, seed=5)
+        ans2 = qn.replicate(4, n_events=1000, processes=2, seed=5)
+
+        self.assertEqual((qn.current_time, qn.num_events), state)
+        self.assertEqual(ans1['num_departures'].shape, (4, qn.nE))
+        self.assertTrue((ans1['num_events'] == 1500).all())
+        for key, value in ans1.items():
+            self.assertTrue((value == ans2[key]).all())
+
+        # Each replication has its own streams.
+        self.assertEqual(len(set(ans1['current_time'])), 4)
+
+        data = qn.replicate(3, t=2, processes=2, collect='queue_data')
+        self.assertEqual(len(data), 3)
+        self.assertTrue(all(d.shape[1] == 6 and len(d) > 0 for d in data))
+
+        ans = qn.replicate(3, t=2, processes=1, collect=lambda net: net.current_time)
+        self.assertTrue(all(t >= state[0] + 2 for t in ans))
+
+        with self.assertRaises(ValueError):
+            qn.replicate(2)
+
+        qn.clear()
+        with self.assertRaises(qt.QueueingToolError):
+            qn.replicate(2, n_events=10)
+
+    def test_QueueNetwork_replicate_store(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        g = qt.generate_pagerank_graph(50, seed=3)
+        qn = qt.QueueNetwork(g, seed=13)
+        qn.initialize(10)
+
+        store = qt.DiskDataStore(path, chunk_size=256)
+        qn.start_collecting_data(store=store)
+        qn.simulate(n=3000)
+
+        def contents():
+            with open(os.path.join(path, 'index.jsonl')) as f:
+                return sorted(os.listdir(path)), f.read()
+
+        before = contents()
+        data = qn.replicate(4, n_events=5000, processes=2, collect='queue_data')
+        qn.replicate(2, n_events=5000, processes=1)
+
+        # The replications kept their data to themselves
+        self.assertEqual(contents(), before)
+        self.assertTrue(all(len(d) > 0 for d in data))
+        self.assertIs(qn._store, store)
+        self.assertIs(qn._data.sink, store)
+
+        qn.stop_collecting_data()
+        reopened = qt.DiskDataStore(path)
+        self.assertEqual(len(reopened), len(store))
+        self.assertEqual(len(reopened.read()), len(qn.get_queue_data()))
+
+    def test_QueueNetwork_pickle(self):
+        g = qt.generate_pagerank_graph(50, seed=3)
+        qn = qt.QueueNetwork(g, seed=13)
+        qn.initialize(10)
+        qn.simulate(n=100)
+
+        qn2 = pickle.loads(pickle.dumps(qn))
+        qn.simulate(n=1000)
+        qn2.simulate(n=1000)
+        self.assertEqual(qn.current_time, qn2.current_time)
+        self.assertEqual(qn.num_agents.tolist(), qn2.num_agents.tolist())
+
+    def test_QueueNetwork_scheduler(self):
+        g = qt.generate_pagerank_graph(100, seed=3)
+
+        def state(qn):
+            ans = [qn.current_time, qn.num_events, qn.time, qn.next_event_description()]
+            return ans + [(q._time, q.num_system, q.num_departures) for q in qn.edge2queue]
+
+        ans = []
+        for scheduler in ['heap', 'calendar', qt.CalendarQueue]:
+            qn = qt.QueueNetwork(g, scheduler=scheduler, seed=13)
+            qn.initialize(25)
+            for k in range(2000):
+                qn._simulate_next_event(slow=False)
+            ans.append(state(qn))
+
+        self.assertEqual(ans[0], ans[1])
+        self.assertEqual(ans[0], ans[2])
+        self.assertIsInstance(qn.copy()._fancy_heap, qt.CalendarQueue)
+
+        qn.clear()
+        self.assertIsInstance(qn._fancy_heap, qt.CalendarQueue)
+
+        with self.assertRaises(ValueError):
+            qt.QueueNetwork(g, scheduler='ladder')
+        with self.assertRaises(ValueError):
+            qt.QueueNetwork(g, scheduler=dict)
@@ -1,4 +1,6 @@
+import copy
 import functools
+import pickle
 import unittest
 
 import networkx as nx
@@ -67,6 +69,34 @@ class TestQueueServers(unittest.TestCase):
 
         self.assertTrue(t < q2.time)
 
+    def test_QueueServer_rng(self):
+
+        def r(t):
+            return 2 + np.sin(t)
+
+        arr = functools.partial(qt.poisson_random_measure, rate=r, rate_max=3)
+        ans = []
+        for q in [qt.QueueServer(arrival_f=arr, service_f=qt.Gamma(2, 0.2), seed=15),
+                  qt.QueueServer(arrival_f=arr, service_f=qt.Gamma(2, 0.2), seed=15),
+                  qt.QueueServer(arrival_f=arr, rng=np.random.default_rng(15))]:
+            self.assertIsNone(arr.keywords.get('rng'))
+            self.assertIs(q.arrival_f.keywords['rng'], q.rng)
+            self.assertIs(q.service_f.rng, q.rng)
+
+            q.set_active()
+            q.simulate(n=2000)
+            ans.append((q.time, q.num_departures, q.num_system))
+
+        self.assertEqual(ans[0], ans[1])
+        self.assertNotEqual(ans[0], ans[2])
+
+        # The global random state is left alone.
+        np.random.seed(3)
+        x = np.random.random()
+        np.random.seed(3)
+        qt.QueueServer(seed=15).simulate(n=10)
+        self.assertEqual(np.random.random(), x)
+
     def test_QueueServer_active_cap(self):
 
         def r(t):
@@ -99,11 +129,11 @@ class TestQueueServers(unittest.TestCase):
         ans = np.zeros((num_events, 3), bool)
 
         for k in range(num_events):
-            nt = len(q._departures) + len(q.queue) + len(q._arrivals) - 2
-            nS = len(q._departures) + len(q.queue) - 1
+            nt = len(q._departures) + len(q.queue) + len(q._arrivals)
+            nS = len(q._departures) + len(q.queue)
             ans[k, 0] = nt == q._num_total
             ans[k, 1] = nS == q.num_system
-            ans[k, 2] = len(q._departures) - 1 <= q.num_servers
+            ans[k, 2] = len(q._departures) <= q.num_servers
             q.simulate(n=1)
 
         self.assertTrue(ans.all())
@@ -173,11 +203,11 @@ class TestQueueServers(unittest.TestCase):
         ans = np.zeros((num_events, 3), bool)
 
         for k in range(num_events):
-            nt = len(q._departures) + len(q.queue) + len(q._arrivals) - 2
-            nS = len(q._departures) + len(q.queue) - 1
+            nt = len(q._departures) + len(q.queue) + len(q._arrivals)
+            nS = len(q._departures) + len(q.queue)
             ans[k, 0] = nt == q._num_total
             ans[k, 1] = nS == q.num_system
-            ans[k, 2] = len(q._departures) - 1 <= q.num_servers
+            ans[k, 2] = len(q._departures) <= q.num_servers
             q.simulate(n=1)
 
         self.assertTrue(ans.all())
@@ -235,6 +265,214 @@ class TestQueueServers(unittest.TestCase):
 
         self.assertFalse(data[:, (1, 2)].any())
 
+    def test_DataCollector(self):
+        q = qt.QueueServer(num_servers=2, collect_data=True, seed=3)
+        q.set_active()
+        q.simulate(n=2000)
+
+        dat = q.fetch_data()
+        self.assertEqual(len(dat), q._num_arrivals)
+        self.assertEqual(len(q._data), q._num_arrivals)
+        self.assertTrue((np.diff(dat[:, 0]) >= 0).all())
+
+        done = dat[:, 2] > 0
+        self.assertEqual(done.sum(), q.num_departures)
+        self.assertTrue((dat[done, 1] >= dat[done, 0]).all())
+        self.assertTrue((dat[done, 2] >= dat[done, 1]).all())
+
+        # The dict view of the data holds the same rows
+        rows = [r for d in q.data.values() for r in d]
+        self.assertEqual(len(rows), len(dat))
+
+        size = sum(getattr(q._data, c).itemsize for c in q._data.columns)
+        self.assertEqual(size, 49)
+
+        q.clear()
+        self.assertEqual(len(q._data), 0)
+        self.assertEqual(q.data, {})
+
+    def test_QueueServer_data_view(self):
+        q = qt.QueueServer(num_servers=2, collect_data=True, seed=3)
+        q.set_active()
+        q.simulate(n=2000)
+
+        # The view is only rebuilt once the collector changes
+        data = q.data
+        self.assertIs(q.data, data)
+        q.simulate(n=10)
+        self.assertIsNot(q.data, data)
+        self.assertEqual(sum(len(d) for d in q.data.values()), len(q.fetch_data()))
+
+        # Assigning a dict replaces the queue's rows
+        data = dict((k, [list(r) for r in v]) for k, v in q.data.items())
+        dat = q.fetch_data()
+        q.data = data
+        self.assertEqual(q.data, data)
+        self.assertTrue((q.fetch_data() == dat).all())
+        self.assertEqual(q._data.num_done, int((dat[:, 2] > 0).sum()))
+
+        q.data = {}
+        self.assertEqual(q.data, {})
+        self.assertEqual(len(q.fetch_data()), 0)
+
+    def test_DataCollector_network(self):
+        g = qt.generate_random_graph(20, seed=7)
+        qn = qt.QueueNetwork(g, seed=7)
+        qn.initialize(queues=range(qn.nE))
+        qn.start_collecting_data()
+        qn.simulate(n=5000)
+
+        self.assertTrue(all(q._data is qn._data for q in qn.edge2queue))
+        self.assertEqual(len(qn._data), len(qn.get_queue_data()))
+
+        net = qn.copy()
+        self.assertTrue(all(q._data is net._data for q in net.edge2queue))
+
+        qn.clear_data(queues=[0, 1])
+        data = qn.get_queue_data()
+        self.assertEqual(len(qn._data), len(data))
+        self.assertFalse(np.isin(data[:, 5], [0, 1]).any())
+        self.assertEqual(len(net.get_queue_data(queues=[0, 1])),
+                         len(net._data.rows([0, 1])))
+
+        # Each queue's rows come from one grouping of the collector
+        groups = None
+        for q in qn.edge2queue:
+            e = q.edge[2]
+            rows = qn._data.rows([e])
+            np.testing.assert_array_equal(qn._data.edge_rows(e), rows)
+            self.assertEqual(sum(len(d) for d in q.data.values()), len(rows))
+            groups = groups or qn._data._groups
+            self.assertIs(qn._data._groups, groups)
+        self.assertEqual(len(qn._data.edge_rows(0)), 0)
+        self.assertEqual(len(qn._data.edge_rows(qn.nE + 5)), 0)
+
+    def test_QueueServer_stats(self):
+        q = qt.LossQueue(num_servers=2, qbuffer=3, collect_data=True,
+                         collect_stats=True, seed=8,
+                         arrival_f=qt.Exponential(2.5),
+                         service_f=qt.Exponential(1.0))
+        q.set_active()
+        q.simulate(n=20000)
+
+        stats = q.get_stats()
+        dat = q.fetch_data()
+        served = dat[dat[:, 1] > 0]
+        done = dat[dat[:, 2] > 0]
+
+        self.assertEqual(stats['num_blocked'], q.num_blocked)
+        self.assertEqual(stats['num_waits'], len(served))
+        self.assertEqual(stats['num_sojourns'], len(done))
+        waits = served[:, 1] - served[:, 0]
+        sojourns = done[:, 2] - done[:, 0]
+        self.assertAlmostEqual(stats['mean_wait'], waits.mean())
+        self.assertAlmostEqual(stats['var_wait'], waits.var(ddof=1))
+        self.assertAlmostEqual(stats['mean_sojourn'], sojourns.mean())
+        self.assertAlmostEqual(stats['var_sojourn'], sojourns.var(ddof=1))
+
+        # The integral of num_system is the total time spent by agents,
+        # up to the agents that are still in the queue.
+        area = stats['mean_num_system'] * stats['elapsed']
+        agents = list(q.queue) + list(q._departures.agents)
+        inside = sum(q._current_t - a._arrival for a in agents)
+        self.assertAlmostEqual(area, sojourns.sum() + inside, places=6)
+        self.assertAlmostEqual(stats['mean_busy'] / 2, stats['utilization'])
+
+        q.clear()
+        self.assertTrue(np.isnan(q.get_stats()['mean_wait']))
+
+    def test_QueueServer_quantiles(self):
+        q = qt.QueueServer(num_servers=2, collect_data=True, collect_stats=True,
+                           collect_quantiles=True, seed=9,
+                           arrival_f=qt.Exponential(1.5),
+                           service_f=qt.Exponential(1.0))
+        q.set_active()
+        q.simulate(n=20000)
+
+        dat = q.fetch_data()
+        served = dat[dat[:, 1] > 0]
+        done = dat[dat[:, 2] > 0]
+        waits = served[:, 1] - served[:, 0]
+        sojourns = done[:, 2] - done[:, 0]
+
+        p = [0.25, 0.5, 0.9, 0.95, 0.99]
+        quantiles = q.get_quantiles(p)
+        for key, x in [('wait', waits), ('sojourn', sojourns)]:
+            exact = np.quantile(x, p, method='lower')
+            upper = np.quantile(x, p, method='higher')
+            est = quantiles[key]
+            self.assertTrue((est >= exact * 0.99 - 1e-9).all())
+            self.assertTrue((est <= upper * 1.01 + 1e-9).all())
+
+        sketch = q._stats.sojourn_sketch
+        copied = pickle.loads(pickle.dumps(sketch))
+        np.testing.assert_array_equal(copied.quantile(p), sketch.quantile(p))
+
+        # Merging two halves gives the sketch of the whole.
+        a, b = qt.QuantileSketch(), qt.QuantileSketch()
+        for x in sojourns[::2]:
+            a.add(x)
+        for x in sojourns[1::2]:
+            b.add(x)
+        a.merge(b)
+        self.assertEqual(len(a), len(sojourns))
+        np.testing.assert_array_equal(a.quantile(p), sketch.quantile(p))
+
+        with self.assertRaises(ValueError):
+            a.merge(qt.QuantileSketch(rel_error=0.05))
+
+        q.clear()
+        self.assertTrue(np.isnan(q.get_quantiles(p)['wait']).all())
+
+    def test_QueueServer_ring_data(self):
+        kwargs = dict(num_servers=2, seed=12, arrival_f=qt.Exponential(1.5),
+                      service_f=qt.Exponential(1.0))
+        q1 = qt.QueueServer(collect_data=True, **kwargs)
+        q2 = qt.QueueServer(collect_data='ring', ring_size=200, **kwargs)
+        for q in [q1, q2]:
+            q.set_active()
+            q.simulate(n=20000)
+
+        # The ring holds the latest visits, in the order they arrived.
+        full, ring = q1.fetch_data(), q2.fetch_data()
+        self.assertEqual(ring.shape, (200, 6))
+        np.testing.assert_array_equal(ring, full[-200:])
+
+        q2.simulate(n=20000)
+        self.assertEqual(len(q2._data.rows([q2.edge[2]])), 200)
+        self.assertEqual(len(q2._data.column('arrival')), 200)
+
+        with self.assertRaises(ValueError):
+            qt.QueueServer(collect_data='ring', ring_size=0)
+
+    def test_QueueServer_states(self):
+        q = qt.QueueServer(num_servers=2, collect_data=True, collect_states=True,
+                           seed=10, arrival_f=qt.Exponential(1.5),
+                           service_f=qt.Exponential(1.0))
+        q.set_active()
+        q.simulate(n=20000)
+
+        # Rebuild num_system from the arrival and departure times.
+        dat = q.fetch_data()
+        times = np.concatenate((dat[:, 0], dat[dat[:, 2] > 0, 2]))
+        steps = np.concatenate((np.ones(len(dat)), -np.ones(np.sum(dat[:, 2] > 0))))
+        order = np.argsort(times, kind='stable')
+        times, num = times[order], np.cumsum(steps[order])
+
+        t0, t1 = 100.0, q.current_time
+        tt = np.clip(np.append(times, t1), t0, t1)
+        area = np.sum(num * np.diff(tt))
+        self.assertAlmostEqual(q.time_average('num_system', t0, t1), area / (t1 - t0))
+
+        area = np.sum(np.minimum(num, 2) * np.diff(tt))
+        self.assertAlmostEqual(q.time_average('utilization', t0, t1), area / (t1 - t0) / 2)
+
+        with self.assertRaises(ValueError):
+            q.time_average('num_agents')
+
+        q.clear()
+        self.assertEqual(len(q._states), 1)
+
     def test_ResourceQueue_network(self):
 
         g = nx.random_geometric_graph(100, 0.2).to_directed()
@@ -311,3 +549,70 @@ class TestQueueServers(unittest.TestCase):
         a0._time = 20
         self.assertGreaterEqual(a0, a1)
         self.assertGreater(a0, a1)
+
+    def test_AgentHeap_order(self):
+        from queueing_tool.queues.agent_heap import AgentHeap
+
+        np.random.seed(10)
+        agents = []
+        for k in range(200):
+            a = qt.Agent((0, k))
+            a._time = float(np.random.randint(0, 20))
+            agents.append(a)
+
+        heap = AgentHeap(agents[:100])
+        for a in agents[100:]:
+            heap.push(a)
+
+        self.assertEqual(len(heap), 200)
+        self.assertEqual(heap.next_time, min(a._time for a in agents))
+
+        heap = copy.deepcopy(heap)
+        popped = [heap.pop() for k in range(200)]
+        ans = sorted(agents, key=lambda a: (a._time, a.agent_id[1]))
+
+        # Ties come out in the order the agents were pushed.
+        self.assertEqual([a.agent_id for a in popped], [a.agent_id for a in ans])
+        self.assertEqual(heap.next_time, np.infty)
+        self.assertIsNone(heap.peek())
+
+        with self.assertRaises(IndexError):
+            heap.pop()
+
+    def test_Distribution_sample(self):
+        dists = [
+            (qt.Exponential(2.0), 0.5),
+            (qt.Gamma(2.0, 0.5), 1.0),
+            (qt.Uniform(1.0, 3.0), 2.0)
+        ]
+
+        for dist, mean in dists:
+            np.random.seed(10)
+            dist.reset()
+            x = np.array([dist(1.0) for k in range(20000)]) - 1.0
+            self.assertAlmostEqual(np.mean(x), mean, 1)
+
+            other = copy.deepcopy(dist)
+            self.assertEqual([dist.sample() for k in range(50)],
+                             [other.sample() for k in range(50)])
+
+            np.random.seed(10)
+            dist.reset()
+            self.assertEqual(dist(1.0) - 1.0, x[0])
+
+        with self.assertRaises(ValueError):
+            qt.Exponential(-1.0)
+        with self.assertRaises(ValueError):
+            qt.Gamma(1.0, 0)
+        with self.assertRaises(ValueError):
+            qt.Uniform(1.0, 1.0)
+
+    def test_QueueServer_distribution(self):
+        q1 = qt.QueueServer(arrival_f=qt.Exponential(2.0), service_f=qt.Gamma(2, 0.2))
+        q2 = qt.QueueServer(arrival_f=lambda t: t + np.random.exponential(0.5))
+
+        for q in [q1, q2]:
+            q.set_active()
+            q.simulate(n=1000)
+            self.assertEqual(q.num_departures + q.num_system, q._num_arrivals)
+            self.assertGreater(q.num_departures, 0)